@@ -85,7 +85,9 @@ def main(genie_version,
          test=False,
          staging=False,
          debug=False,
-         skip_mutationsincis=False):
+         skip_mutationsincis=False,
+         maf_chunksize=None,
+         maf_workers=1):
     '''
     - Does parameter checks
     - Updates process tracking start
@@ -108,6 +110,8 @@ def main(genie_version,
         staging: Staging flag, uses staging databases
         debug:  Synapse debug flag
         skip_mutationsincis: Skip mutation in cis filter
+        maf_chunksize: Number of rows to filter at a time with pandas
+        maf_workers: Number of processes filtering center mafs
     '''
     syn = process_functions.synLogin(pemfile, debug=debug)
     genie_user = os.environ.get('GENIE_USER')
@@ -138,9 +142,9 @@ def main(genie_version,
         oncoLinkEnt = syn.get(oncoLink)
         oncotree_link = oncoLinkEnt.externalURL
 
-    # Check if you can connect to oncotree link,
+    # Check if you can connect to oncotree link or have a snapshot of it,
     # if not then don't run validation / processing
-    process_functions.checkUrl(oncotree_link)
+    process_functions.check_oncotree_link(oncotree_link)
 
     cbioValidatorPath = os.path.join(
         cbioportal_path, "core/src/main/scripts/importer/validateData.py")
@@ -184,7 +188,9 @@ def main(genie_version,
         skipMutationsInCis=skip_mutationsincis,
         test=test,
         genie_user=genie_user,
-        genie_pass=genie_pass)
+        genie_pass=genie_pass,
+        maf_chunksize=maf_chunksize,
+        maf_workers=maf_workers)
 
     # Create case lists files
     logger.info("CREATE CASE LIST FILES")
@@ -331,6 +337,18 @@ if __name__ == "__main__":
         action='store_true',
         help="Skip running mutation in cis script")
 
+    parser.add_argument(
+        "--mafChunksize",
+        type=int,
+        help="Filter the release mafs with pandas, reading this many "
+             "rows at a time")
+
+    parser.add_argument(
+        "--mafWorkers",
+        type=int,
+        default=1,
+        help="Number of processes filtering the center mafs")
+
     parser.add_argument(
         "--pemFile",
         type=str,
@@ -363,4 +381,6 @@ if __name__ == "__main__":
          test=args.test,
          staging=args.staging,
          debug=args.debug,
-         skip_mutationsincis=args.skipMutationsInCis)
+         skip_mutationsincis=args.skipMutationsInCis,
+         maf_chunksize=args.mafChunksize,
+         maf_workers=args.mafWorkers)
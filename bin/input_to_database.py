@@ -1,6 +1,7 @@
 #! /usr/bin/env python3
 import os
 import argparse
+import functools
 import logging
 
 from genie import input_to_database
@@ -23,9 +24,16 @@ def main(process,
          reference=None,
          vcf2maf_path=None,
          vep_path=None,
-         vep_data=None):
+         vep_data=None,
+         oncotree_offline=False,
+         threads=1,
+         center_workers=1,
+         processing_workers=None,
+         validation_executor="thread"):
 
     syn = process_functions.synLogin(pemfile, debug=debug)
+    process_functions.ONCOTREE_CACHE.use_synapse_cache(syn)
+    process_functions.ONCOTREE_CACHE.offline = oncotree_offline
     # Must specify correct paths to vcf2maf, VEP and VEP data
     # if trying to process vcf, maf and mafSP
     if process in ['vcf', 'maf', 'mafSP'] and not only_validate:
@@ -72,9 +80,9 @@ def main(process,
             databaseToSynIdMappingDf['Database'] == 'oncotreeLink'].values[0]
         onco_link_ent = syn.get(onco_link)
         oncotree_link = onco_link_ent.externalURL
-    # Check if you can connect to oncotree link,
+    # Check if you can connect to oncotree link or have a snapshot of it,
     # if not then don't run validation / processing
-    process_functions.checkUrl(oncotree_link)
+    process_functions.check_oncotree_link(oncotree_link)
 
     center_mapping_ent = syn.get(center_mapping_id)
     if center_mapping_ent.get('isProcessing', ['True'])[0] == 'True':
@@ -91,16 +99,26 @@ def main(process,
     # Create new maf database, should only happen once if its specified
     if create_new_maf_database:
         databaseToSynIdMappingDf = \
-            input_to_database.create_and_archive_maf_database(syn, databaseToSynIdMappingDf)
-
-    for center in centers:
-        input_to_database.center_input_to_database(
-            syn, project_id, center, process,
-            only_validate, vcf2maf_path, vep_path,
-            vep_data, databaseToSynIdMappingDf,
-            center_mapping_df, reference=reference,
-            delete_old=delete_old,
-            oncotree_link=oncotree_link)
+            input_to_database.create_and_archive_maf_database(
+                syn, databaseToSynIdMappingDf)
+
+    failed_centers = input_to_database.centers_input_to_database(
+        syn, project_id, centers, process,
+        only_validate, vcf2maf_path, vep_path,
+        vep_data, databaseToSynIdMappingDf,
+        center_mapping_df, reference=reference,
+        delete_old=delete_old,
+        oncotree_link=oncotree_link,
+        threads=threads,
+        center_workers=center_workers,
+        processing_workers=processing_workers,
+        validation_executor=validation_executor,
+        syn_login=functools.partial(process_functions.synLogin,
+                                    pemfile, debug=debug))
+    if failed_centers:
+        # isProcessing stays True, like after a crash, so the failed
+        # centers are looked at before the next run
+        raise input_to_database.FailedCentersError(failed_centers)
 
     # To ensure that this is the new entity
     center_mapping_ent = syn.get(center_mapping_id)
@@ -109,8 +127,8 @@ def main(process,
 
     error_tracker_synid = process_functions.getDatabaseSynId(
         syn, "errorTracker", databaseToSynIdMappingDf=databaseToSynIdMappingDf)
-    # Only write out invalid reasons if the center
-    # isnt specified and if only validate
+    # write_invalid_reasons rewrites the error report of every center in
+    # center_mapping_df, so it only runs after all centers were validated
     if center is None and only_validate:
         logger.info("WRITING INVALID REASONS TO CENTER STAGING DIRS")
         write_invalid_reasons.write_invalid_reasons(
@@ -151,6 +169,10 @@ if __name__ == "__main__":
         "--oncotree_link",
         type=str,
         help="Link to oncotree code")
+    parser.add_argument(
+        "--oncotree_offline",
+        action='store_true',
+        help="Only use stored oncotree snapshots, don't request oncotree")
     parser.add_argument(
         "--createNewMafDatabase",
         action='store_true',
@@ -163,6 +185,29 @@ if __name__ == "__main__":
         "--reference",
         type=str,
         help="Path to VCF reference file")
+    parser.add_argument(
+        "--thread",
+        type=int,
+        default=1,
+        help="Number of files to validate at the same time")
+    parser.add_argument(
+        "--validation_executor",
+        choices=["thread", "process"],
+        default="thread",
+        help="Validate the --thread files in threads or in processes. "
+             "Processes run the pandas validation in parallel, but each "
+             "logs into Synapse")
+    parser.add_argument(
+        "--center_workers",
+        type=int,
+        default=1,
+        help="Number of centers to validate and process at the same time")
+    parser.add_argument(
+        "--processing_workers",
+        type=int,
+        help="Number of centers to process at the same time. "
+             "Defaults to 1 for vcf, maf and mafSP, "
+             "otherwise --center_workers")
 
     # DEFAULT PARAMS
     parser.add_argument(
@@ -195,4 +240,9 @@ if __name__ == "__main__":
          reference=args.reference,
          vcf2maf_path=args.vcf2mafPath,
          vep_path=args.vepPath,
-         vep_data=args.vepData)
+         vep_data=args.vepData,
+         oncotree_offline=args.oncotree_offline,
+         threads=args.thread,
+         center_workers=args.center_workers,
+         processing_workers=args.processing_workers,
+         validation_executor=args.validation_executor)
@@ -6,6 +6,7 @@ import logging
 
 import synapseclient
 
+import genie.bed
 import genie.config
 import genie.validate
 from .__version__ import __version__
@@ -63,6 +64,9 @@ def build_parser():
 
     parser_validate.add_argument("--oncotree_link", type=str, help="Link to oncotree code")
 
+    parser_validate.add_argument("--oncotree_offline", action='store_true',
+                                 help="Only use stored oncotree snapshots, don't request oncotree")
+
     validate_group = parser_validate.add_mutually_exclusive_group()
 
     validate_group.add_argument("--filetype", type=str,
@@ -88,13 +92,30 @@ def build_parser():
                                  help='Do not check hugo symbols of fusion and cna file')
 
     parser_validate.set_defaults(func=genie.validate._perform_validate)
+
+    parser_store = subparsers.add_parser('build-feature-store',
+                                         help='Builds the exon and gene feature store used to '
+                                              'annotate BED files from a local GTF')
+
+    parser_store.add_argument("gtf_path", type=str,
+                              help='Path to GRCh37 GTF, can be gzipped')
+
+    parser_store.add_argument("--store_dir", type=str,
+                              help='Feature store directory. Defaults to the one used '
+                                   'when processing BED files')
+
+    parser_store.set_defaults(func=genie.bed._perform_build_feature_store)
     return parser
 
 
 def main():
     """Invoke"""
     args = build_parser().parse_args()
-    syn = synapse_login(args.syn_user, args.syn_pass)
+    # The feature store is built offline
+    if args.func == genie.bed._perform_build_feature_store:
+        syn = None
+    else:
+        syn = synapse_login(args.syn_user, args.syn_pass)
     # func has to match the set_defaults
     args.func(syn, args)
 
@@ -1,14 +1,35 @@
 """GENIE bed class and functions"""
+import csv
+import functools
+import io
+import json
 import os
 import logging
+import shutil
 import subprocess
+import tempfile
+import threading
 
+import numpy as np
 import pandas as pd
+try:
+    from synapseclient.core.utils import md5_for_file
+except ModuleNotFoundError:
+    from synapseclient.utils import md5_for_file
 
 from .example_filetype_format import FileTypeFormat
 from . import process_functions
 
 LOGGER = logging.getLogger(__name__)
+# Remapped bed symbols are cached between validation and processing, in
+# BED_REMAP_CACHE_DIR if it is set, otherwise in the bed_remap_cache dir of
+# the Synapse client's cache
+BED_REMAP_CACHE_DIR = None
+BED_REMAP_CACHE_SIZE = 200
+GRCH37_GTF_URL = ('http://ftp.ensembl.org/pub/release-75/gtf/homo_sapiens/'
+                  'Homo_sapiens.GRCh37.75.gtf.gz')
+GTF_FEATURE_TYPES = ["exon", "gene"]
+GENE_POSITION_SYNID = "syn11806563"
 
 
 # def createGenePositionsTables():
@@ -56,57 +77,256 @@ LOGGER = logging.getLogger(__name__)
 #         databaseEnt.primaryKey, toDelete=True)
 #     return(genes)
 
-def create_gtf(dirname):
+
+class GenomicIntervals(object):
+    """
+    Intervals sorted by start position per chromosome, used to check if
+    BED regions overlap any of the intervals with a binary search instead
+    of `bedtools intersect`.  Positions are 0-based and half-open like in
+    a BED file.
     """
-    Create exon.gtf and gene.gtf from GRCh37 gtf
+
+    def __init__(self, chromosomes, starts, ends):
+        """
+        Args:
+            chromosomes: Chromosome of each interval
+            starts: 0-based start of each interval
+            ends: End of each interval
+        """
+        intervaldf = pd.DataFrame({'chrom': chromosomes,
+                                   'start': starts,
+                                   'end': ends})
+        self._intervals = {}
+        for chrom, chromdf in intervaldf.groupby('chrom'):
+            chromdf = chromdf.sort_values('start', kind='stable')
+            starts = chromdf['start'].values.astype(np.int64)
+            ends = chromdf['end'].values.astype(np.int64)
+            # The maximum end of all the intervals starting before a
+            # position, so one lookup tells if any of them reach past it
+            max_ends = np.maximum.accumulate(ends)
+            self._intervals[str(chrom)] = (starts, ends, max_ends)
+
+    def save(self, store_dir, feature_type):
+        """
+        Save the intervals as .npy arrays of chromosome codes, starts, ends
+        and maximum ends, sorted by chromosome and start.  The chromosome
+        names of the codes are saved in {feature_type}_chromosomes.json
+
+        Args:
+            store_dir: Feature store directory
+            feature_type: Name of the features, ie. exon
+        """
+        chromosomes = sorted(self._intervals)
+        arrays = {'chrom': [], 'start': [], 'end': [], 'max_end': []}
+        for code, chrom in enumerate(chromosomes):
+            starts, ends, max_ends = self._intervals[chrom]
+            arrays['chrom'].append(np.full(len(starts), code,
+                                           dtype=np.int32))
+            arrays['start'].append(starts)
+            arrays['end'].append(ends)
+            arrays['max_end'].append(max_ends)
+        for name, chrom_arrays in arrays.items():
+            dtype = np.int32 if name == 'chrom' else np.int64
+            array = np.concatenate(chrom_arrays) if chrom_arrays \
+                else np.array([], dtype=dtype)
+            np.save(os.path.join(store_dir, "{}_{}.npy".format(
+                feature_type, name)), array)
+        with open(os.path.join(store_dir, "{}_chromosomes.json".format(
+                feature_type)), "w") as chrom_file:
+            json.dump(chromosomes, chrom_file)
+
+    @classmethod
+    def load(cls, store_dir, feature_type):
+        """
+        Load intervals saved with save.  The arrays are memory-mapped,
+        so only the parts that are searched are read from disk.
+
+        Args:
+            store_dir: Feature store directory
+            feature_type: Name of the features, ie. exon
+
+        Returns:
+            GenomicIntervals
+        """
+        with open(os.path.join(store_dir, "{}_chromosomes.json".format(
+                feature_type)), "r") as chrom_file:
+            chromosomes = json.load(chrom_file)
+        arrays = {}
+        for name in ['chrom', 'start', 'end', 'max_end']:
+            arrays[name] = np.load(
+                os.path.join(store_dir, "{}_{}.npy".format(feature_type,
+                                                           name)),
+                mmap_mode='r')
+        # Intervals are sorted by chromosome code, so each chromosome is
+        # one slice of the arrays
+        boundaries = np.searchsorted(arrays['chrom'],
+                                     np.arange(len(chromosomes) + 1))
+        intervals = cls.__new__(cls)
+        intervals._intervals = {}
+        for code, chrom in enumerate(chromosomes):
+            chrom_slice = slice(boundaries[code], boundaries[code + 1])
+            intervals._intervals[chrom] = (arrays['start'][chrom_slice],
+                                           arrays['end'][chrom_slice],
+                                           arrays['max_end'][chrom_slice])
+        return intervals
+
+    def overlaps(self, chromosomes, starts, ends):
+        """
+        Check which regions overlap at least one interval
+
+        Args:
+            chromosomes: Chromosome of each region
+            starts: 0-based start of each region
+            ends: End of each region
+
+        Returns:
+            numpy.array: True for each region that overlaps an interval
+        """
+        chromosomes = pd.Series(chromosomes).astype(str).values
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        # bedtools treats zero length regions as covering the
+        # bases on each side of the position
+        zero_length = starts == ends
+        starts = np.where(zero_length, starts - 1, starts)
+        ends = np.where(zero_length, ends + 1, ends)
+        overlap = np.zeros(len(starts), dtype=bool)
+        for chrom in np.unique(chromosomes):
+            if chrom not in self._intervals:
+                continue
+            interval_starts, _, max_ends = self._intervals[chrom]
+            in_chrom = chromosomes == chrom
+            # Number of intervals that start before the end of each region
+            before_end = np.searchsorted(interval_starts, ends[in_chrom],
+                                         side='left')
+            chrom_overlap = np.zeros(len(before_end), dtype=bool)
+            has_interval = before_end > 0
+            chrom_overlap[has_interval] = \
+                max_ends[before_end[has_interval] - 1] > \
+                starts[in_chrom][has_interval]
+            overlap[in_chrom] = chrom_overlap
+        return overlap
+
+
+def build_feature_store(gtf_path, store_dir):
+    """
+    Build the exon and gene feature store from a GTF
 
     Args:
-        dirname: Directory where these files should live
+        gtf_path: Path to GTF, can be gzipped
+        store_dir: Directory where the feature store should live
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    gtfdf = pd.read_csv(gtf_path, sep="\t", header=None,
+                        usecols=[0, 2, 3, 4], dtype={0: str, 2: str},
+                        quoting=csv.QUOTE_NONE, comment="#")
+    for feature_type in GTF_FEATURE_TYPES:
+        featuredf = gtfdf[gtfdf[2] == feature_type]
+        # GTF positions are 1-based and closed, so the start is shifted by
+        # one like bedtools does.
+        intervals = GenomicIntervals(featuredf[0], featuredf[3] - 1,
+                                     featuredf[4])
+        intervals.save(store_dir, feature_type)
+
+
+def create_feature_store(dirname, gtf_path=None):
+    """
+    Create the exon and gene feature store from the GRCh37 gtf once
+
+    Args:
+        dirname: Directory where the feature store should live
+        gtf_path: Local GTF to build the feature store from.
+                  Default is to download the Ensembl GRCh37 GTF.
+
+    Returns:
+        str: feature store directory
+    """
+    store_dir = os.path.join(dirname, "gtf_feature_store")
+    if not os.path.exists(store_dir):
+        if gtf_path is None:
+            download_cmd = ['wget', GRCH37_GTF_URL, '-P', dirname]
+            subprocess.check_call(download_cmd)
+            gtf_path = os.path.join(dirname, os.path.basename(GRCH37_GTF_URL))
+        # Build next to the store and move it in place at the end, so
+        # processes never load a partial store
+        temp_store_dir = tempfile.mkdtemp(dir=dirname)
+        build_feature_store(gtf_path, temp_store_dir)
+        try:
+            os.rename(temp_store_dir, store_dir)
+        except OSError:
+            # Another process created the store first
+            shutil.rmtree(temp_store_dir)
+    return store_dir
+
+
+def _perform_build_feature_store(syn, args):
+    """
+    Rebuild the feature store from a local GTF, used by the genie cli.
+    No Synapse login is needed.
+
+    Args:
+        syn: Synapse object, not used
+        args: argparse arguments with gtf_path and store_dir
+    """
+    store_dir = args.store_dir
+    if store_dir is None:
+        store_dir = os.path.join(process_functions.SCRIPT_DIR,
+                                 "gtf_feature_store")
+    LOGGER.info("BUILDING FEATURE STORE {} FROM {}".format(store_dir,
+                                                           args.gtf_path))
+    # Build next to the store and swap it in at the end, so a crash never
+    # leaves a partial store behind
+    store_dir = os.path.abspath(store_dir)
+    temp_store_dir = tempfile.mkdtemp(dir=os.path.dirname(store_dir))
+    try:
+        build_feature_store(args.gtf_path, temp_store_dir)
+        if os.path.isdir(store_dir):
+            old_store_dir = tempfile.mkdtemp(dir=os.path.dirname(store_dir))
+            os.replace(store_dir, os.path.join(old_store_dir, "store"))
+            os.replace(temp_store_dir, store_dir)
+            shutil.rmtree(old_store_dir)
+        else:
+            os.replace(temp_store_dir, store_dir)
+    except BaseException:
+        shutil.rmtree(temp_store_dir, ignore_errors=True)
+        raise
+
+
+@functools.lru_cache(maxsize=4)
+def _load_feature_store(store_dir, modified_time):
+    return (GenomicIntervals.load(store_dir, "exon"),
+            GenomicIntervals.load(store_dir, "gene"))
+
+
+def load_feature_store(store_dir):
+    """
+    Load the exon and gene features of a feature store once, reloading
+    only if the store is rebuilt
+
+    Args:
+        store_dir: Feature store directory
 
     Returns:
-        exon_gtf_path: exon GTF
-        gene_gtf_path: gene GTF
+        tuple: exon and gene GenomicIntervals
     """
-    exon_gtf_path = os.path.join(dirname, "exon.gtf")
-    gene_gtf_path = os.path.join(dirname, "gene.gtf")
-
-    if not os.path.exists(exon_gtf_path) or not os.path.exists(gene_gtf_path):
-        download_cmd = ['wget',
-                        'http://ftp.ensembl.org/pub/release-75/gtf/homo_sapiens/Homo_sapiens.GRCh37.75.gtf.gz',
-                        '-P', dirname]
-        subprocess.check_call(download_cmd)
-        gtfgz_path = os.path.join(dirname, "Homo_sapiens.GRCh37.75.gtf.gz")
-        gunzip_cmd = ['gunzip', '-f', gtfgz_path]
-        subprocess.check_call(gunzip_cmd)
-        gtf_path = os.path.join(dirname, "Homo_sapiens.GRCh37.75.gtf")
-
-        exon_awk_cmd = ['awk', '$3 == "exon" {print}', gtf_path]
-        exon_gtf = subprocess.check_output(
-            exon_awk_cmd, universal_newlines=True)
-        with open(exon_gtf_path, "w") as gtf_file:
-            gtf_file.write(exon_gtf)
-        gene_awk_cmd = ['awk', '$3 == "gene" {print}', gtf_path]
-        gene_gtf = subprocess.check_output(
-            gene_awk_cmd, universal_newlines=True)
-        with open(gene_gtf_path, "w") as gtf_file:
-            gtf_file.write(gene_gtf)
-    return(exon_gtf_path, gene_gtf_path)
-
-
-def _add_feature_type_tobeddf(filepath, featuretype):
+    return _load_feature_store(store_dir, os.path.getmtime(store_dir))
+
+
+def _add_feature_type_tobeddf(bed_lines, featuretype):
     """
     Add Feature_Type to dataframe
 
     Args:
-        filepath: path to bed
+        bed_lines: bed file lines
         featuretype: exon, intron, or intergenic
 
     Returns:
         df: empty dataframe or dataframe with appended feature type
     """
     # No need to add anything if the dataframe is empty
-    if os.stat(filepath).st_size != 0:
-        beddf = pd.read_csv(filepath, sep="\t", header=None)
+    if bed_lines:
+        beddf = pd.read_csv(io.StringIO("\n".join(bed_lines) + "\n"),
+                            sep="\t", header=None)
         beddf.columns = ["Chromosome", "Start_Position", "End_Position",
                          "Hugo_Symbol", "includeInPanel", "clinicalReported",
                          "ID", "SEQ_ASSAY_ID"]
@@ -116,65 +336,38 @@ def _add_feature_type_tobeddf(filepath, featuretype):
     return beddf
 
 
-def add_feature_type(temp_bed_path, exon_gtf_path, gene_gtf_path):
+def add_feature_type_to_text(bed_text, exons, genes):
     """
-    Add Feature_Type to bed file (exon, intron, intergenic)
+    Add Feature_Type to bed file content (exon, intron, intergenic).
+    Regions that overlap an exon are exons, regions that only overlap
+    a gene are introns and all other regions are intergenic.  Duplicated
+    regions are only kept once.
 
     Args:
-        temp_bed_path: BED file without feature type
-        exon_gtf_path: exon gtf
-        gene_gtf_path: gene gtf
+        bed_text: BED file content without feature type
+        exons: exon GenomicIntervals
+        genes: gene GenomicIntervals
 
     Returns:
-        genie_combined_path: Path to final bed file
+        pd.DataFrame: bed dataframe with feature type
     """
-    genie_exon_path = os.path.join(process_functions.SCRIPT_DIR,
-                                   'genie_exons.bed')
-    genie_intron_path = os.path.join(process_functions.SCRIPT_DIR,
-                                     'genie_introns.bed')
-    genie_intergenic_path = os.path.join(process_functions.SCRIPT_DIR,
-                                         'genie_intergenic.bed')
-    intron_intergenic_path = os.path.join(process_functions.SCRIPT_DIR,
-                                          'intron_intergenic.bed')
-    gene_path = os.path.join(process_functions.SCRIPT_DIR, 'gene.bed')
-    # GET EXON REGIONS
-    # Get intersection between true exon regions and submitted bed regions
-    command = ['bedtools', 'intersect', '-a',
-               temp_bed_path, '-b', exon_gtf_path, '-wa',
-               '|', 'sort', '|', 'uniq', '>', genie_exon_path]
-    subprocess.check_call(" ".join(command), shell=True)
-    # get intergenic/intron regions
-    # Get opposite of intersection between true exon regions and submitted
-    # bed regions
-    command = ['bedtools', 'intersect', '-a',
-               temp_bed_path, '-b', exon_gtf_path, '-wa', '-v'
-               '|', 'sort', '|', 'uniq', '>', intron_intergenic_path]
-    subprocess.check_call(" ".join(command), shell=True)
-    # get gene regions
-    # Get intersection between true gene regions and submitted bed regions
-    command = ['bedtools', 'intersect', '-a',
-               temp_bed_path, '-b', gene_gtf_path, '-wa',
-               '|', 'sort', '|', 'uniq', '>', gene_path]
-    subprocess.check_call(" ".join(command), shell=True)
-    # GET INTRON REGSIONS
-    # Difference between the gene regions and exon regions will give
-    # intron regions
-    command = ['diff', gene_path, genie_exon_path, '|',
-               'grep', "'<'", '|', 'sed', "'s/< //'", '>',
-               genie_intron_path]
-    subprocess.check_call(" ".join(command), shell=True)
-    # GET INTERGENIC REGIONS
-    # Difference between the intron/intergenic and intron regions will
-    # give intergenic regions
-    command = ['diff', intron_intergenic_path, genie_intron_path, '|',
-               'grep', "'<'", '|', 'sed', "'s/< //'", '>',
-               genie_intergenic_path]
-    subprocess.check_call(" ".join(command), shell=True)
-
-    genie_exondf = _add_feature_type_tobeddf(genie_exon_path, "exon")
-    genie_introndf = _add_feature_type_tobeddf(genie_intron_path, "intron")
-    genie_intergenicdf = _add_feature_type_tobeddf(genie_intergenic_path,
-                                                   "intergenic")
+    bed_lines = [line for line in bed_text.splitlines() if line]
+    regions = [line.split("\t", 3)[:3] for line in bed_lines]
+    regiondf = pd.DataFrame(regions,
+                            columns=['chrom', 'start', 'end'], dtype=str)
+    in_exon = exons.overlaps(regiondf['chrom'],
+                             regiondf['start'].astype(np.int64),
+                             regiondf['end'].astype(np.int64))
+    in_gene = genes.overlaps(regiondf['chrom'],
+                             regiondf['start'].astype(np.int64),
+                             regiondf['end'].astype(np.int64))
+    bed_lines = np.array(bed_lines, dtype=object)
+    genie_exondf = _add_feature_type_tobeddf(
+        sorted(set(bed_lines[in_exon])), "exon")
+    genie_introndf = _add_feature_type_tobeddf(
+        sorted(set(bed_lines[in_gene & ~in_exon])), "intron")
+    genie_intergenicdf = _add_feature_type_tobeddf(
+        sorted(set(bed_lines[~in_gene & ~in_exon])), "intergenic")
     # Specify the combined df in case there no bed hits at all
     genie_combineddf = pd.DataFrame(columns=["Chromosome", "Start_Position",
                                              "End_Position", "Hugo_Symbol",
@@ -188,108 +381,217 @@ def add_feature_type(temp_bed_path, exon_gtf_path, gene_gtf_path):
     return genie_combineddf
 
 
-def _check_region_overlap(row, gene_positiondf):
+class GenePositionIndex(object):
+    """
+    Gene positions (syn11806563) indexed by symbol and by chromosome, so
+    BED regions can be checked and remapped without filtering the whole
+    gene position dataframe for each region.  The genes of each chromosome
+    are kept in the order of the dataframe and sorted by start, end and
+    length to find the candidate genes with a binary search.
     """
-    Check if the submitted bed symbol + region overlaps with
-    the actual gene's positions
 
-    Args:
-        row: row in bed file (genomic region)
-        gene_positiondf: Reference gene position dataframe
+    def __init__(self, gene_positiondf):
+        """
+        Args:
+            gene_positiondf: Reference gene position dataframe
+        """
+        self._symbol_positions = {}
+        first_symbols = gene_positiondf.drop_duplicates('hgnc_symbol')
+        for symbol, start, end in zip(first_symbols['hgnc_symbol'],
+                                      first_symbols['start_position'],
+                                      first_symbols['end_position']):
+            if not pd.isnull(symbol):
+                self._symbol_positions[symbol] = (start, end)
+
+        positiondf = gene_positiondf.dropna(
+            subset=['start_position', 'end_position'])
+        self._chromosomes = {}
+        for chrom, chromdf in positiondf.groupby('chromosome_name',
+                                                  sort=False):
+            starts = chromdf['start_position'].values
+            ends = chromdf['end_position'].values
+            lengths = ends - starts
+            start_order = np.argsort(starts, kind='stable')
+            end_order = np.argsort(ends, kind='stable')
+            length_order = np.argsort(lengths, kind='stable')
+            # Smallest end of the genes starting at or after each gene
+            # in start order
+            min_ends_after = np.minimum.accumulate(
+                ends[start_order][::-1])[::-1]
+            self._chromosomes[chrom] = {
+                'symbols': chromdf['hgnc_symbol'].values,
+                'starts': starts,
+                'ends': ends,
+                'lengths': lengths,
+                'start_order': start_order,
+                'sorted_starts': starts[start_order],
+                'end_order': end_order,
+                'sorted_ends': ends[end_order],
+                'length_order': length_order,
+                'sorted_lengths': lengths[length_order],
+                'min_ends_after': min_ends_after,
+                'max_end': ends.max(),
+                'min_start': starts.min()}
+
+    def check_region_overlap(self, symbol, start, end):
+        """
+        Check if the submitted bed symbol + region overlaps with
+        the actual gene's positions
 
-    Return:
-        True if the region does overlap.
-    """
-    matching_symbol_ind = gene_positiondf['hgnc_symbol'] == row['Hugo_Symbol']
-    match_with_genedb = gene_positiondf[matching_symbol_ind]
+        Args:
+            symbol: Submitted gene symbol
+            start: Submitted start position
+            end: Submitted end position
 
-    if not match_with_genedb.empty:
+        Return:
+            True if the region does overlap.
+        """
+        position = self._symbol_positions.get(symbol)
+        if position is None:
+            return False
         # We are assuming that there is only one matching gene, but
         # there are actually duplicated gene symbols
-        start_position = match_with_genedb['start_position'].values[0]
-        end_position = match_with_genedb['end_position'].values[0]
+        start_position, end_position = position
         # Submitted bed start position in a gene
-        start_in_gene = start_position <= row['Start_Position'] <= end_position
+        start_in_gene = start_position <= start <= end_position
         # Submitted bed end position in a gene
-        end_in_gene = start_position <= row['End_Position'] <= end_position
+        end_in_gene = start_position <= end <= end_position
         # Submitted bed region surrounds a gene
-        gene_in_region = end_position <= row['End_Position'] and \
-                         start_position >= row['Start_Position']
+        gene_in_region = end_position <= end and start_position >= start
         return start_in_gene or end_in_gene or gene_in_region
-    return False
-
 
-def _get_max_overlap_index(overlap, bed_length, boundary):
-    """
-    Calculate the ratio of overlap between the submitted bed
-    region and gene position dataframe and return the index of
-    the max overlapping region
+    def check_regions_overlap(self, symbols, starts, ends):
+        """
+        Vectorized check_region_overlap
 
-    Args:
-        overlap: Possible overlapping region
-        bed_length: Length of submitted region
-        boundary: specified ratio overlap
+        Args:
+            symbols: Submitted gene symbols
+            starts: Submitted start positions
+            ends: Submitted end positions
 
-    Returns:
-        Index of regions with maximum overlap or None
-    """
-    ratio_overlap = overlap / bed_length
-    ratio_overlap = ratio_overlap[ratio_overlap > boundary]
-    ratio_overlap = ratio_overlap[ratio_overlap <= 1]
-    if not ratio_overlap.empty:
-        return ratio_overlap.idxmax()
-    return None
+        Return:
+            numpy.array: True for each region that overlaps its gene
+        """
+        symbols = pd.Series(symbols).reset_index(drop=True)
+        starts = np.asarray(starts)
+        ends = np.asarray(ends)
+        start_positions = symbols.map(
+            {symbol: position[0]
+             for symbol, position in self._symbol_positions.items()})
+        end_positions = symbols.map(
+            {symbol: position[1]
+             for symbol, position in self._symbol_positions.items()})
+        start_positions = start_positions.values.astype(float)
+        end_positions = end_positions.values.astype(float)
+        start_in_gene = (start_positions <= starts) & \
+            (starts <= end_positions)
+        end_in_gene = (start_positions <= ends) & (ends <= end_positions)
+        gene_in_region = (end_positions <= ends) & (start_positions >= starts)
+        return start_in_gene | end_in_gene | gene_in_region
+
+    @staticmethod
+    def _get_max_overlap_index(overlap, bed_length, boundary, candidates):
+        """
+        Calculate the ratio of overlap between the submitted bed
+        region and the candidate genes and return the index of
+        the first gene with the max overlap
 
+        Args:
+            overlap: Overlap of each candidate gene
+            bed_length: Length of submitted region
+            boundary: specified ratio overlap
+            candidates: Index of candidate genes in the chromosome
 
-def _map_position_within_boundary(row, positiondf, boundary=0.9):
-    """
-    Map positions and checks if posision is contained within the
-    specified percentage boundary
+        Returns:
+            Index of region with maximum overlap or None
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio_overlap = overlap / bed_length
+        in_boundary = (ratio_overlap > boundary) & (ratio_overlap <= 1)
+        if not in_boundary.any():
+            return None
+        ratio_overlap = ratio_overlap[in_boundary]
+        candidates = candidates[in_boundary]
+        return candidates[ratio_overlap == ratio_overlap.max()].min()
+
+    def map_position_within_boundary(self, chromosome, start, end,
+                                     boundary=0.9):
+        """
+        Map positions and checks if posision is contained within the
+        specified percentage boundary
 
-    Args:
-        row: Row in bed file (genomic region)
-        positiondf: Reference bed position dataframe
-        boundary: Percent boundary defined
+        Args:
+            chromosome: Chromosome of region
+            start: Start position of region
+            end: End position of region
+            boundary: Percent boundary defined
 
-    Return:
-        pd.Series: mapped position
-    """
-    # First filter just based on whether or not region is within the gene
-    # position dataframe
-    match_chr = positiondf['chromosome_name'] == str(row['Chromosome'])
-    chrom_rows = positiondf[match_chr]
-    match_start = chrom_rows['start_position'] <= row['Start_Position']
-    start_rows = chrom_rows[match_start]
-    end_rows = start_rows[start_rows['end_position'] >= row['End_Position']]
-
-    bed_length = row['End_Position'] - row['Start_Position']
-    # as long as the strand is within the boundary % defined
-    # Start goes over start boundary, but end is contained in position
-    if end_rows.empty:
-        if sum(chrom_rows['end_position'] >= row['End_Position']) > 0:
-            overlap = row['End_Position'] - chrom_rows['start_position']
-            # difference =  difference * -1.0
-            max_overlap = _get_max_overlap_index(overlap, bed_length,
-                                                 boundary)
-            if max_overlap is not None:
-                end_rows = end_rows.append(chrom_rows.loc[[max_overlap]])
+        Return:
+            list: mapped gene symbols
+        """
+        chrom = self._chromosomes.get(str(chromosome))
+        if chrom is None:
+            return []
+        # First filter just based on whether or not region is within the
+        # gene positions
+        start_before = chrom['start_order'][:np.searchsorted(
+            chrom['sorted_starts'], start, side='right')]
+        contained = np.sort(
+            start_before[chrom['ends'][start_before] >= end])
+        if contained.size:
+            return chrom['symbols'][contained].tolist()
+
+        bed_length = end - start
+        all_genes = np.arange(len(chrom['starts']))
+        # Genes outside of these windows have an overlap ratio that
+        # can't be within the boundary
+        use_windows = bed_length > 0 and boundary >= 0
+        overlap_indices = []
+        # as long as the strand is within the boundary % defined
+        # Start goes over start boundary, but end is contained in position
+        if chrom['max_end'] >= end:
+            if use_windows:
+                candidates = chrom['start_order'][
+                    np.searchsorted(chrom['sorted_starts'], start,
+                                    side='left'):
+                    np.searchsorted(chrom['sorted_starts'], end,
+                                    side='left')]
+            else:
+                candidates = all_genes
+            overlap = end - chrom['starts'][candidates]
+            overlap_indices.append(self._get_max_overlap_index(
+                overlap, bed_length, boundary, candidates))
         # End goes over end boundary, but start is contained in position
-        if sum(chrom_rows['start_position'] <= row['Start_Position']) > 0:
-            overlap = chrom_rows['end_position'] - row['Start_Position']
-            max_overlap = _get_max_overlap_index(overlap, bed_length,
-                                                 boundary)
-            if max_overlap is not None:
-                end_rows = end_rows.append(chrom_rows.loc[[max_overlap]])
+        if chrom['min_start'] <= start:
+            if use_windows:
+                candidates = chrom['end_order'][
+                    np.searchsorted(chrom['sorted_ends'], start,
+                                    side='right'):
+                    np.searchsorted(chrom['sorted_ends'], end,
+                                    side='right')]
+            else:
+                candidates = all_genes
+            overlap = chrom['ends'][candidates] - start
+            overlap_indices.append(self._get_max_overlap_index(
+                overlap, bed_length, boundary, candidates))
         # Start and end go over position boundary
-        check = chrom_rows[chrom_rows['start_position'] >= row['Start_Position']]
-        check = check[check['end_position'] <= row['End_Position']]
-        if not check.empty:
-            overlap = chrom_rows['end_position'] - chrom_rows['start_position']
-            max_overlap = _get_max_overlap_index(overlap, bed_length,
-                                                 boundary)
-            if max_overlap is not None:
-                end_rows = end_rows.append(chrom_rows.loc[[max_overlap]])
-    return end_rows
+        start_after = np.searchsorted(chrom['sorted_starts'], start,
+                                      side='left')
+        if start_after < len(all_genes) and \
+                chrom['min_ends_after'][start_after] <= end:
+            if use_windows:
+                candidates = chrom['length_order'][
+                    np.searchsorted(chrom['sorted_lengths'], 0,
+                                    side='right'):
+                    np.searchsorted(chrom['sorted_lengths'], bed_length,
+                                    side='right')]
+            else:
+                candidates = all_genes
+            overlap = chrom['lengths'][candidates]
+            overlap_indices.append(self._get_max_overlap_index(
+                overlap, bed_length, boundary, candidates))
+        return [chrom['symbols'][index] for index in overlap_indices
+                if index is not None]
 
 
 def remap_symbols(row, gene_positiondf):
@@ -299,23 +601,27 @@ def remap_symbols(row, gene_positiondf):
 
     Args:
         row: start and end position
-        gene_positiondf: Actual gene position dataframe
+        gene_positiondf: Actual gene position dataframe or GenePositionIndex
 
     Return:
         bool or Series: if the gene passed in need to be remapped or
                         the remapped gene
     """
-    region_overlap = _check_region_overlap(row, gene_positiondf)
+    if isinstance(gene_positiondf, GenePositionIndex):
+        gene_positions = gene_positiondf
+    else:
+        gene_positions = GenePositionIndex(gene_positiondf)
+    region_overlap = gene_positions.check_region_overlap(
+        row['Hugo_Symbol'], row['Start_Position'], row['End_Position'])
     if not region_overlap:
-        overlap_positions = _map_position_within_boundary(row,
-                                                          gene_positiondf)
-        if overlap_positions.empty:
+        symbol_list = gene_positions.map_position_within_boundary(
+            row['Chromosome'], row['Start_Position'], row['End_Position'])
+        if not symbol_list:
             LOGGER.warning("{} cannot be remapped. "
                            "These rows will have an empty gene symbol".format(
                                row['Hugo_Symbol']))
             row['Hugo_Symbol'] = float('nan')
-        elif len(overlap_positions) > 1:
-            symbol_list = overlap_positions['hgnc_symbol'].tolist()
+        elif len(symbol_list) > 1:
             if row['Hugo_Symbol'] not in symbol_list:
                 # if "MLL4", then the HUGO symbol should be KMT2D and KMT2B
                 LOGGER.warning("{} can be mapped to different symbols: {}. "
@@ -324,7 +630,7 @@ def remap_symbols(row, gene_positiondf):
                                    ", ".join(symbol_list)))
                 row['Hugo_Symbol'] = float('nan')
         else:
-            symbol = overlap_positions['hgnc_symbol'].values[0]
+            symbol = symbol_list[0]
             if row['Hugo_Symbol'] != symbol:
                 LOGGER.info("{} will be remapped to {}".format(
                     row['Hugo_Symbol'], symbol))
@@ -332,6 +638,331 @@ def remap_symbols(row, gene_positiondf):
     return row
 
 
+def remap_bed_symbols(beddf, gene_positions):
+    """
+    Remap the hugo symbols of the bed regions that don't overlap
+    their gene
+
+    Args:
+        beddf: bed dataframe
+        gene_positions: GenePositionIndex
+
+    Return:
+        pd.DataFrame: bed dataframe with remapped symbols
+    """
+    beddf = beddf.copy()
+    overlap = gene_positions.check_regions_overlap(
+        beddf['Hugo_Symbol'], beddf['Start_Position'], beddf['End_Position'])
+    to_remapdf = beddf[~overlap]
+    if not to_remapdf.empty:
+        remappeddf = to_remapdf.apply(
+            lambda row: remap_symbols(row, gene_positions), axis=1)
+        beddf.loc[~overlap, 'Hugo_Symbol'] = remappeddf['Hugo_Symbol']
+    return beddf
+
+
+class SharedGenePositions(object):
+    """
+    Gene position table and index shared by every bed file of a run.
+    Nothing is shared until load is called, bed files otherwise query
+    the gene position table themselves.
+    """
+
+    def __init__(self):
+        self.table = None
+        self.index = None
+        self._lock = threading.Lock()
+
+    def load(self, syn):
+        """
+        Query the gene position table and index it, only the first
+        call queries Synapse
+
+        Args:
+            syn: Synapse object
+
+        Returns:
+            GenePositionIndex
+        """
+        with self._lock:
+            if self.index is None:
+                self.table = syn.tableQuery(
+                    'SELECT * FROM {}'.format(GENE_POSITION_SYNID))
+                self.index = GenePositionIndex(self.table.asDataFrame())
+            return self.index
+
+    def clear(self):
+        """Stop sharing the gene positions"""
+        with self._lock:
+            self.table = None
+            self.index = None
+
+
+GENE_POSITIONS = SharedGenePositions()
+
+
+class SymbolResolver(object):
+    """
+    Hugo symbols of the bed database of a center.  Genes are valid if
+    they are Hugo symbols of the center's bed files, or are remapped to
+    the Hugo symbol of the first bed region with the gene as ID.
+    """
+
+    def __init__(self, beddf):
+        """
+        Args:
+            beddf: Bed database dataframe with Hugo_Symbol and ID columns
+        """
+        self.symbols = set(beddf['Hugo_Symbol'].dropna())
+        self.id_symbols = {}
+        for gene_id, symbol in zip(beddf['ID'], beddf['Hugo_Symbol']):
+            self.id_symbols.setdefault(gene_id, symbol)
+
+    @classmethod
+    def from_table(cls, syn, bed_synid, center):
+        """
+        Query the bed database rows of a center
+
+        Args:
+            syn: Synapse object
+            bed_synid: Synapse id of bed database
+            center: GENIE center
+
+        Returns:
+            SymbolResolver
+        """
+        bed_table = syn.tableQuery(
+            "select Hugo_Symbol, ID from {} where CENTER = '{}'".format(
+                bed_synid, center))
+        return cls(bed_table.asDataFrame())
+
+    def resolve(self, genes, keep_unmapped=False):
+        """
+        Map genes to the Hugo symbols of the bed files, each unique
+        gene is looked up once
+
+        Args:
+            genes: Series of gene names
+            keep_unmapped: Keep genes that can't be mapped instead of
+                           making them NaN. Default is False
+
+        Returns:
+            Series: Mapped gene names
+        """
+        mapping = {}
+        for gene in genes.dropna().unique():
+            if gene in self.symbols:
+                mapping[gene] = gene
+            elif gene in self.id_symbols:
+                LOGGER.info("{} will be remapped to {}".format(
+                    gene, self.id_symbols[gene]))
+                mapping[gene] = self.id_symbols[gene]
+            elif keep_unmapped:
+                mapping[gene] = gene
+            else:
+                LOGGER.warning(
+                    "{} cannot be remapped and will not be released. The "
+                    "symbol must exist in your seq assay ids (bed files) "
+                    "and must be mappable to a gene.".format(gene))
+        resolved = genes.map(mapping)
+        if keep_unmapped:
+            resolved = resolved.where(genes.notnull(), genes)
+        return resolved
+
+
+class SymbolResolverCache(object):
+    """
+    Symbol resolvers of the centers being validated and processed.  A
+    center's resolver is cleared when its bed database rows are updated
+    and when its run is done.
+    """
+
+    def __init__(self):
+        self._resolvers = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def get(self, syn, bed_synid, center):
+        """
+        Get the symbol resolver of a center, only the first call
+        queries the bed database
+
+        Args:
+            syn: Synapse object
+            bed_synid: Synapse id of bed database
+            center: GENIE center
+
+        Returns:
+            SymbolResolver
+        """
+        key = (bed_synid, center)
+        # Only calls for the same center wait on its query, the bed
+        # databases of other centers are queried at the same time
+        with self._key_lock(key):
+            with self._lock:
+                resolver = self._resolvers.get(key)
+            if resolver is None:
+                resolver = SymbolResolver.from_table(syn, bed_synid, center)
+                with self._lock:
+                    self._resolvers[key] = resolver
+            return resolver
+
+    def clear(self, center=None):
+        """
+        Remove cached resolvers
+
+        Args:
+            center: Only remove the resolvers of this center.
+                    Default is to remove all of them
+        """
+        with self._lock:
+            keys = [key for key in self._key_locks
+                    if center is None or key[1] == center]
+        for key in keys:
+            # Wait for a query in progress, so it can't store a resolver
+            # of the rows that are being replaced
+            with self._key_lock(key):
+                with self._lock:
+                    self._resolvers.pop(key, None)
+
+
+SYMBOL_RESOLVERS = SymbolResolverCache()
+
+
+class BedRemapCache(object):
+    """
+    On disk cache of remapped bed symbols.  Each entry is keyed on the md5
+    of the bed file and the etag of the gene position table and maps each
+    submitted region (chromosome, start, end, symbol) to its remapped
+    symbol.  The least recently used entries are removed once there are
+    more than max_entries entries.
+    """
+
+    def __init__(self, cache_dir, max_entries=None):
+        """
+        Args:
+            cache_dir: Cache directory
+            max_entries: Number of entries to keep.
+                         Default is BED_REMAP_CACHE_SIZE
+        """
+        self.cache_dir = cache_dir
+        self.max_entries = BED_REMAP_CACHE_SIZE if max_entries is None \
+            else max_entries
+
+    @classmethod
+    def for_synapse(cls, syn):
+        """
+        Cache in BED_REMAP_CACHE_DIR, or next to the files of the Synapse
+        client's cache
+
+        Args:
+            syn: Synapse object
+
+        Returns:
+            BedRemapCache
+        """
+        cache_dir = BED_REMAP_CACHE_DIR
+        if cache_dir is None:
+            cache_dir = os.path.join(syn.cache.cache_root_dir,
+                                     "bed_remap_cache")
+        return cls(cache_dir)
+
+    def _entry_path(self, bed_md5, gene_table_etag):
+        return os.path.join(self.cache_dir, "{}_{}.json".format(
+            bed_md5, gene_table_etag))
+
+    def get(self, bed_md5, gene_table_etag):
+        """
+        Get cached remapped symbols
+
+        Args:
+            bed_md5: md5 of bed file
+            gene_table_etag: etag of gene position table
+
+        Returns:
+            dict: region to remapped symbol, empty if nothing is cached
+        """
+        entry_path = self._entry_path(bed_md5, gene_table_etag)
+        try:
+            with open(entry_path, "r") as entry_file:
+                entry = json.load(entry_file)
+            # Mark the entry as recently used
+            os.utime(entry_path, None)
+        except (OSError, ValueError):
+            return {}
+        return {tuple(region): symbol for region, symbol in entry}
+
+    def put(self, bed_md5, gene_table_etag, remapped):
+        """
+        Cache remapped symbols
+
+        Args:
+            bed_md5: md5 of bed file
+            gene_table_etag: etag of gene position table
+            remapped: dict of region to remapped symbol
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entry = [[list(region), symbol] for region, symbol in
+                 remapped.items()]
+        # Write to a temporary file first so that concurrent runs never
+        # read a partial entry
+        temp_fd, temp_path = tempfile.mkstemp(dir=self.cache_dir,
+                                              suffix=".tmp")
+        with os.fdopen(temp_fd, "w") as entry_file:
+            json.dump(entry, entry_file)
+        os.replace(temp_path, self._entry_path(bed_md5, gene_table_etag))
+        self._evict()
+
+    def _evict(self):
+        entry_paths = [os.path.join(self.cache_dir, name)
+                       for name in os.listdir(self.cache_dir)
+                       if name.endswith(".json")]
+        if len(entry_paths) <= self.max_entries:
+            return
+        entry_paths.sort(key=os.path.getmtime)
+        for entry_path in entry_paths[:-self.max_entries]:
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
+
+
+def _normalize_regions(beddf):
+    """
+    Normalize the chromosomes and symbols of the bed regions the way they
+    are remapped, so validation and processing remap the same regions
+
+    Args:
+        beddf: bed dataframe
+
+    Returns:
+        pd.DataFrame: bed dataframe with normalized regions
+    """
+    beddf = beddf.copy()
+    # Gene symbols can be split by ; and _ and : and .
+    beddf['Hugo_Symbol'] = [
+        str(symbol).split(";")[0].split("_")[0].split(":")[0].split(".")[0]
+        for symbol in beddf['Hugo_Symbol']]
+    # Replace all chr with blank
+    beddf['Chromosome'] = [
+        str(chrom).replace("chr", "") for chrom in beddf['Chromosome']]
+    return beddf
+
+
+def _region_keys(beddf):
+    """Regions as json serializable (chromosome, start, end, symbol)"""
+    symbols = [None if pd.isnull(symbol) else symbol
+               for symbol in beddf['Hugo_Symbol']]
+    return [(str(chrom), int(start), int(end), symbol)
+            for chrom, start, end, symbol in zip(beddf['Chromosome'],
+                                                 beddf['Start_Position'],
+                                                 beddf['End_Position'],
+                                                 symbols)]
+
 
 class bed(FileTypeFormat):
     """GENIE bed format"""
@@ -347,6 +978,8 @@ class bed(FileTypeFormat):
             filePathList: List of files
         """
         filepath = filepathlist[0]
+        # Used to look up the remapped symbols of this bed file
+        self._bed_md5 = md5_for_file(filepath).hexdigest()
         try:
             beddf = pd.read_csv(filepath, sep="\t", header=None)
         except Exception:
@@ -361,6 +994,63 @@ class bed(FileTypeFormat):
                 "contain a comment/header line")
         return beddf
 
+    def _get_gene_positions(self):
+        """
+        Get the gene position index, the gene position table is only
+        queried once for validation and processing
+
+        Returns:
+            GenePositionIndex
+        """
+        if getattr(self, "_gene_positions", None) is None and \
+                GENE_POSITIONS.index is not None:
+            self._gene_position_table = GENE_POSITIONS.table
+            self._gene_positions = GENE_POSITIONS.index
+        if getattr(self, "_gene_positions", None) is None:
+            gene_position_table = self.syn.tableQuery(
+                'SELECT * FROM {}'.format(GENE_POSITION_SYNID))
+            self._gene_position_table = gene_position_table
+            self._gene_positions = GenePositionIndex(
+                gene_position_table.asDataFrame())
+        return self._gene_positions
+
+    def _remap_symbols(self, beddf):
+        """
+        Remap the bed symbols, reusing the symbols remapped by an earlier
+        validation or processing of the same bed file
+
+        Args:
+            beddf: bed dataframe
+
+        Returns:
+            pd.DataFrame: bed dataframe with remapped symbols
+        """
+        gene_positions = self._get_gene_positions()
+        bed_md5 = getattr(self, "_bed_md5", None)
+        if bed_md5 is None or beddf.empty:
+            return remap_bed_symbols(beddf, gene_positions)
+        gene_table_etag = self._gene_position_table.etag
+        cache = BedRemapCache.for_synapse(self.syn)
+        remapped = cache.get(bed_md5, gene_table_etag)
+        regions = _region_keys(beddf)
+        cached = np.array([region in remapped for region in regions])
+        beddf = beddf.copy()
+        if cached.any():
+            beddf.loc[cached, 'Hugo_Symbol'] = [
+                float('nan') if remapped[region] is None
+                else remapped[region]
+                for region, is_cached in zip(regions, cached) if is_cached]
+        if not cached.all():
+            to_remapdf = remap_bed_symbols(beddf[~cached], gene_positions)
+            beddf.loc[~cached, 'Hugo_Symbol'] = to_remapdf['Hugo_Symbol']
+            uncached_regions = [region for region, is_cached in
+                                zip(regions, cached) if not is_cached]
+            for region, symbol in zip(uncached_regions,
+                                      to_remapdf['Hugo_Symbol']):
+                remapped[region] = None if pd.isnull(symbol) else symbol
+            cache.put(bed_md5, gene_table_etag, remapped)
+        return beddf
+
     def _validateFilename(self, filepath):
         """
         Validates filename
@@ -446,35 +1136,22 @@ class bed(FileTypeFormat):
         # Must be .astype(bool) because `1, 0 in [True, False]`
         beddf[4] = beddf[4].astype(bool)
 
-        exon_gtf_path, gene_gtf_path = create_gtf(process_functions.SCRIPT_DIR)
+        feature_store = create_feature_store(process_functions.SCRIPT_DIR)
         LOGGER.info("REMAPPING {}".format(seq_assay_id))
         # bedname = seq_assay_id + ".bed"
         beddf.columns = ["Chromosome", "Start_Position", "End_Position",
                        "Hugo_Symbol", "includeInPanel", "clinicalReported"]
-        # Validate gene symbols
-        # Gene symbols can be split by ; and _ and : and .
-        beddf['Hugo_Symbol'] = [
-            i.split(";")[0].split("_")[0].split(":")[0].split(".")[0]
-            for i in beddf['Hugo_Symbol']]
-        # Replace all chr with blank
-        beddf['Chromosome'] = [
-            str(i).replace("chr", "") for i in beddf['Chromosome']]
+        beddf = _normalize_regions(beddf)
         # Change all start and end to int
         beddf['Start_Position'] = beddf['Start_Position'].apply(int)
         beddf['End_Position'] = beddf['End_Position'].apply(int)
 
-        gene_position_table = self.syn.tableQuery('SELECT * FROM syn11806563')
-        gene_positiondf = gene_position_table.asDataFrame()
         beddf['ID'] = beddf['Hugo_Symbol']
-        # The apply function of a DataFrame is called twice on the first
-        # row (known pandas behavior)
-        beddf = beddf.apply(lambda x: remap_symbols(x, gene_positiondf),
-                            axis=1)
+        beddf = self._remap_symbols(beddf)
         beddf['SEQ_ASSAY_ID'] = seq_assay_id
-        temp_bed_path = os.path.join(process_functions.SCRIPT_DIR, "temp.bed")
-        beddf.to_csv(temp_bed_path, sep="\t", index=False, header=None)
-        final_bed = add_feature_type(temp_bed_path, exon_gtf_path,
-                                     gene_gtf_path)
+        bed_text = beddf.to_csv(sep="\t", index=False, header=None)
+        exons, genes = load_feature_store(feature_store)
+        final_bed = add_feature_type_to_text(bed_text, exons, genes)
         final_bed['CENTER'] = self.center
         final_bed['Chromosome'] = final_bed['Chromosome'].astype(str)
         if create_panel:
@@ -516,6 +1193,8 @@ class bed(FileTypeFormat):
                                      seq_assay_id,
                                      filterByColumn="SEQ_ASSAY_ID",
                                      toDelete=True)
+        # Symbols are resolved against the updated bed database
+        SYMBOL_RESOLVERS.clear(self.center)
         final_beddf.to_csv(newPath, sep="\t", index=False)
         return newPath
 
@@ -562,9 +1241,7 @@ class bed(FileTypeFormat):
                 total_error += \
                     "BED file: You cannot submit any null symbols.\n"
             beddf = beddf[~beddf['Hugo_Symbol'].isnull()]
-            beddf["Hugo_Symbol"] = [str(hugo).split(";")[0]
-                                    .split("_")[0].split(":")[0]
-                                    for hugo in beddf["Hugo_Symbol"]]
+            beddf = _normalize_regions(beddf)
             if sum(beddf['Hugo_Symbol'] == "+") != 0 or \
                sum(beddf['Hugo_Symbol'] == "-") != 0:
                 total_error += ("BED file: Fourth column must be the "
@@ -580,11 +1257,7 @@ class bed(FileTypeFormat):
             total_error += error
 
             if to_validate_symbol:
-                gene_position_table = self.syn.tableQuery('SELECT * FROM syn11806563')
-                gene_positiondf = gene_position_table.asDataFrame()
-                # The apply function of a DataFrame is called twice on the first row (known
-                # pandas behavior)
-                beddf = beddf.apply(lambda x: remap_symbols(x, gene_positiondf), axis=1)
+                beddf = self._remap_symbols(beddf)
 
                 if any(beddf['Hugo_Symbol'].isnull()):
                     warning += ("BED file: "
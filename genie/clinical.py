@@ -2,6 +2,8 @@ import datetime
 import os
 import logging
 import subprocess
+import tempfile
+import time
 import yaml
 
 import pandas as pd
@@ -32,6 +34,175 @@ def remove_greaterthan_lessthan_str(col):
     return(col)
 
 
+class ColumnTransform(object):
+    '''
+    One step of the clinical normalization pipeline
+
+    Args:
+        column: Column that is written
+        transform: Name of the ClinicalNormalizer method that transforms
+                   the source column.  None to only fill in the default
+        source: Column that is transformed. Defaults to column
+        default: Value of the column if the source column doesn't exist.
+                 None to skip the step instead
+    '''
+    def __init__(self, column, transform, source=None, default=None):
+        self.column = column
+        self.transform = transform
+        self.source = column if source is None else source
+        self.default = default
+
+    @property
+    def name(self):
+        return "{}:{}".format(self.column, self.transform or "default")
+
+
+# Order matters, columns that don't exist are added in this order
+CLINICAL_TRANSFORMS = [
+    ColumnTransform("PATIENT_ID", "genie_id"),
+    ColumnTransform("PRIMARY_RACE", "race", default="Not Collected"),
+    ColumnTransform("SECONDARY_RACE", "race", default="Not Collected"),
+    ColumnTransform("TERTIARY_RACE", "race", default="Not Collected"),
+    ColumnTransform("ETHNICITY", "ethnicity", default="Not Collected"),
+    ColumnTransform("BIRTH_YEAR", "integer"),
+    ColumnTransform("SEX", "sex"),
+    ColumnTransform("SAMPLE_ID", "genie_id"),
+    ColumnTransform("AGE_AT_SEQ_REPORT", "integer"),
+    ColumnTransform("SEQ_ASSAY_ID", "seq_assay_id"),
+    # Uses the sample type codes, so this must happen before SAMPLE_TYPE
+    ColumnTransform("SAMPLE_TYPE_DETAILED", "sample_type_detailed",
+                    source="SAMPLE_TYPE"),
+    ColumnTransform("SAMPLE_TYPE", "sample_type"),
+    ColumnTransform("SEQ_DATE", "seq_date"),
+    ColumnTransform("SEQ_YEAR", "seq_year", source="SEQ_DATE"),
+    ColumnTransform("YEAR_CONTACT", "integer", default="Not Collected"),
+    ColumnTransform("YEAR_DEATH", "integer", default="Not Collected"),
+    ColumnTransform("INT_CONTACT", None, default="Not Collected"),
+    ColumnTransform("INT_DOD", None, default="Not Collected"),
+    ColumnTransform("DEAD", None, default="Not Collected")]
+
+
+class ClinicalNormalizer(object):
+    '''
+    Runs CLINICAL_TRANSFORMS over a clinical dataframe and strips the
+    spaces around every string afterwards.
+
+    Args:
+        center: GENIE center
+        sex_mapping: Sex mapping table
+        race_mapping: Race mapping table
+        ethnicity_mapping: Ethnicity mapping table
+        sample_type: Sample type mapping table
+        transforms: Pipeline steps. Defaults to CLINICAL_TRANSFORMS
+    '''
+    def __init__(self, center, sex_mapping, race_mapping,
+                 ethnicity_mapping, sample_type, transforms=None):
+        self.center = center
+        self.sex_mapper = process_functions.CodeMapper(sex_mapping)
+        self.race_mapper = process_functions.CodeMapper(race_mapping)
+        self.ethnicity_mapper = process_functions.CodeMapper(
+            ethnicity_mapping)
+        self.sample_type_mapper = process_functions.CodeMapper(sample_type)
+        self.transforms = CLINICAL_TRANSFORMS if transforms is None \
+            else transforms
+        self.timings = []
+
+    def genie_id(self, col):
+        return process_functions.format_genie_ids(col, self.center)
+
+    def race(self, col):
+        return self.race_mapper.map(col)
+
+    def ethnicity(self, col):
+        return self.ethnicity_mapper.map(col)
+
+    def sex(self, col):
+        return self.sex_mapper.map(col)
+
+    def integer(self, col):
+        return process_functions.coerce_int(col)
+
+    def seq_assay_id(self, col):
+        # standardize all SEQ_ASSAY_ID with uppercase
+        return col.str.replace('_', '-', regex=False).str.upper()
+
+    def sample_type(self, col):
+        return self.sample_type_mapper.map(col)
+
+    def sample_type_detailed(self, col):
+        return self.sample_type_mapper.map(col, useDescription=True)
+
+    def seq_date(self, col):
+        return col.str.title()
+
+    def seq_year(self, col):
+        years = col.astype(str).str.split("-").str[1]
+        return pd.to_numeric(years.where(col.astype(str) != "Release"))
+
+    @staticmethod
+    def strip(col):
+        if pd.api.types.infer_dtype(col, skipna=False) == "string":
+            return col.str.strip(" ")
+        is_str = col.map(lambda value: isinstance(value, str)).astype(bool)
+        if not is_str.any():
+            return col
+        stripped = col.copy()
+        stripped[is_str] = col[is_str].str.strip(" ")
+        return stripped
+
+    def _run_step(self, name, step, col):
+        '''
+        Run one step and time it.  Numeric columns and columns that only
+        have strings are transformed once per unique value, as most
+        clinical columns only have a handful of values.  Mixed columns are
+        transformed as is, because factorizing would treat 1, 1.0 and True
+        as one value.
+        '''
+        start = time.time()
+        result = None
+        if col.dtype.kind in 'biuf' or \
+                pd.api.types.infer_dtype(col, skipna=False) == "string":
+            codes, uniques = pd.factorize(col)
+            # Not worth it for id columns.  NA values have no unique value
+            if len(uniques) < len(col) / 2 and (codes >= 0).all():
+                result = step(pd.Series(uniques))
+                result = pd.Series(result.values.take(codes),
+                                   index=col.index, name=col.name)
+        if result is None:
+            result = step(col)
+        self.timings.append((name, time.time() - start))
+        return result
+
+    def normalize(self, clinicaldf):
+        '''
+        Normalize a clinical dataframe.  The time of every step is kept
+        in timings.
+
+        Args:
+            clinicaldf: Clinical dataframe with capitalized headers
+                        and no NA values
+
+        Returns:
+            dataframe: Normalized clinical dataframe
+        '''
+        clinicaldf = clinicaldf.copy()
+        self.timings = []
+        for transform in self.transforms:
+            if transform.source in clinicaldf:
+                if transform.transform is not None:
+                    clinicaldf[transform.column] = self._run_step(
+                        transform.name,
+                        getattr(self, transform.transform),
+                        clinicaldf[transform.source])
+            elif transform.default is not None:
+                clinicaldf[transform.column] = transform.default
+        # TRIM EVERY COLUMN
+        for col in clinicaldf.columns[clinicaldf.dtypes == object]:
+            clinicaldf[col] = self._run_step(
+                "{}:strip".format(col), self.strip, clinicaldf[col])
+        return(clinicaldf)
+
+
 class clinical(FileTypeFormat):
 
     _fileType = "clinical"
@@ -58,114 +229,44 @@ class clinical(FileTypeFormat):
 
     # PROCESSING
     # Update clinical file with the correct mappings
-    def update_clinical(self, x, sex_mapping,
+    def update_clinical(self, clinicaldf, sex_mapping,
                         race_mapping, ethnicity_mapping, sample_type):
-        # PATIENT ID
-        if x.get("PATIENT_ID") is not None:
-            x['PATIENT_ID'] = process_functions.checkGenieId(
-                x['PATIENT_ID'], self.center)
-        # RACE
-        if x.get('PRIMARY_RACE') is not None:
-            x['PRIMARY_RACE'] = process_functions.getCODE(
-                race_mapping, x['PRIMARY_RACE'])
-        else:
-            x['PRIMARY_RACE'] = "Not Collected"
-
-        if x.get('SECONDARY_RACE') is not None:
-            x['SECONDARY_RACE'] = process_functions.getCODE(
-                race_mapping, x['SECONDARY_RACE'])
-        else:
-            x['SECONDARY_RACE'] = "Not Collected"
-
-        if x.get('TERTIARY_RACE') is not None:
-            x['TERTIARY_RACE'] = process_functions.getCODE(
-                race_mapping, x['TERTIARY_RACE'])
-        else:
-            x['TERTIARY_RACE'] = "Not Collected"
-        # ETHNICITY
-        if x.get('ETHNICITY') is not None:
-            x['ETHNICITY'] = process_functions.getCODE(
-                ethnicity_mapping, x['ETHNICITY'])
-        else:
-            x['ETHNICITY'] = "Not Collected"
-        # BIRTH YEAR
-        if x.get("BIRTH_YEAR") is not None:
-            # BIRTH YEAR (Check if integer)
-            if process_functions.checkInt(x['BIRTH_YEAR']):
-                x['BIRTH_YEAR'] = int(x['BIRTH_YEAR'])
-        # SEX
-        if x.get("SEX") is not None:
-            x['SEX'] = process_functions.getCODE(sex_mapping, x['SEX'])
-        # TRIM EVERY COLUMN MAKE ALL DASHES
-        # SAMPLE ID
-        if x.get('SAMPLE_ID') is not None:
-            x['SAMPLE_ID'] = process_functions.checkGenieId(
-                x['SAMPLE_ID'], self.center)
-        # AGE AT SEQ REPORT
-        if x.get('AGE_AT_SEQ_REPORT') is not None:
-            if process_functions.checkInt(x['AGE_AT_SEQ_REPORT']):
-                x['AGE_AT_SEQ_REPORT'] = int(x['AGE_AT_SEQ_REPORT'])
-
-        # SEQ ASSAY ID
-        if x.get('SEQ_ASSAY_ID') is not None:
-            x['SEQ_ASSAY_ID'] = x['SEQ_ASSAY_ID'].replace('_', '-')
-            # standardize all SEQ_ASSAY_ID with uppercase
-            x['SEQ_ASSAY_ID'] = x['SEQ_ASSAY_ID'].upper()
-
-        # SAMPLE_TYPE
-        if x.get('SAMPLE_TYPE') is not None:
-            sampleType = x['SAMPLE_TYPE']
-            x['SAMPLE_TYPE'] = process_functions.getCODE(
-                sample_type, sampleType)
-            # Trim spaces
-            x['SAMPLE_TYPE_DETAILED'] = process_functions.getCODE(
-                sample_type, sampleType, useDescription=True)
-
-        if x.get('SEQ_DATE') is not None:
-            x['SEQ_DATE'] = x['SEQ_DATE'].title()
-            x['SEQ_YEAR'] = \
-                int(str(x['SEQ_DATE']).split("-")[1]) \
-                if str(x['SEQ_DATE']) != "Release" else float('nan')
-
-        if x.get('YEAR_CONTACT') is None:
-            x['YEAR_CONTACT'] = 'Not Collected'
-        else:
-            if process_functions.checkInt(x['YEAR_CONTACT']):
-                x['YEAR_CONTACT'] = int(x['YEAR_CONTACT'])
-
-        if x.get('YEAR_DEATH') is None:
-            x['YEAR_DEATH'] = 'Not Collected'
-        else:
-            if process_functions.checkInt(x['YEAR_DEATH']):
-                x['YEAR_DEATH'] = int(x['YEAR_DEATH'])
-
-        if x.get('INT_CONTACT') is None:
-            x['INT_CONTACT'] = 'Not Collected'
-
-        if x.get('INT_DOD') is None:
-            x['INT_DOD'] = 'Not Collected'
+        '''
+        Remap the clinical file column by column
 
-        if x.get('DEAD') is None:
-            x['DEAD'] = 'Not Collected'
+        Args:
+            clinicaldf: Clinical dataframe with capitalized headers
+                        and no NA values
+            sex_mapping: Sex mapping table
+            race_mapping: Race mapping table
+            ethnicity_mapping: Ethnicity mapping table
+            sample_type: Sample type mapping table
 
-        # TRIM EVERY COLUMN MAKE ALL DASHES
-        for i in x.keys():
-            if isinstance(x[i], str):
-                x[i] = x[i].strip(" ")
-        return(x)
+        Returns:
+            dataframe: Remapped clinical dataframe
+        '''
+        normalizer = ClinicalNormalizer(
+            self.center, sex_mapping, race_mapping,
+            ethnicity_mapping, sample_type)
+        clinicaldf = normalizer.normalize(clinicaldf)
+        logger.debug("Clinical normalization: " + ", ".join(
+            "{} {:.3f}s".format(name, seconds)
+            for name, seconds in normalizer.timings))
+        return(clinicaldf)
 
     def uploadMissingData(self, df, col, dbSynId, stagingSynId,
                           retractionSynId=None):
         samples = "','".join(df[col])
-        path = os.path.join(
-            process_functions.SCRIPT_DIR,
-            "{}_missing_{}.csv".format(self._fileType, col))
         missing = self.syn.tableQuery(
             "select {} from {} where CENTER='{}' and {} not in ('{}')".format(
                 col, dbSynId, self.center, col, samples))
-        missing.asDataFrame().to_csv(path, index=False)
-        self.syn.store(synapseclient.File(path, parent=stagingSynId))
-        os.remove(path)
+        # Centers can be processed at the same time, so each call
+        # writes to its own directory
+        with tempfile.TemporaryDirectory() as missing_dir:
+            path = os.path.join(
+                missing_dir, "{}_missing_{}.csv".format(self._fileType, col))
+            missing.asDataFrame().to_csv(path, index=False)
+            self.syn.store(synapseclient.File(path, parent=stagingSynId))
 
     def _process(self, clinical, clinicalTemplate):
         # Capitalize all clinical dataframe columns
@@ -185,9 +286,9 @@ class clinical(FileTypeFormat):
 
         # Attach MSK to centers
         # clinicalMerged = clinicalMerged.fillna("")
-        clinicalRemapped = clinical.apply(lambda x: self.update_clinical(
-            x, sex_mapping, race_mapping,
-            ethnicity_mapping, sampleType_mapping), 1)
+        clinicalRemapped = self.update_clinical(
+            clinical, sex_mapping, race_mapping,
+            ethnicity_mapping, sampleType_mapping)
         # Some columns may have been added during update,
         # remove unwanted columns again
         clinicalRemapped = clinicalRemapped.drop(clinicalRemapped.columns[
@@ -1,46 +1,44 @@
 import logging
 import os
 
+import numpy as np
 import pandas as pd
 import synapseclient
 
 from .example_filetype_format import FileTypeFormat
+from . import bed
 from . import process_functions
 
 logger = logging.getLogger(__name__)
 
+# CNA values are -2 to 2 in steps of 0.5 and are stored as int8 codes
+# of twice the value
+CNA_NAN_CODE = np.iinfo(np.int8).min
+CNA_CODES = np.arange(-4, 5, dtype=np.int8)
+CNA_TEXT = ["-2", "-1.5", "-1", "-0.5", "0", "0.5", "1", "1.5", "2"]
+# Codes of the CNA values when a column is read as text
+CNA_TEXT_CODES = dict(zip(CNA_TEXT, CNA_CODES.tolist()))
+CNA_TEXT_CODES.update({text + ".0": code
+                       for text, code in zip(CNA_TEXT, CNA_CODES.tolist())
+                       if "." not in text})
 
-def validateSymbol(gene, bedDf, returnMappedDf=True):
+
+def _cna_code_bytes():
+    '''
+    Tab and text of each code, indexed by the code as uint8 and padded
+    with zero bytes
     '''
-    Validate gene symbol
+    code_bytes = np.zeros((256, 5), dtype=np.uint8)
+    codes = np.append(CNA_CODES, CNA_NAN_CODE).astype(np.int8)
+    for code, text in zip(codes.view(np.uint8), CNA_TEXT + ["NA"]):
+        text_bytes = np.frombuffer(("\t" + text).encode(), dtype=np.uint8)
+        code_bytes[code, :len(text_bytes)] = text_bytes
+    return code_bytes
 
-    Args:
-        gene: Gene name
-        bedDf: Bed pandas dataframe
-        returnMappedDf: Return a mapped gene. Defaults to True
 
-    Returns:
-        gene name or boolean for whether a gene is valid
-    '''
-    valid = False
-    if sum(bedDf['Hugo_Symbol'] == gene) > 0:
-        valid = True
-    elif sum(bedDf['ID'] == gene) > 0:
-        mismatch = bedDf[bedDf['ID'] == gene]
-        mismatch.drop_duplicates(inplace=True)
-        logger.info("{} will be remapped to {}".format(
-            gene, mismatch['Hugo_Symbol'].values[0]))
-        gene = mismatch['Hugo_Symbol'].values[0]
-    else:
-        logger.warning(
-            "{} cannot be remapped and will not be released. The symbol "
-            "must exist in your seq assay ids (bed files) and must be "
-            "mappable to a gene.".format(gene))
-        gene = float('nan')
-    if returnMappedDf:
-        return(gene)
-    else:
-        return(valid)
+_CNA_CODE_BYTES = _cna_code_bytes()
+# Rows are formatted in chunks of at most this many bytes of text
+CNA_FORMAT_CHUNK_BYTES = 16 * 1024 * 1024
 
 
 def makeCNARow(row, symbols):
@@ -80,6 +78,266 @@ def checkIfOneZero(x):
     assert len(set(x.tolist())) == 1, "Can only be one unique value"
 
 
+def _encode_cna_array(values):
+    '''
+    Encode a float array of CNA values
+
+    Args:
+        values: float numpy array
+
+    Returns:
+        tuple: int8 codes, bool array of values that aren't CNA values
+    '''
+    doubled = values * 2
+    rounded = np.rint(doubled)
+    with np.errstate(invalid='ignore'):
+        valid = (doubled == rounded) & (np.abs(doubled) <= 4)
+    invalid = ~valid & ~np.isnan(values)
+    codes = np.where(valid, rounded, CNA_NAN_CODE).astype(np.int8)
+    return codes, invalid
+
+
+def encode_cna_values(valuesdf, block_size=1000):
+    '''
+    Encode the values of a CNA dataframe as int8 codes of twice the
+    value, missing values are CNA_NAN_CODE
+
+    Args:
+        valuesdf: Dataframe with only CNA value columns
+        block_size: Number of numeric columns converted at a time
+
+    Returns:
+        tuple: genes x samples int8 codes,
+               bool array of the columns that have values that
+               aren't CNA values
+    '''
+    codes = np.empty(valuesdf.shape, dtype=np.int8)
+    invalid_columns = np.zeros(valuesdf.shape[1], dtype=bool)
+    numeric = [pd.api.types.is_numeric_dtype(dtype) and
+               not pd.api.types.is_bool_dtype(dtype)
+               for dtype in valuesdf.dtypes]
+    numeric_columns = np.flatnonzero(numeric)
+    for start in range(0, len(numeric_columns), block_size):
+        columns = numeric_columns[start:start + block_size]
+        block_codes, invalid = _encode_cna_array(
+            valuesdf.iloc[:, columns].to_numpy(dtype=float))
+        codes[:, columns] = block_codes
+        invalid_columns[columns] = invalid.any(axis=0)
+    for column in np.flatnonzero(~np.array(numeric, dtype=bool)):
+        values = valuesdf.iloc[:, column]
+        if pd.api.types.is_bool_dtype(values.dtype):
+            # TRUE/FALSE are not CNA values
+            codes[:, column] = CNA_NAN_CODE
+            invalid_columns[column] = len(values) > 0
+            continue
+        # Text is matched as is, so values like +1 or 1e0 are invalid
+        text = values.where(values.isnull(), values.astype(str))
+        text_codes = text.map(CNA_TEXT_CODES)
+        codes[:, column] = text_codes.fillna(CNA_NAN_CODE).to_numpy(
+            dtype=np.int8)
+        invalid_columns[column] = \
+            (text_codes.isnull() & values.notnull()).any()
+    return codes, invalid_columns
+
+
+class CnaMatrix(object):
+    '''
+    Genes x samples CNA matrix stored as int8 codes of twice the CNA value,
+    an eighth of the memory of a float matrix.
+
+    Args:
+        symbols: Hugo symbols of the rows
+        samples: Sample ids of the columns
+        codes: genes x samples int8 codes, CNA_NAN_CODE for missing values
+    '''
+    def __init__(self, symbols, samples, codes):
+        self.symbols = pd.Index(symbols, dtype=object)
+        self.samples = list(samples)
+        self.codes = codes
+
+    @property
+    def empty(self):
+        return len(self.symbols) == 0
+
+    @classmethod
+    def from_dataframe(cls, cnadf):
+        '''
+        Create a CNA matrix from a dataframe
+
+        Args:
+            cnadf: CNA dataframe, the first column are the Hugo symbols
+
+        Returns:
+            CnaMatrix
+
+        Raises:
+            ValueError: The dataframe has values that aren't CNA values
+        '''
+        codes, invalid_columns = encode_cna_values(cnadf.iloc[:, 1:])
+        if invalid_columns.any():
+            raise ValueError("Samples with invalid CNA values: {}".format(
+                ", ".join(cnadf.columns[1:][invalid_columns])))
+        return cls(cnadf.iloc[:, 0].tolist(), cnadf.columns[1:], codes)
+
+    @classmethod
+    def read(cls, path, chunksize=5000):
+        '''
+        Read a cBioPortal CNA file.  The file is read in chunks of rows so
+        the float values of the whole file are never in memory.
+
+        Args:
+            path: Path to CNA file
+            chunksize: Number of rows read at a time
+
+        Returns:
+            CnaMatrix
+        '''
+        columns = pd.read_csv(path, sep="\t", nrows=0).columns
+        symbol_col = columns[0]
+        samples = [col for col in columns[1:]
+                   if col.upper() != "ENTREZ_GENE_ID"]
+        symbols = []
+        code_chunks = []
+        chunks = pd.read_csv(path, sep="\t", chunksize=chunksize,
+                             usecols=[symbol_col] + samples,
+                             converters={symbol_col: str})
+        for chunk in chunks:
+            chunk_matrix = cls.from_dataframe(chunk[[symbol_col] + samples])
+            symbols.extend(chunk_matrix.symbols)
+            code_chunks.append(chunk_matrix.codes)
+        if code_chunks:
+            codes = np.concatenate(code_chunks)
+        else:
+            codes = np.empty((0, len(samples)), dtype=np.int8)
+        return cls(symbols, samples, codes)
+
+    def to_dataframe(self):
+        '''
+        Returns:
+            pd.DataFrame: Hugo_Symbol and float sample columns
+        '''
+        values = np.where(self.codes == CNA_NAN_CODE, np.nan,
+                          self.codes / 2)
+        cnadf = pd.DataFrame(values, columns=self.samples)
+        cnadf.insert(0, "Hugo_Symbol", self.symbols)
+        return cnadf
+
+    def format_rows(self, chunk_bytes=CNA_FORMAT_CHUNK_BYTES):
+        '''
+        Format the values of each row as text, every value is preceded by
+        a tab and missing values are NA
+
+        Args:
+            chunk_bytes: Maximum size of the text of the rows formatted
+                         at a time
+
+        Yields:
+            str: Values of one row
+        '''
+        row_bytes = _CNA_CODE_BYTES.shape[1] * max(len(self.samples), 1)
+        chunk_rows = max(chunk_bytes // row_bytes, 1)
+        for start in range(0, self.codes.shape[0], chunk_rows):
+            chunk_codes = self.codes[start:start + chunk_rows]
+            code_bytes = _CNA_CODE_BYTES[chunk_codes.view(np.uint8)]
+            for row in code_bytes:
+                yield row.tobytes().replace(b"\0", b"").decode()
+
+    def write(self, path):
+        '''
+        Write the matrix as a cBioPortal CNA file
+
+        Args:
+            path: Path to CNA file
+        '''
+        with open(path, "w") as cna_file:
+            cna_file.write("\t".join(["Hugo_Symbol"] + self.samples) + "\n")
+            for symbol, row in zip(self.symbols, self.format_rows()):
+                cna_file.write(symbol + row + "\n")
+
+    def reindex(self, symbols):
+        '''
+        Align the matrix on symbols, keeping the first row of a
+        duplicated symbol.  Missing symbols get missing values.
+
+        Args:
+            symbols: Hugo symbols
+
+        Returns:
+            CnaMatrix
+        '''
+        first = ~self.symbols.duplicated()
+        rows = self.symbols[first].get_indexer(symbols)
+        codes = np.full((len(rows), len(self.samples)), CNA_NAN_CODE,
+                        dtype=np.int8)
+        codes[rows != -1] = self.codes[first][rows[rows != -1]]
+        return CnaMatrix(symbols, self.samples, codes)
+
+    def select_samples(self, samples):
+        '''
+        Keep the samples that are in samples, in the order of the matrix
+
+        Args:
+            samples: Collection of sample ids to keep
+
+        Returns:
+            CnaMatrix
+        '''
+        samples = set(samples)
+        keep = [sample in samples for sample in self.samples]
+        return CnaMatrix(self.symbols,
+                         [sample for sample in self.samples
+                          if sample in samples],
+                         self.codes[:, keep])
+
+    def drop_missing_symbols(self):
+        '''Remove rows without a Hugo symbol'''
+        keep = self.symbols.notnull()
+        return CnaMatrix(self.symbols[keep], self.samples, self.codes[keep])
+
+    def merge_duplicates(self):
+        '''
+        Merge the rows of duplicated symbols like mergeCNAvalues: the
+        value of a sample is its only value, or its only non-zero value
+        next to zeros, otherwise missing.  The merged rows come after
+        the other rows, in the order the symbols are first duplicated.
+
+        Returns:
+            CnaMatrix
+        '''
+        duplicated = self.symbols.duplicated(keep=False)
+        if not duplicated.any():
+            return self
+        merged_symbols = self.symbols[self.symbols.duplicated()].unique()
+        groups = merged_symbols.get_indexer(self.symbols[duplicated])
+        order = np.argsort(groups, kind="stable")
+        dup_codes = self.codes[duplicated][order]
+        starts = np.flatnonzero(np.r_[True, np.diff(groups[order]) != 0])
+
+        n_values = np.zeros((len(merged_symbols), len(self.samples)),
+                            dtype=np.int8)
+        n_nonzero = np.zeros_like(n_values)
+        nonzero_value = np.zeros_like(n_values)
+        has_zero = None
+        for code in CNA_CODES:
+            present = np.logical_or.reduceat(dup_codes == code, starts,
+                                             axis=0)
+            n_values += present
+            if code == 0:
+                has_zero = present
+            else:
+                n_nonzero += present
+                nonzero_value[present] = code
+        merged_codes = np.full(n_values.shape, CNA_NAN_CODE, dtype=np.int8)
+        merged_codes[(n_values == 1) & has_zero] = 0
+        single_nonzero = (n_nonzero == 1) & \
+            ((n_values == 1) | ((n_values == 2) & has_zero))
+        merged_codes[single_nonzero] = nonzero_value[single_nonzero]
+        return CnaMatrix(
+            self.symbols[~duplicated].append(merged_symbols),
+            self.samples,
+            np.concatenate([self.codes[~duplicated], merged_codes]))
+
+
 class cna(FileTypeFormat):
 
     _fileType = "cna"
@@ -93,7 +351,18 @@ class cna(FileTypeFormat):
         assert os.path.basename(filePath[0]) == \
             "data_CNA_{}.txt".format(self.center)
 
-    def _process(self, cnaDf, databaseToSynIdMappingDf):
+    def _process_matrix(self, cnaDf, databaseToSynIdMappingDf):
+        '''
+        Remap the symbols, merge the duplicated genes and rename
+        the samples
+
+        Args:
+            cnaDf: CNA dataframe
+            databaseToSynIdMappingDf: Database to synapse id mapping
+
+        Returns:
+            CnaMatrix
+        '''
         cnaDf.rename(columns={
             cnaDf.columns[0]: cnaDf.columns[0].upper()}, inplace=True)
         cnaDf.rename(columns={
@@ -106,48 +375,28 @@ class cna(FileTypeFormat):
 
         bedSynId = databaseToSynIdMappingDf.Id[
             databaseToSynIdMappingDf['Database'] == "bed"][0]
-        bed = self.syn.tableQuery(
-            "select Hugo_Symbol, ID from {} where CENTER = '{}'" .format(
-                bedSynId, self.center))
-        bedDf = bed.asDataFrame()
-        cnaDf['Hugo_Symbol'] = \
-            cnaDf['Hugo_Symbol'].apply(lambda x: validateSymbol(x, bedDf))
-        order = cnaDf.columns
-        cnaDf = cnaDf[~cnaDf['Hugo_Symbol'].isnull()]
-        # cnaDf = cnaDf.applymap(str)
-        duplicatedGenes = pd.DataFrame()
-        duplicated_symbols = cnaDf['Hugo_Symbol'][
-            cnaDf['Hugo_Symbol'].duplicated()].unique()
-        for i in duplicated_symbols:
-            dups = cnaDf[cnaDf['Hugo_Symbol'] == i]
-            newVal = dups[dups.columns[dups.columns != "Hugo_Symbol"]].apply(
-                mergeCNAvalues)
-            temp = pd.DataFrame(newVal).transpose()
-            temp['Hugo_Symbol'] = i
-            duplicatedGenes = duplicatedGenes.append(temp, sort=False)
-        cnaDf.drop_duplicates('Hugo_Symbol', keep=False, inplace=True)
-        cnaDf = cnaDf.append(duplicatedGenes, sort=False)
-        cnaDf = cnaDf[order]
-        cnaDf.columns = [
-            process_functions.checkGenieId(i, self.center)
-            if i != "Hugo_Symbol" else i for i in cnaDf.columns]
-
-        return(cnaDf)
+        resolver = bed.SYMBOL_RESOLVERS.get(self.syn, bedSynId, self.center)
+        cnaDf['Hugo_Symbol'] = resolver.resolve(cnaDf['Hugo_Symbol'])
+        order = ["Hugo_Symbol"] + [col for col in cnaDf.columns
+                                   if col != "Hugo_Symbol"]
+        cna_matrix = CnaMatrix.from_dataframe(cnaDf[order])
+        cna_matrix = cna_matrix.drop_missing_symbols().merge_duplicates()
+        cna_matrix.samples = [
+            process_functions.checkGenieId(sample, self.center)
+            for sample in cna_matrix.samples]
+        return(cna_matrix)
+
+    def _process(self, cnaDf, databaseToSynIdMappingDf):
+        cna_matrix = self._process_matrix(cnaDf, databaseToSynIdMappingDf)
+        return(cna_matrix.to_dataframe())
 
     def process_steps(self, cnaDf, newPath, databaseToSynIdMappingDf):
-        newCNA = self._process(cnaDf, databaseToSynIdMappingDf)
+        cna_matrix = self._process_matrix(cnaDf, databaseToSynIdMappingDf)
 
         centerMafSynId = databaseToSynIdMappingDf.Id[
             databaseToSynIdMappingDf['Database'] == "centerMaf"][0]
-        if not newCNA.empty:
-            cnaText = process_functions.removePandasDfFloat(newCNA)
-            # Replace blank with NA's
-            cnaText = cnaText.replace(
-                "\t\t", "\tNA\t").replace(
-                "\t\t", "\tNA\t").replace(
-                '\t\n', "\tNA\n")
-            with open(newPath, "w") as cnaFile:
-                cnaFile.write(cnaText)
+        if not cna_matrix.empty:
+            cna_matrix.write(newPath)
             self.syn.store(synapseclient.File(newPath, parent=centerMafSynId))
         return(newPath)
 
@@ -169,11 +418,8 @@ class cna(FileTypeFormat):
         if process_functions.checkColExist(cnvDF, "ENTREZ_GENE_ID"):
             del cnvDF['ENTREZ_GENE_ID']
 
-        # cnvDF = cnvDF.fillna('')
-        allowed_values = ['-2.0', '-2', '-1.5', '-1.0', '-1',
-                          '0.0', '0', '0.5', '1.0', '1', '1.5',
-                          '2', '2.0', 'nan']
-        if not all(cnvDF.applymap(lambda x: str(x) in allowed_values).all()):
+        _, invalid_columns = encode_cna_values(cnvDF)
+        if invalid_columns.any():
             total_error += (
                 "All values must be NA/blank, -2, -1.5, -1, -0.5, "
                 "0, 0.5, 1, 1.5, or 2.\n")
@@ -183,12 +429,9 @@ class cna(FileTypeFormat):
                 databaseToSynIdMappingDf = process_functions.get_synid_database_mappingdf(self.syn, project_id)
                 bedSynId = process_functions.getDatabaseSynId(self.syn, "bed",
                                                               databaseToSynIdMappingDf=databaseToSynIdMappingDf)
-                bed = self.syn.tableQuery(
-                    "select Hugo_Symbol, ID from {} where "
-                    "CENTER = '{}'".format(bedSynId, self.center))
-                bedDf = bed.asDataFrame()
-                cnvDF['remapped'] = cnvDF['HUGO_SYMBOL'].apply(
-                    lambda x: validateSymbol(x, bedDf))
+                resolver = bed.SYMBOL_RESOLVERS.get(
+                    self.syn, bedSynId, self.center)
+                cnvDF['remapped'] = resolver.resolve(cnvDF['HUGO_SYMBOL'])
                 cnvDF = cnvDF[~cnvDF['remapped'].isnull()]
 
                 # Do not allow any duplicated genes after symbols
@@ -130,9 +130,9 @@ def consortiumToPublic(syn, processingDate, genie_version, releaseId, databaseSy
             sampleCols = ["PATIENT_ID"]
             sampleCols.extend(publicRelease['fieldName'][publicRelease['level'] == "sample"].tolist())
             #clinicalDf is defined on line 36
-            # clinicalDf['AGE_AT_SEQ_REPORT'] = [int(math.floor(int(float(i))/365.25)) if process.checkInt(i) else i for i in clinicalDf['AGE_AT_SEQ_REPORT']]
-            # clinicalDf['AGE_AT_SEQ_REPORT'][clinicalDf['AGE_AT_SEQ_REPORT'] == ">32485"] = ">89"
-            # clinicalDf['AGE_AT_SEQ_REPORT'][clinicalDf['AGE_AT_SEQ_REPORT'] == "<6570"] = "<18"
+            # The consortium clinical file is already annotated by
+            # database_to_staging.annotate_oncotree, so AGE_AT_SEQ_REPORT
+            # is in years and the cancer types are filled in
 
             clinicalDf = clinicalDf[clinicalDf['SAMPLE_ID'].isin(publicReleaseSamples)]
 
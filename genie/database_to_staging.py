@@ -2,18 +2,25 @@
 '''
 Functions for releasing GENIE consortium releases
 '''
+import concurrent.futures
+import contextlib
+import copy
+import csv
 import logging
-import math
 import os
 import re
+import shutil
 import subprocess
+import tempfile
 import time
 
+import numpy as np
 import pandas as pd
 import synapseclient
 import synapseutils
 
 from . import process_functions
+from .cna import CnaMatrix
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -35,6 +42,12 @@ FUSIONS_CENTER_PATH = os.path.join(GENIE_RELEASE_DIR, 'data_fusions_%s.txt')
 SEG_CENTER_PATH = os.path.join(GENIE_RELEASE_DIR,
                                'genie_data_cna_hg19_%s.seg')
 BED_DIFFS_SEQASSAY_PATH = os.path.join(GENIE_RELEASE_DIR, 'diff_%s.csv')
+# Buffer size of each release maf file handle
+MAF_WRITE_BUFFER = 1024 * 1024
+# Number of seg table rows queried at a time
+SEG_PAGE_SIZE = 1000000
+SEG_COLUMNS = ['ID', 'chrom', 'loc.start', 'loc.end', 'num.mark',
+               'seg.mean']
 
 
 def find_caselistid(syn, parentid):
@@ -189,55 +202,100 @@ def redact_phi(clinicaldf, interval_cols_to_redact=['AGE_AT_SEQ_REPORT',
     return clinicaldf
 
 
-def configure_maf_row(row_array, headers, keep_samples, remove_variants,
-                      flagged_variants):
-    """Configures each maf row, does germline filtering
+class MafRowFilter(object):
+    """Sample and variant filters applied to each release maf row.
 
-    Args:
-        rowArray: Each maf row
-        headers: maf Headers
-        keepSamples: Samples to keep
-        remove_variants: Variants to remove
-        flagged_variants: Variants to flag
-
-    Returns:
-        configured maf row
+    The keep, remove and flag keys are stored as frozensets and the
+    column positions are looked up once per maf file with `with_headers`,
+    so configuring a row only does constant time lookups.
     """
-    chrom = str(row_array[headers.index('Chromosome')])
-    start = str(row_array[headers.index('Start_Position')])
-    end = str(row_array[headers.index('End_Position')])
-    ref = str(row_array[headers.index('Reference_Allele')])
-    seq = str(row_array[headers.index('Tumor_Seq_Allele2')])
-    sampleid = str(row_array[headers.index('Tumor_Sample_Barcode')])
-    hgvsp = str(row_array[headers.index('HGVSp_Short')])
-    filter_info = str(row_array[headers.index('FILTER')])
-    variant = '{} {} {} {} {} {}'.format(chrom, start, end,
-                                         ref, seq, sampleid)
-    # Add this line for now because merge check uses
-    # different primary key from maf
-    mergecheck_variant = '{} {} {} {} {} {}'.format(chrom, start, hgvsp,
-                                                    ref, seq, sampleid)
-    # if pd.Series(sampleId).isin(keepSamples).any() and \
-    # not pd.Series(variant).isin(remove_variants).any():
-    if sampleid in keep_samples.tolist() \
-            and variant not in remove_variants.tolist() \
-            and "common_variant" not in filter_info: # germline filtering
-        fillnas = ['t_depth', 't_ref_count', 't_alt_count',
+
+    FILLNA_COLS = ['t_depth', 't_ref_count', 't_alt_count',
                    'n_depth', 'n_ref_count', 'n_alt_count']
-        for i in fillnas:
-            # mutationsDf[i] = mutationsDf[i].fillna("NA")
-            # mutationsDf[i] = ["NA" if str(each) == "." else each
-            #                    for each in  mutationsDf[i]]
-            value = row_array[headers.index(i)]
-            row_array[headers.index(i)] = "" if str(value) == "." else value
-
-        n_depth = row_array[headers.index("n_depth")]
-        row_array[headers.index("Match_Norm_Seq_Allele2")] = \
-            '' if str(n_depth) in ["NA", "0.0"] else n_depth
-        row_array[headers.index("Match_Norm_Seq_Allele1")] = \
-            '' if str(n_depth) in ["NA", "0.0"] else n_depth
-        # row_array.pop(headers.index('inBED'))
-        if mergecheck_variant in flagged_variants.tolist():
+
+    def __init__(self, keep_for_merged_consortium_samples,
+                 keep_for_center_consortium_samples,
+                 remove_mafinbed_variants,
+                 flagged_mutationInCis_variants):
+        """
+        Args:
+            keep_for_merged_consortium_samples: Samples to keep for merged
+                                                file
+            keep_for_center_consortium_samples: Samples to keep for center
+                                                files
+            remove_mafinbed_variants: Variants to remove
+            flagged_mutationInCis_variants: Variants to flag
+        """
+        self.keep_merged_samples = frozenset(
+            keep_for_merged_consortium_samples)
+        self.keep_center_samples = frozenset(
+            keep_for_center_consortium_samples)
+        self.remove_variants = frozenset(remove_mafinbed_variants)
+        self.flagged_variants = frozenset(flagged_mutationInCis_variants)
+        self.headers = None
+
+    def with_headers(self, headers):
+        """Returns a copy of the filter with the column positions of a maf
+        file.  The filter sets are shared, not copied.
+
+        Args:
+            headers: maf Headers
+
+        Returns:
+            MafRowFilter
+        """
+        row_filter = copy.copy(self)
+        row_filter.headers = headers
+        index = headers.index
+        row_filter.center_idx = index('Center')
+        row_filter.chrom_idx = index('Chromosome')
+        row_filter.start_idx = index('Start_Position')
+        row_filter.end_idx = index('End_Position')
+        row_filter.ref_idx = index('Reference_Allele')
+        row_filter.seq_idx = index('Tumor_Seq_Allele2')
+        row_filter.sample_idx = index('Tumor_Sample_Barcode')
+        row_filter.hgvsp_idx = index('HGVSp_Short')
+        row_filter.filter_idx = index('FILTER')
+        row_filter.fillna_idx = [index(col) for col in self.FILLNA_COLS]
+        row_filter.n_depth_idx = index('n_depth')
+        row_filter.norm_allele2_idx = index('Match_Norm_Seq_Allele2')
+        row_filter.norm_allele1_idx = index('Match_Norm_Seq_Allele1')
+        return row_filter
+
+    def configure_row(self, row_array):
+        """Configures a maf row that passed the sample filter, does
+        germline filtering.  The row is only configured once, so that the
+        same text can be written to both the merged and the center release
+        files.
+
+        Args:
+            row_array: Each maf row
+
+        Returns:
+            configured maf row or None if the variant is filtered
+        """
+        chrom = str(row_array[self.chrom_idx])
+        start = str(row_array[self.start_idx])
+        ref = str(row_array[self.ref_idx])
+        seq = str(row_array[self.seq_idx])
+        sampleid = str(row_array[self.sample_idx])
+        variant = '{} {} {} {} {} {}'.format(
+            chrom, start, row_array[self.end_idx], ref, seq, sampleid)
+        if variant in self.remove_variants or \
+                "common_variant" in str(row_array[self.filter_idx]):
+            return None
+        for i in self.fillna_idx:
+            if str(row_array[i]) == ".":
+                row_array[i] = ""
+        n_depth = row_array[self.n_depth_idx]
+        norm_allele = '' if str(n_depth) in ["NA", "0.0"] else n_depth
+        row_array[self.norm_allele2_idx] = norm_allele
+        row_array[self.norm_allele1_idx] = norm_allele
+        # Add this line for now because merge check uses
+        # different primary key from maf
+        mergecheck_variant = '{} {} {} {} {} {}'.format(
+            chrom, start, row_array[self.hgvsp_idx], ref, seq, sampleid)
+        if mergecheck_variant in self.flagged_variants:
             row_array.append('True')
         else:
             row_array.append('')
@@ -245,8 +303,235 @@ def configure_maf_row(row_array, headers, keep_samples, remove_variants,
         new_row += "\n"
         new_row = process_functions.removeStringFloat(new_row)
         return new_row
+
+    def write_rows(self, maf_file, writer):
+        """Filters and configures each row of a center maf file once and
+        writes the row to the merged and center release files
+
+        Args:
+            maf_file: Open center maf file positioned after the header
+            writer: MafReleaseWriter
+        """
+        keep_merged_samples = self.keep_merged_samples
+        keep_center_samples = self.keep_center_samples
+        for row in maf_file:
+            row_array = row.replace("\n", "").split("\t")
+            sampleid = row_array[self.sample_idx]
+            to_merged = sampleid in keep_merged_samples
+            to_center = sampleid in keep_center_samples
+            if not to_merged and not to_center:
+                continue
+            center = row_array[self.center_idx]
+            new_row = self.configure_row(row_array)
+            if new_row is None:
+                continue
+            if to_merged:
+                writer.write_merged(new_row)
+            if to_center:
+                writer.write_center(center, new_row)
+
+    def _variant_keys(self, chunk, position_col):
+        return chunk['Chromosome'].str.cat(
+            [chunk['Start_Position'], chunk[position_col],
+             chunk['Reference_Allele'], chunk['Tumor_Seq_Allele2'],
+             chunk['Tumor_Sample_Barcode']], sep=" ")
+
+    def configure_chunk(self, chunk):
+        """Vectorized version of configure_row for a chunk of maf rows that
+        passed the sample filter
+
+        Args:
+            chunk: maf dataframe with all values as strings
+
+        Returns:
+            Series of configured maf rows, variants that are filtered out
+            are dropped
+        """
+        variants = self._variant_keys(chunk, 'End_Position')
+        keep = ~variants.isin(self.remove_variants) & \
+            ~chunk['FILTER'].str.contains("common_variant", regex=False)
+        chunk = chunk[keep].copy()
+        mergecheck_variants = self._variant_keys(chunk, 'HGVSp_Short')
+        flags = mergecheck_variants.isin(self.flagged_variants).map(
+            {True: 'True', False: ''})
+        for col in self.FILLNA_COLS:
+            chunk.loc[chunk[col] == ".", col] = ""
+        n_depth = chunk['n_depth'].where(
+            ~chunk['n_depth'].isin(["NA", "0.0"]), "")
+        chunk['Match_Norm_Seq_Allele2'] = n_depth
+        chunk['Match_Norm_Seq_Allele1'] = n_depth
+        columns = [chunk[col] for col in chunk.columns[1:]]
+        new_rows = chunk.iloc[:, 0].str.cat(columns + [flags], sep="\t")
+        new_rows += "\n"
+        # Same replacements as removeStringFloat
+        new_rows = new_rows.str.replace(".0\t", "\t", regex=False)
+        new_rows = new_rows.str.replace(".0\n", "\n", regex=False)
+        return new_rows
+
+    def write_chunks(self, maf_file, writer, chunksize):
+        """Same as write_rows, but reads the center maf file with pandas
+        and filters chunksize rows at a time
+
+        Args:
+            maf_file: Open center maf file positioned after the header
+            writer: MafReleaseWriter
+            chunksize: Number of maf rows to read at a time
+        """
+        keep_merged_samples = list(self.keep_merged_samples)
+        keep_center_samples = list(self.keep_center_samples)
+        mafdf_chunks = pd.read_csv(maf_file, sep="\t", header=None,
+                                   names=self.headers[:-1], dtype=str,
+                                   na_filter=False,
+                                   quoting=csv.QUOTE_NONE,
+                                   chunksize=chunksize)
+        for chunk in mafdf_chunks:
+            to_merged = chunk['Tumor_Sample_Barcode'].isin(
+                keep_merged_samples)
+            to_center = chunk['Tumor_Sample_Barcode'].isin(
+                keep_center_samples)
+            chunk = chunk[to_merged | to_center]
+            if chunk.empty:
+                continue
+            new_rows = self.configure_chunk(chunk)
+            to_merged = to_merged[new_rows.index]
+            to_center = to_center[new_rows.index]
+            writer.write_merged("".join(new_rows[to_merged]))
+            center_rows = new_rows[to_center]
+            centers = chunk['Center'][center_rows.index]
+            for center, rows in center_rows.groupby(centers, sort=False):
+                writer.write_center(center, "".join(rows))
+
+
+class MafReleaseWriter(object):
+    """Writes the merged and center release maf (or seg) files.
+
+    One buffered handle is kept open per output file for the lifetime of
+    the writer instead of reopening the files in append mode for each row.
+    Center files are created on first use, unless they are passed in
+    when the writer is created.
+    """
+
+    def __init__(self, merged_path, center_path, centers=(),
+                 buffering=MAF_WRITE_BUFFER):
+        """
+        Args:
+            merged_path: Path to merged release maf
+            center_path: Center release maf path with a '%s' for the center
+            centers: Centers to create release mafs for
+            buffering: Buffer size of each file handle in bytes
+        """
+        self.merged_path = merged_path
+        self.center_path = center_path
+        self.buffering = buffering
+        self.header = None
+        self._merged_file = open(merged_path, "w", buffering=buffering)
+        self._center_files = {}
+        for center in centers:
+            self._open_center(center)
+
+    def _open_center(self, center):
+        center_file = open(self.center_path % center, "w",
+                           buffering=self.buffering)
+        if self.header is not None:
+            center_file.write(self.header)
+        self._center_files[center] = center_file
+        return center_file
+
+    def write_header(self, header):
+        """Writes header to the merged and all center files
+
+        Args:
+            header: Header line
+        """
+        self.header = header
+        self._merged_file.write(header)
+        for center_file in self._center_files.values():
+            center_file.write(header)
+
+    def write_merged(self, row):
+        """Writes row to merged release maf"""
+        self._merged_file.write(row)
+
+    def write_center(self, center, row):
+        """Writes row to center release maf"""
+        center_file = self._center_files.get(center)
+        if center_file is None:
+            center_file = self._open_center(center)
+        center_file.write(row)
+
+    @property
+    def centers(self):
+        """Centers that have a release maf"""
+        return list(self._center_files)
+
+    def copy_merged(self, path):
+        """Appends the content of a file to the merged release maf"""
+        with open(path, "r") as maf_part:
+            shutil.copyfileobj(maf_part, self._merged_file)
+
+    def copy_center(self, center, path):
+        """Appends the content of a file to a center release maf"""
+        center_file = self._center_files.get(center)
+        if center_file is None:
+            center_file = self._open_center(center)
+        with open(path, "r") as maf_part:
+            shutil.copyfileobj(maf_part, center_file)
+
+    def close(self):
+        """Flushes and closes all file handles"""
+        self._merged_file.close()
+        for center_file in self._center_files.values():
+            center_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _read_maf_headers(maf_file):
+    """Reads the header of a center maf and adds the mutation in cis flag
+    header"""
+    headers = maf_file.readline().replace("\n", "").split("\t")
+    headers.append("mutationInCis_Flag")
+    return headers
+
+
+def _write_center_maf(maf_file, headers, row_filter, writer,
+                      maf_chunksize=None):
+    center_filter = row_filter.with_headers(headers)
+    if maf_chunksize is None:
+        center_filter.write_rows(maf_file, writer)
     else:
-        return None
+        center_filter.write_chunks(maf_file, writer, maf_chunksize)
+
+
+def _write_center_maf_part(maf_path, row_filter, part_dir, index,
+                           maf_chunksize=None):
+    """Filters one center maf into its own merged and center release maf
+    parts without headers.  Runs in a worker process.
+
+    Args:
+        maf_path: Path to center maf
+        row_filter: MafRowFilter
+        part_dir: Directory to write the parts to
+        index: Index of the center maf, used to name the parts
+        maf_chunksize: Filter the maf with pandas, reading this many rows
+                       at a time. Default is None, to filter row by row.
+
+    Returns:
+        tuple: merged part path, dict of center to center part path
+    """
+    merged_path = os.path.join(part_dir, "%d_merged.txt" % index)
+    center_path = os.path.join(part_dir, "%d_center_%%s.txt" % index)
+    with open(maf_path, "r") as maf_file, \
+            MafReleaseWriter(merged_path, center_path) as writer:
+        headers = _read_maf_headers(maf_file)
+        _write_center_maf(maf_file, headers, row_filter, writer,
+                          maf_chunksize=maf_chunksize)
+    return merged_path, {center: center_path % center
+                         for center in writer.centers}
 
 
 def runMAFinBED(syn,
@@ -587,6 +872,50 @@ def store_fusion_files(syn,
         name="data_fusions.txt")
 
 
+def _write_maf_release_parallel(syn, maf_synids, release_centers,
+                                row_filter, writer, maf_chunksize,
+                                maf_workers):
+    """Filters each center maf in its own process, then concatenates the
+    parts in the order of the center mafs so the release mafs are the same
+    as when filtering the mafs one after another
+
+    Args:
+        syn: Synapse object
+        maf_synids: Synapse ids of center mafs
+        release_centers: Centers with release = True
+        row_filter: MafRowFilter
+        writer: MafReleaseWriter of the release mafs
+        maf_chunksize: Filter the mafs with pandas, reading this many rows
+                       at a time.
+        maf_workers: Number of processes
+    """
+    part_dir = tempfile.mkdtemp(dir=GENIE_RELEASE_DIR)
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=maf_workers) as executor:
+            futures = []
+            for index, mafSynId in enumerate(maf_synids):
+                mafEnt = syn.get(mafSynId)
+                logger.info(mafEnt.path)
+                if index == 0:
+                    with open(mafEnt.path, "r") as mafFile:
+                        headers = _read_maf_headers(mafFile)
+                    writer.write_header("\t".join(headers) + "\n")
+                center = mafEnt.path.split("_")[3]
+                # Make sure to only write the centers that release = True
+                if center in release_centers:
+                    futures.append(executor.submit(
+                        _write_center_maf_part, mafEnt.path, row_filter,
+                        part_dir, index, maf_chunksize=maf_chunksize))
+            for future in futures:
+                merged_part, center_parts = future.result()
+                writer.copy_merged(merged_part)
+                for center, center_part in center_parts.items():
+                    writer.copy_center(center, center_part)
+    finally:
+        shutil.rmtree(part_dir)
+
+
 def store_maf_files(syn,
                     genie_version,
                     flatfiles_view_synid,
@@ -597,7 +926,9 @@ def store_maf_files(syn,
                     keep_for_center_consortium_samples,
                     remove_mafinbed_variants,
                     flagged_mutationInCis_variants,
-                    current_release_staging):
+                    current_release_staging,
+                    maf_chunksize=None,
+                    maf_workers=1):
     '''
     Create, filter, configure, and store maf file
 
@@ -613,6 +944,10 @@ def store_maf_files(syn,
         remove_mafinbed_variants: Variants to remove
         flagged_mutationInCis_variants: Variants to flag
         current_release_staging: Staging flag
+        maf_chunksize: Filter the mafs with pandas, reading this many rows
+                       at a time. Default is None, to filter row by row.
+        maf_workers: Number of processes filtering center mafs. Default is
+                     1, to filter the mafs one after another.
     '''
 
     logger.info("FILTERING, STORING MUTATION FILES")
@@ -622,48 +957,32 @@ def store_maf_files(syn,
     centerMafSynIdsDf = centerMafSynIds.asDataFrame()
     mutations_path = os.path.join(
         GENIE_RELEASE_DIR, 'data_mutations_extended_%s.txt' % genie_version)
-    with open(mutations_path, 'w') as f:
-        pass
-    for index, mafSynId in enumerate(centerMafSynIdsDf.id):
-        mafEnt = syn.get(mafSynId)
-        logger.info(mafEnt.path)
-        with open(mafEnt.path, "r") as mafFile:
-            header = mafFile.readline()
-            headers = header.replace("\n", "").split("\t")
-            # Add in mutation in cis flag header
-            headers.append("mutationInCis_Flag")
-            header = "\t".join(headers) + "\n"
-            if index == 0:
-                with open(mutations_path, 'a') as f:
-                    f.write(header)
-                # Create maf file per center for their staging directory
-                for center in clinicaldf['CENTER'].unique():
-                    with open(MUTATIONS_CENTER_PATH % center, 'w') as f:
-                        f.write(header)
-        # with open(mafEnt.path,"r") as newMafFile:
-        #   newMafFile.readline()
-            center = mafEnt.path.split("_")[3]
-            # Make sure to only write the centers that release = True
-            if center in center_mappingdf.center.tolist():
-                for row in mafFile:
-                    rowArray = row.replace("\n", "").split("\t")
-                    center = rowArray[headers.index('Center')]
-                    newMergedRow = configure_maf_row(
-                        rowArray, headers,
-                        keep_for_merged_consortium_samples,
-                        remove_mafinbed_variants,
-                        flagged_mutationInCis_variants)
-                    if newMergedRow is not None:
-                        with open(mutations_path, 'a') as f:
-                            f.write(newMergedRow)
-                    newCenterRow = configure_maf_row(
-                        rowArray, headers,
-                        keep_for_center_consortium_samples,
-                        remove_mafinbed_variants,
-                        flagged_mutationInCis_variants)
-                    if newCenterRow is not None:
-                        with open(MUTATIONS_CENTER_PATH % center, 'a') as f:
-                            f.write(newCenterRow)
+    row_filter = MafRowFilter(keep_for_merged_consortium_samples,
+                              keep_for_center_consortium_samples,
+                              remove_mafinbed_variants,
+                              flagged_mutationInCis_variants)
+    release_centers = center_mappingdf.center.tolist()
+    # Create maf file per center for their staging directory
+    with MafReleaseWriter(mutations_path, MUTATIONS_CENTER_PATH,
+                          centers=clinicaldf['CENTER'].unique()) as writer:
+        if maf_workers > 1:
+            _write_maf_release_parallel(syn, centerMafSynIdsDf.id,
+                                        release_centers, row_filter, writer,
+                                        maf_chunksize, maf_workers)
+        else:
+            for index, mafSynId in enumerate(centerMafSynIdsDf.id):
+                mafEnt = syn.get(mafSynId)
+                logger.info(mafEnt.path)
+                with open(mafEnt.path, "r") as mafFile:
+                    headers = _read_maf_headers(mafFile)
+                    if index == 0:
+                        writer.write_header("\t".join(headers) + "\n")
+                    center = mafEnt.path.split("_")[3]
+                    # Make sure to only write the centers that release = True
+                    if center in release_centers:
+                        _write_center_maf(mafFile, headers, row_filter,
+                                          writer,
+                                          maf_chunksize=maf_chunksize)
     store_file(
         syn, mutations_path,
         parent=release_synid,
@@ -785,6 +1104,88 @@ def store_assay_info_files(syn, genie_version, assay_info_synid,
     return wes_panels.tolist()
 
 
+ONCOTREE_COLUMNS = ['CANCER_TYPE', 'CANCER_TYPE_DETAILED',
+                    'ONCOTREE_PRIMARY_NODE', 'ONCOTREE_SECONDARY_NODE']
+
+
+def _take_unique(values, transform):
+    '''
+    Transform each unique value once.  Null values stay null.
+
+    Args:
+        values: pandas Series
+        transform: Function that transforms a Series of unique values
+
+    Returns:
+        numpy.ndarray: transformed values
+    '''
+    codes, uniques = pd.factorize(values)
+    transformed = transform(pd.Series(uniques, dtype=object))
+    # Code -1 (null) takes the appended null
+    return(np.append(transformed.values.astype(object), float('nan'))
+           .take(codes))
+
+
+def _convert_age_at_seq_report(ages):
+    '''
+    Convert AGE_AT_SEQ_REPORT from days to years.  Integer ages are
+    floored to years, the redacted >32485 and <6570 days become >89 and
+    <18 years, and every other value is kept as is.
+
+    Args:
+        ages: Unique AGE_AT_SEQ_REPORT values in days
+
+    Returns:
+        Series: AGE_AT_SEQ_REPORT in years
+    '''
+    days = pd.to_numeric(ages, errors='coerce').astype(float)
+    integers = np.isfinite(days) & (np.floor(days) == days)
+    years = ages.astype(object)
+    years[integers] = np.floor(
+        days[integers].astype(np.int64) / 365.25).astype(np.int64).tolist()
+    years[years == ">32485"] = ">89"
+    years[years == "<6570"] = "<18"
+    return(years)
+
+
+def annotate_oncotree(clinicaldf, oncotree_mapping):
+    '''
+    Add the cancer types and oncotree nodes of the ONCOTREE_CODE and
+    convert AGE_AT_SEQ_REPORT from days to years, keeping the days in
+    AGE_AT_SEQ_REPORT_DAYS.  Codes are matched case insensitively and
+    codes that are not in the mapping are set to null.
+
+    Args:
+        clinicaldf: Clinical dataframe with ONCOTREE_CODE and
+                    AGE_AT_SEQ_REPORT
+        oncotree_mapping: Oncotree code mappings from
+                          process_functions.get_oncotree_code_mappings
+
+    Returns:
+        pandas.DataFrame: annotated clinical dataframe
+    '''
+    clinicaldf = clinicaldf.copy()
+    mappingdf = pd.DataFrame.from_dict(
+        oncotree_mapping, orient="index").reindex(columns=ONCOTREE_COLUMNS)
+    # Add in unknown key which maps to UNKNOWN everything
+    mappingdf.loc['UNKNOWN'] = 'UNKNOWN'
+    codes = _take_unique(clinicaldf['ONCOTREE_CODE'],
+                         lambda unique_codes: unique_codes.str.upper())
+    annotations = mappingdf.reindex(codes)
+    for col in ONCOTREE_COLUMNS:
+        clinicaldf[col] = annotations[col].values
+    # All cancer types that are null should have null oncotree codes
+    clinicaldf.loc[
+        clinicaldf['CANCER_TYPE'].isnull(), 'ONCOTREE_CODE'] = float('nan')
+    # Suggest using AGE_AT_SEQ_REPORT_DAYS instead so that the
+    # descriptions can match
+    clinicaldf['AGE_AT_SEQ_REPORT_DAYS'] = clinicaldf['AGE_AT_SEQ_REPORT']
+    clinicaldf['AGE_AT_SEQ_REPORT'] = pd.Series(_take_unique(
+        clinicaldf['AGE_AT_SEQ_REPORT'], _convert_age_at_seq_report),
+        index=clinicaldf.index).infer_objects()
+    return(clinicaldf)
+
+
 def store_clinical_files(syn,
                          genie_version,
                          clinicaldf,
@@ -824,46 +1225,7 @@ def store_clinical_files(syn,
     logger.info("ADD CANCER TYPES")
     # This removes support for both oncotree urls (only support json)
     oncotree_dict = process_functions.get_oncotree_code_mappings(oncotree_url)
-    # Add in unknown key which maps to UNKNOWN everything
-    oncotree_dict['UNKNOWN'] = {'CANCER_TYPE': 'UNKNOWN',
-                                'CANCER_TYPE_DETAILED': 'UNKNOWN',
-                                'ONCOTREE_PRIMARY_NODE': 'UNKNOWN',
-                                'ONCOTREE_SECONDARY_NODE': 'UNKNOWN'}
-
-    clinicaldf['CANCER_TYPE'] = [
-        oncotree_dict[code.upper()]["CANCER_TYPE"]
-        if code.upper() in oncotree_dict.keys() else float('nan')
-        for code in clinicaldf['ONCOTREE_CODE']]
-
-    clinicaldf['CANCER_TYPE_DETAILED'] = [
-        oncotree_dict[code.upper()]["CANCER_TYPE_DETAILED"]
-        if code.upper() in oncotree_dict.keys() else float('nan')
-        for code in clinicaldf['ONCOTREE_CODE']]
-
-    clinicaldf['ONCOTREE_PRIMARY_NODE'] = [
-        oncotree_dict[code.upper()]["ONCOTREE_PRIMARY_NODE"]
-        if code.upper() in oncotree_dict.keys() else float('nan')
-        for code in clinicaldf['ONCOTREE_CODE']]
-
-    clinicaldf['ONCOTREE_SECONDARY_NODE'] = [
-        oncotree_dict[code.upper()]["ONCOTREE_SECONDARY_NODE"]
-        if code.upper() in oncotree_dict.keys() else float('nan')
-        for code in clinicaldf['ONCOTREE_CODE']]
-
-    # All cancer types that are null should have null oncotree codes
-    clinicaldf['ONCOTREE_CODE'][
-        clinicaldf['CANCER_TYPE'].isnull()] = float('nan')
-    # Suggest using AGE_AT_SEQ_REPORT_DAYS instead so that the
-    # descriptions can match
-    clinicaldf['AGE_AT_SEQ_REPORT_DAYS'] = clinicaldf['AGE_AT_SEQ_REPORT']
-    clinicaldf['AGE_AT_SEQ_REPORT'] = [
-        int(math.floor(int(float(age))/365.25))
-        if process_functions.checkInt(age) else age
-        for age in clinicaldf['AGE_AT_SEQ_REPORT']]
-    clinicaldf['AGE_AT_SEQ_REPORT'][
-        clinicaldf['AGE_AT_SEQ_REPORT'] == ">32485"] = ">89"
-    clinicaldf['AGE_AT_SEQ_REPORT'][
-        clinicaldf['AGE_AT_SEQ_REPORT'] == "<6570"] = "<18"
+    clinicaldf = annotate_oncotree(clinicaldf, oncotree_dict)
 
     ############################################################
     # CENTER SPECIFIC CODE FOR RIGHT NOW (REMOVE UHN-555-V1)
@@ -938,6 +1300,83 @@ def store_clinical_files(syn,
            keep_merged_consortium_samples)
 
 
+class CnaReleaseAssembler(object):
+    '''
+    Assembles the release CNA matrix from the center matrices.  Every
+    center matrix is aligned on the shared, sorted Hugo symbol index and
+    its samples are formatted into blocks of columns on disk.  The release
+    matrix is written once at the end by concatenating the rows of the
+    blocks.
+
+    Args:
+        symbols: Hugo symbols of all center matrices
+        block_dir: Directory to write the column blocks to
+        block_size: Maximum number of samples per column block
+    '''
+    def __init__(self, symbols, block_dir, block_size=5000):
+        self.symbols = pd.Index(sorted(set(symbols)), name="Hugo_Symbol")
+        self.block_dir = block_dir
+        self.block_size = block_size
+        self.block_paths = []
+        self.samples = []
+
+    def align(self, center_cna):
+        '''
+        Align a center matrix on the shared symbols
+
+        Args:
+            center_cna: Center CnaMatrix
+
+        Returns:
+            CnaMatrix: One row per shared symbol.  Processed CNA files
+                       have unique symbols, the first row of any
+                       duplicated symbol is kept
+        '''
+        return center_cna.reindex(self.symbols)
+
+    def add(self, aligned_cna):
+        '''
+        Add the samples of an aligned matrix to the release matrix
+
+        Args:
+            aligned_cna: CnaMatrix returned by align
+        '''
+        samples = aligned_cna.samples
+        for start in range(0, len(samples), self.block_size):
+            block = aligned_cna.select_samples(
+                samples[start:start + self.block_size])
+            block_path = os.path.join(
+                self.block_dir, "cna_block_{}.txt".format(
+                    len(self.block_paths)))
+            # Only the sample columns are kept, the symbols are the
+            # same in every block
+            with open(block_path, "w") as block_file:
+                block_file.write("\t" + "\t".join(block.samples) + "\n")
+                for row in block.format_rows():
+                    block_file.write(row + "\n")
+            self.block_paths.append(block_path)
+            self.samples.extend(block.samples)
+
+    def write(self, cna_path):
+        '''
+        Write the release matrix
+
+        Args:
+            cna_path: Path to the release CNA file
+        '''
+        with contextlib.ExitStack() as stack:
+            block_files = [stack.enter_context(open(block_path, "r"))
+                           for block_path in self.block_paths]
+            with open(cna_path, "w") as cna_file:
+                rows = zip(["Hugo_Symbol"] + self.symbols.tolist(),
+                           *block_files)
+                for row in rows:
+                    cna_file.write(row[0])
+                    for block_line in row[1:]:
+                        cna_file.write(block_line.rstrip("\n"))
+                    cna_file.write("\n")
+
+
 def store_cna_files(syn, flatfiles_view_synid,
                     keep_for_center_consortium_samples,
                     keep_for_merged_consortium_samples,
@@ -964,89 +1403,109 @@ def store_cna_files(syn, flatfiles_view_synid,
                  "where name like 'data_CNA%'").format(flatfiles_view_synid)
     center_cna_synids = syn.tableQuery(query_str)
     center_cna_synidsdf = center_cna_synids.asDataFrame()
-    # Grab all unique symbols and form cna_template
+    # Grab all unique symbols to align the center files on
     all_symbols = set()
+    cna_ents = []
     for cna_synid in center_cna_synidsdf['id']:
         cna_ent = syn.get(cna_synid)
+        cna_ents.append(cna_ent)
         with open(cna_ent.path, "r") as cna_file:
             # Read first line first
             cna_file.readline()
             # Get all hugo symbols
             all_symbols = all_symbols.union(
                 set(line.split("\t")[0] for line in cna_file))
-    cna_template = pd.DataFrame({"Hugo_Symbol": list(all_symbols)})
-    cna_template.sort_values("Hugo_Symbol", inplace=True)
-    cna_template.to_csv(cna_path, sep="\t", index=False)
-    # Loop through to create finalized CNA file
-    with_center_hugo_symbol = pd.Series("Hugo_Symbol")
-    with_center_hugo_symbol = with_center_hugo_symbol.append(
-        pd.Series(keep_for_center_consortium_samples))
-
-    with_merged_hugo_symbol = pd.Series("Hugo_Symbol")
-    with_merged_hugo_symbol = with_merged_hugo_symbol.append(
-        pd.Series(keep_for_merged_consortium_samples))
-
-    cna_samples = []
-
-    for cna_synId in center_cna_synidsdf['id']:
-        cna_ent = syn.get(cna_synId)
-        center = cna_ent.name.replace("data_CNA_", "").replace(".txt", "")
-        logger.info(cna_ent.path)
-        if center in center_mappingdf.center.tolist():
-            center_cna = pd.read_csv(cna_ent.path, sep="\t")
-            merged_cna = cna_template.merge(
-                center_cna, on="Hugo_Symbol", how="outer")
-            merged_cna.sort_values("Hugo_Symbol", inplace=True)
-
-            if not current_release_staging:
-                merged_cna = merged_cna[merged_cna.columns[
-                    merged_cna.columns.isin(with_center_hugo_symbol)]]
 
-                cna_text = process_functions.removePandasDfFloat(merged_cna)
-                # Replace blank with NA's
-                cna_text = cna_text.replace("\t\t", "\tNA\t")
-                cna_text = cna_text.replace("\t\t", "\tNA\t")
-                cna_text = cna_text.replace('\t\n', "\tNA\n")
+    keep_for_center_consortium_samples = set(
+        keep_for_center_consortium_samples)
+    keep_for_merged_consortium_samples = set(
+        keep_for_merged_consortium_samples)
+    block_dir = tempfile.mkdtemp(dir=GENIE_RELEASE_DIR)
+    try:
+        assembler = CnaReleaseAssembler(all_symbols, block_dir)
+        for cna_ent in cna_ents:
+            center = cna_ent.name.replace("data_CNA_", "").replace(".txt", "")
+            logger.info(cna_ent.path)
+            if center not in center_mappingdf.center.tolist():
+                continue
+            # Symbols are read as text, like when they were collected
+            aligned_cna = assembler.align(CnaMatrix.read(cna_ent.path))
 
+            if not current_release_staging:
                 # Store center CNA file in staging dir
-                with open(CNA_CENTER_PATH % center, "w") as cna_file:
-                    cna_file.write(cna_text)
+                aligned_cna.select_samples(
+                    keep_for_center_consortium_samples).write(
+                        CNA_CENTER_PATH % center)
                 store_file(syn, CNA_CENTER_PATH % center,
                            genieVersion=genie_version,
                            parent=center_mappingdf['stagingSynId'][
                                center_mappingdf['center'] == center][0])
             # This is to remove more samples for the final cna file
-            merged_cna = merged_cna[merged_cna.columns[
-                merged_cna.columns.isin(with_merged_hugo_symbol)]]
-
-            cna_text = process_functions.removePandasDfFloat(merged_cna)
-            cna_text = cna_text.replace("\t\t", "\tNA\t")
-            cna_text = cna_text.replace("\t\t", "\tNA\t")
-            cna_text = cna_text.replace('\t\n', "\tNA\n")
-
-            with open(CNA_CENTER_PATH % center, "w") as cna_file:
-                cna_file.write(cna_text)
-            # Join CNA file
-            cna_samples.extend(merged_cna.columns[1:].tolist())
-            linux_join_command = ["join", cna_path, CNA_CENTER_PATH % center]
-            output = subprocess.check_output(linux_join_command)
-            with open(cna_path, "w") as cna_file:
-                cna_file.write(output.decode("utf-8").replace(" ", "\t"))
+            assembler.add(aligned_cna.select_samples(
+                keep_for_merged_consortium_samples))
+        assembler.write(cna_path)
+    finally:
+        shutil.rmtree(block_dir)
 
     store_file(syn, cna_path, parent=release_synid, genieVersion=genie_version,
                name="data_CNA.txt")
 
-    return cna_samples
+    return assembler.samples
 
 
 # SEG
+def _query_seg_pages(syn, seg_synid, page_size):
+    '''
+    Query the seg table page_size rows at a time.  Pages are ordered on
+    ROW_ID and each page starts after the last ROW_ID of the previous
+    page, so rows can't be skipped or repeated between pages and deep
+    pages cost the same as the first one.
+
+    Args:
+        syn: Synapse object
+        seg_synid: Seg database synid
+        page_size: Number of rows per query
+
+    Yields:
+        pandas.DataFrame: Seg rows with release column names and CENTER
+    '''
+    where = ""
+    while True:
+        seg = syn.tableQuery(
+            'SELECT ID,CHROM,LOCSTART,LOCEND,NUMMARK,SEGMEAN'
+            ',CENTER FROM %s%s ORDER BY ROW_ID LIMIT %d' % (
+                seg_synid, where, page_size))
+        # The index is ROW_ID_ROW_VERSION
+        segdf = seg.asDataFrame()
+        if segdf.empty:
+            break
+        yield segdf.rename(columns={'CHROM': 'chrom',
+                                    'LOCSTART': 'loc.start',
+                                    'LOCEND': 'loc.end',
+                                    'SEGMEAN': 'seg.mean',
+                                    'NUMMARK': 'num.mark'})
+        if len(segdf) < page_size:
+            break
+        last_row_id = int(str(segdf.index[-1]).split("_")[0])
+        where = " WHERE ROW_ID > %d" % last_row_id
+
+
+def _format_seg_rows(segdf):
+    '''Seg rows as tsv text without header, see removePandasDfFloat'''
+    text = segdf[SEG_COLUMNS].to_csv(sep="\t", index=False, header=False)
+    return process_functions.removeStringFloat(text)
+
+
 def store_seg_files(syn, genie_version,
                     seg_synid, release_synid,
                     keep_for_center_consortium_samples,
                     keep_for_merged_consortium_samples,
-                    center_mappingdf, current_release_staging):
+                    center_mappingdf, current_release_staging,
+                    page_size=SEG_PAGE_SIZE):
     '''
-    Create, filter and store seg file
+    Create, filter and store seg file.  The seg table is queried in
+    pages and each page is filtered and written to the merged and
+    center seg files as it arrives.
 
     Args:
         syn: Synapse object
@@ -1057,39 +1516,34 @@ def store_seg_files(syn, genie_version,
         keep_for_merged_consortium_samples: Samples to keep for merged file
         center_mappingdf: Center mapping dataframe
         current_release_staging: Staging flag
+        page_size: Number of seg rows queried at a time
     '''
     logger.info("MERING, FILTERING, STORING SEG FILES")
     seg_path = os.path.join(GENIE_RELEASE_DIR,
                             'genie_private_data_cna_hg19_%s.seg' % genie_version)
-    seg = syn.tableQuery(
-        'SELECT ID,CHROM,LOCSTART,LOCEND,NUMMARK,SEGMEAN'
-        ',CENTER FROM %s' % seg_synid)
-    segdf = seg.asDataFrame()
-    segdf = segdf.rename(columns={'CHROM': 'chrom',
-                                  'LOCSTART': 'loc.start',
-                                  'LOCEND': 'loc.end',
-                                  'SEGMEAN': 'seg.mean',
-                                  'NUMMARK': 'num.mark'})
-    if not current_release_staging:
-        staging_segdf = segdf[segdf['ID'].isin(
-            keep_for_center_consortium_samples)]
-        for center in center_mappingdf.center:
-            center_seg = staging_segdf[staging_segdf['CENTER'] == center]
-            if not center_seg.empty:
-                del center_seg['CENTER']
-                segtext = process_functions.removePandasDfFloat(center_seg)
-                with open(SEG_CENTER_PATH % center, "w") as seg_file:
-                    seg_file.write(segtext)
-                store_file(
-                    syn, SEG_CENTER_PATH % center,
-                    genieVersion=genie_version,
-                    parent=center_mappingdf['stagingSynId'][
-                        center_mappingdf['center'] == center][0])
-    del segdf['CENTER']
-    segdf = segdf[segdf['ID'].isin(keep_for_merged_consortium_samples)]
-    segtext = process_functions.removePandasDfFloat(segdf)
-    with open(seg_path, "w") as seg_file:
-        seg_file.write(segtext)
+    keep_center_samples = list(keep_for_center_consortium_samples)
+    keep_merged_samples = list(keep_for_merged_consortium_samples)
+    release_centers = center_mappingdf.center.tolist()
+    with MafReleaseWriter(seg_path, SEG_CENTER_PATH) as writer:
+        writer.write_header("\t".join(SEG_COLUMNS) + "\n")
+        for segdf in _query_seg_pages(syn, seg_synid, page_size):
+            merged_segdf = segdf[segdf['ID'].isin(keep_merged_samples)]
+            writer.write_merged(_format_seg_rows(merged_segdf))
+            if current_release_staging:
+                continue
+            center_segdf = segdf[
+                segdf['ID'].isin(keep_center_samples) &
+                segdf['CENTER'].isin(release_centers)]
+            for center, rows in center_segdf.groupby('CENTER', sort=False):
+                writer.write_center(center, _format_seg_rows(rows))
+    # Store center seg files in staging dir
+    for center in release_centers:
+        if center in writer.centers:
+            store_file(
+                syn, SEG_CENTER_PATH % center,
+                genieVersion=genie_version,
+                parent=center_mappingdf['stagingSynId'][
+                    center_mappingdf['center'] == center][0])
     store_file(syn, seg_path, parent=release_synid,
                genieVersion=genie_version,
                name="genie_private_data_cna_hg19.seg")
@@ -1186,7 +1640,8 @@ def stagingToCbio(syn, processingDate, genieVersion,
                   oncotree_url=None, consortiumReleaseCutOff=183,
                   current_release_staging=False,
                   skipMutationsInCis=False, test=False,
-                  genie_user=None, genie_pass=None):
+                  genie_user=None, genie_pass=None,
+                  maf_chunksize=None, maf_workers=1):
     '''
     Main function that takes the GENIE database and creates release files
 
@@ -1203,6 +1658,9 @@ def stagingToCbio(syn, processingDate, genieVersion,
         test: Testing parameter. Default is False.
         genie_user: Synapse username. Default is None.
         genie_pass: Synapse password.  Default is None.
+        maf_chunksize: Filter the mafs with pandas, reading this many rows
+                       at a time. Default is None, to filter row by row.
+        maf_workers: Number of processes filtering center mafs. Default is 1.
 
     Returns:
         list: Gene panel entities
@@ -1321,7 +1779,9 @@ def stagingToCbio(syn, processingDate, genieVersion,
         keepForCenterConsortiumSamples,
         remove_mafInBed_variants,
         flagged_mutationInCis_variants,
-        current_release_staging)
+        current_release_staging,
+        maf_chunksize=maf_chunksize,
+        maf_workers=maf_workers)
 
     cnaSamples = store_cna_files(
         syn,
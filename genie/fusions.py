@@ -5,31 +5,12 @@ import logging
 import pandas as pd
 
 from .example_filetype_format import FileTypeFormat
+from . import bed
 from . import process_functions
 
 logger = logging.getLogger(__name__)
 
 
-def validateSymbol(x, bedDf, returnMappedDf=True):
-    valid=False
-    gene = x['HUGO_SYMBOL']
-    if sum(bedDf['Hugo_Symbol'] == gene) > 0:
-        valid=True
-    elif sum(bedDf['ID'] == gene) > 0:
-        mismatch = bedDf[bedDf['ID'] == gene]
-        mismatch.drop_duplicates(inplace=True)
-        logger.info("%s will be remapped to %s" % (gene, mismatch['Hugo_Symbol'].values[0]))
-        x['HUGO_SYMBOL'] = mismatch['Hugo_Symbol'].values[0]
-    #else:
-    #    logger.warning("%s cannot be remapped and will not be released. The symbol must exist in your seq assay ids (bed files) and must be mappable to a gene." % gene)
-    #    x['HUGO_SYMBOL'] = float('nan')
-        #x['FUSION'] = x['FUSION'].replace("%s-" % gene,"%s-" % x['HUGO_SYMBOL'])
-        #x['COMMENTS'] = str(x['COMMENTS']).replace("-%s" % gene,"-%s" % str(x['COMMENTS']))
-    if returnMappedDf:
-        return(x)
-    else:
-        return(valid)
-
 # Remap fusion's FUSION column
 def remapFusion(gene_dict, DF, col):
     nonmapped = []
@@ -75,9 +56,9 @@ class fusions(FileTypeFormat):
         fusion['ID'] = fusion['HUGO_SYMBOL'].copy()
         bedSynId = process_functions.getDatabaseSynId(self.syn, "bed",
                                                       databaseToSynIdMappingDf=databaseToSynIdMappingDf)
-        bed = self.syn.tableQuery("select Hugo_Symbol, ID from %s where CENTER = '%s'" % (bedSynId, self.center))
-        bedDf = bed.asDataFrame()
-        fusion = fusion.apply(lambda x: validateSymbol(x, bedDf), axis=1)
+        resolver = bed.SYMBOL_RESOLVERS.get(self.syn, bedSynId, self.center)
+        fusion['HUGO_SYMBOL'] = resolver.resolve(fusion['HUGO_SYMBOL'],
+                                                 keep_unmapped=True)
         #Create nonmapped gene dict
         temp = fusion[fusion['HUGO_SYMBOL'] != fusion['ID']]
         foo = temp[~temp.HUGO_SYMBOL.isnull()]
@@ -117,11 +98,6 @@ class fusions(FileTypeFormat):
         if process_functions.checkColExist(fusionDF, "HUGO_SYMBOL") and not nosymbol_check:
            # logger.info("VALIDATING %s GENE SYMBOLS" % os.path.basename(filePath))
             #invalidated_genes = fusionDF["HUGO_SYMBOL"].drop_duplicates().apply(validateSymbol)
-            databaseToSynIdMappingDf = process_functions.get_synid_database_mappingdf(self.syn, project_id)
-            bedSynId = process_functions.getDatabaseSynId(self.syn, "bed",
-                                                          databaseToSynIdMappingDf=databaseToSynIdMappingDf)
-            bed = self.syn.tableQuery("select Hugo_Symbol, ID from %s where CENTER = '%s'" % (bedSynId, self.center))
-            bedDf = bed.asDataFrame()
             #invalidated_genes = self.pool.map(process_functions.validateSymbol, fusionDF["HUGO_SYMBOL"].drop_duplicates())
             if fusionDF["HUGO_SYMBOL"].isnull().any():
                 total_error += "Your fusion file should not have any NA/blank Hugo Symbols.\n"
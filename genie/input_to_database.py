@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
 from collections import defaultdict
+import concurrent.futures
+import contextlib
 import datetime
 import logging
+import logging.handlers
+import multiprocessing
 import os
+import threading
 import time
 from typing import List
 
@@ -15,9 +20,11 @@ import synapseutils
 import pandas as pd
 
 from .config import PROCESS_FILES
+from . import bed
 from . import process_functions
 from . import validate
 from . import toRetract
+from .table_upload import is_retryable
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -27,6 +34,80 @@ DUPLICATED_FILE_ERROR = (
     "Duplicated filename! Files should be uploaded as new versions "
     "and the entire dataset should be uploaded."
 )
+# Processes that annotate with VEP through vcf2maf
+VEP_PROCESSES = ['vcf', 'maf', 'mafSP']
+
+# Center handled by the current thread, so concurrent centers each
+# log to their own file
+_CENTER_CONTEXT = threading.local()
+
+
+class CenterLogFilter(logging.Filter):
+    '''
+    Only pass log records emitted while the center is being handled
+
+    Args:
+        center: Center name
+    '''
+    def __init__(self, center):
+        super().__init__()
+        self.center = center
+
+    def filter(self, record):
+        return getattr(_CENTER_CONTEXT, 'center', None) == self.center
+
+
+class FailedCentersError(Exception):
+    '''
+    Raised when centers failed to be validated or processed.  The
+    traceback of each center is in its log.
+
+    Args:
+        centers: Names of the failed centers
+    '''
+    def __init__(self, centers):
+        super().__init__("Failed centers: {}".format(", ".join(centers)))
+        self.centers = centers
+
+
+@contextlib.contextmanager
+def _center_context(center):
+    previous = getattr(_CENTER_CONTEXT, 'center', None)
+    _CENTER_CONTEXT.center = center
+    try:
+        yield
+    finally:
+        _CENTER_CONTEXT.center = previous
+
+
+class StageLimits(object):
+    '''
+    Bounds how many centers run a stage at the same time, so heavy
+    processing can be throttled separately from validation.  A stage
+    without a limit is not bounded.
+
+    Args:
+        **limits: Maximum number of centers per stage name
+    '''
+    def __init__(self, **limits):
+        self._semaphores = {
+            stage: threading.BoundedSemaphore(limit)
+            for stage, limit in limits.items() if limit is not None}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''
+        Wait for a free slot of a stage and hold it
+
+        Args:
+            name: Stage name
+        '''
+        semaphore = self._semaphores.get(name)
+        if semaphore is None:
+            yield
+            return
+        with semaphore:
+            yield
 
 '''
 TODO:
@@ -62,7 +143,132 @@ def entity_date_to_timestamp(entity_date_time):
     return to_unix_epoch_time(date_time_obj)
 
 
-def get_center_input_files(syn, synid, center, process="main", downloadFile=True):
+class CenterFileDownloader(object):
+    '''
+    Gets center file entities, downloading several files at the same time.
+    Files are fetched with a single syn.get each, which reuses an
+    unmodified copy in the Synapse cache instead of downloading it again.
+
+    Args:
+        syn: Synapse object
+        workers: Number of files to get at the same time. Defaults to 1
+        retries: Number of times a file is retried. Defaults to 3
+        retry_wait: Seconds to wait before the first retry, doubles
+                    every retry. Defaults to 5
+    '''
+    def __init__(self, syn, workers=1, retries=3, retry_wait=5):
+        self.syn = syn
+        self.workers = workers
+        self.retries = retries
+        self.retry_wait = retry_wait
+
+    def _cached_path(self, ent):
+        '''
+        Get the cached copy of a file. The Synapse cache only returns a
+        copy whose modified time matches the one recorded when it was
+        downloaded, so the file isn't hashed again.
+
+        Args:
+            ent: Synapse File entity without a downloaded file
+
+        Returns:
+            str: Path to the cached file or None
+        '''
+        if ent.get('dataFileHandleId') is None:
+            return None
+        return self.syn.cache.get(ent.dataFileHandleId)
+
+    def _retry(self, func, synid):
+        '''
+        Call func(synid), retrying on HTTP and connection errors
+        '''
+        for attempt in range(self.retries + 1):
+            try:
+                return func(synid)
+            except Exception as ex:
+                if not is_retryable(ex) or attempt == self.retries:
+                    raise
+                wait = self.retry_wait * 2 ** attempt
+                logger.warning(
+                    f"Getting {synid} failed ({ex}), retrying in {wait}s")
+                time.sleep(wait)
+
+    def _get_metadata(self, synid):
+        return self._retry(
+            lambda synid: self.syn.get(synid, downloadFile=False), synid)
+
+    def _download(self, ent):
+        cached_path = self._cached_path(ent)
+        if cached_path is None:
+            return self._retry(
+                lambda synid: self.syn.get(synid, downloadFile=True),
+                ent.id)
+        ent.path = cached_path
+        ent.files = [os.path.basename(cached_path)]
+        ent.cacheDir = os.path.dirname(cached_path)
+        return ent
+
+    def _get(self, synid):
+        return self._retry(
+            lambda synid: self.syn.get(synid, downloadFile=True), synid)
+
+    def _map(self, func, values):
+        '''
+        Map func over values with the thread pool, keeping the order.  The
+        pool threads log as the center of the calling thread.
+        '''
+        if self.workers <= 1 or len(values) <= 1:
+            return [func(value) for value in values]
+        center = getattr(_CENTER_CONTEXT, 'center', None)
+
+        def _center_func(value):
+            with _center_context(center):
+                return func(value)
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(self.workers, len(values))) as executor:
+            return list(executor.map(_center_func, values))
+
+    def get_entities(self, synids):
+        '''
+        Get the entities and their files
+
+        Args:
+            synids: List of Synapse ids
+
+        Returns:
+            list: Synapse File entities in the same order as synids
+        '''
+        return self._map(self._get, synids)
+
+    def get_metadata(self, synids):
+        '''
+        Get the entities without downloading their files
+
+        Args:
+            synids: List of Synapse ids
+
+        Returns:
+            list: Synapse File entities in the same order as synids
+        '''
+        return self._map(self._get_metadata, synids)
+
+    def download(self, entities):
+        '''
+        Download the files of entities fetched with get_metadata.
+        Files with a cached copy don't cost another Synapse call.
+
+        Args:
+            entities: List of Synapse File entities
+
+        Returns:
+            list: Synapse File entities with their files, in the same order
+        '''
+        return self._map(self._download, entities)
+
+
+def get_center_input_files(syn, synid, center, process="main",
+                           downloadFile=True, workers=1):
     '''
     This function walks through each center's input directory
     to get a list of tuples of center files
@@ -73,6 +279,9 @@ def get_center_input_files(syn, synid, center, process="main", downloadFile=True
         center: Center name
         process: Process type includes, main, vcf, maf and mafSP.
                  Defaults to main such that the vcf
+        downloadFile: Download the files. Defaults to True
+        workers: Number of files to download at the same time.
+                 Defaults to 1
 
     Returns:
         List of entities with the correct format to pass into validation
@@ -83,9 +292,8 @@ def get_center_input_files(syn, synid, center, process="main", downloadFile=True
         "data_clinical_supp_patient_{center}.txt".format(center=center)]
 
     center_files = synapseutils.walk(syn, synid)
-    clinicalpair_entities = []
-    prepared_center_file_list = []
-
+    names = []
+    ent_synids = []
     for _, _, entities in center_files:
         for name, ent_synid in entities:
             # This is to remove vcfs from being validated during main
@@ -93,18 +301,26 @@ def get_center_input_files(syn, synid, center, process="main", downloadFile=True
             # not necessary for them to be run everytime.
             if name.endswith(".vcf") and process != "vcf":
                 continue
+            names.append(name)
+            ent_synids.append(ent_synid)
 
-            ent = syn.get(ent_synid, downloadFile=downloadFile)
-
-            # Clinical file can come as two files.
-            # The two files need to be merged together which is
-            # why there is this format
+    downloader = CenterFileDownloader(syn, workers=workers)
+    if downloadFile:
+        ents = downloader.get_entities(ent_synids)
+    else:
+        ents = downloader.get_metadata(ent_synids)
 
-            if name in clinical_pair_name:
-                clinicalpair_entities.append(ent)
-                continue
+    clinicalpair_entities = []
+    prepared_center_file_list = []
+    for name, ent in zip(names, ents):
+        # Clinical file can come as two files.
+        # The two files need to be merged together which is
+        # why there is this format
+        if name in clinical_pair_name:
+            clinicalpair_entities.append(ent)
+            continue
 
-            prepared_center_file_list.append([ent])
+        prepared_center_file_list.append([ent])
 
     if clinicalpair_entities:
         # clinicalpair_entities = [x for x in clinicalpair]
@@ -113,14 +329,48 @@ def get_center_input_files(syn, synid, center, process="main", downloadFile=True
     return prepared_center_file_list
 
 
-def check_existing_file_status(validation_status_table, error_tracker_table, entities):
+def index_file_status(validation_status_table, error_tracker_table):
     '''
-    This function checks input files against the existing validation and error
-    tracking dataframe
+    Index the validation statuses and errors of a center by file id, so
+    every file group can be checked without scanning the tables
 
     Args:
         validation_status_table: Validation status Synapse Table query result
         error_tracker_table: Error tracking Synapse Table query result
+
+    Returns:
+        tuple: dict of file id to its status row (status, md5, name, path),
+               dict of file id to its errors
+    '''
+    validation_statusdf = validation_status_table.asDataFrame()
+    error_trackerdf = error_tracker_table.asDataFrame()
+    # Like filtering the tables, the first row of a file id is used
+    status_columns = ['status', 'md5', 'name', 'path']
+    status_columns = [col for col in status_columns
+                      if col in validation_statusdf]
+    file_statuses = {}
+    for status_row in validation_statusdf[['id'] + status_columns].itertuples(
+            index=False):
+        status = dict(zip(status_columns, status_row[1:]))
+        file_statuses.setdefault(status_row[0], status)
+    file_errors = {}
+    if not error_trackerdf.empty:
+        for synid, errors in zip(error_trackerdf['id'],
+                                 error_trackerdf['errors']):
+            file_errors.setdefault(synid, errors)
+    return file_statuses, file_errors
+
+
+def check_existing_file_status(file_statuses, file_errors, entities):
+    '''
+    This function checks input files against the existing validation and error
+    tracking dataframe
+
+    Args:
+        file_statuses: File id to status dict from index_file_status,
+                       or the validation status Synapse Table query result
+        file_errors: File id to errors dict from index_file_status,
+                     or the error tracking Synapse Table query result
         entities: list of center input entites
 
     Returns:
@@ -137,35 +387,34 @@ def check_existing_file_status(validation_status_table, error_tracker_table, ent
     statuses = []
     errors = []
 
-    validation_statusdf = validation_status_table.asDataFrame()
-    error_trackerdf = error_tracker_table.asDataFrame()
+    if not isinstance(file_statuses, dict):
+        file_statuses, file_errors = index_file_status(file_statuses,
+                                                       file_errors)
     # This should be outside fo the forloop so that it doesn't
     # get reset
     to_validate = False
     for ent in entities:
         # Get the current status and errors from the tables.
-        current_status = validation_statusdf[validation_statusdf['id'] == ent.id]
-        current_error = error_trackerdf[error_trackerdf['id'] == ent.id]
+        current_status = file_statuses.get(ent.id)
 
-        if current_status.empty:
+        if current_status is None:
             to_validate = True
         else:
             # This to_validate is here, because the following is a
             # sequential check of whether files need to be validated
-            statuses.append(current_status['status'].values[0])
-            if current_error.empty:
-                to_validate = \
-                    current_status['status'].values[0] == "INVALID"
+            statuses.append(current_status['status'])
+            if ent.id not in file_errors:
+                to_validate = current_status['status'] == "INVALID"
             else:
-                errors.append(current_error['errors'].values[0])
+                errors.append(file_errors[ent.id])
             # Add Name check here (must add name of the entity as a column)
-            if current_status['md5'].values[0] != ent.md5 or \
-               current_status['name'].values[0] != ent.name:
+            if current_status['md5'] != ent.md5 or \
+               current_status['name'] != ent.name:
                 to_validate = True
             else:
                 status_str = "{filename} ({id}) FILE STATUS IS: {filestatus}"
                 logger.info(status_str.format(filename=ent.name, id=ent.id,
-                                              filestatus=current_status['status'].values[0]))
+                                              filestatus=current_status['status']))
 
     return({'status_list': statuses,
             'error_list': errors,
@@ -227,7 +476,7 @@ def _get_status_and_error_list(valid, message, entities):
     return input_status_list, invalid_errors_list
 
 
-def validatefile(syn, project_id, entities, validation_status_table, error_tracker_table,
+def validatefile(syn, project_id, entities, file_statuses, file_errors,
                  center, threads, oncotree_link,
                  format_registry=PROCESS_FILES):
     '''Validate a list of entities.
@@ -237,8 +486,8 @@ def validatefile(syn, project_id, entities, validation_status_table, error_track
     Args:
         syn: Synapse object
         entities: A list of entities for a single file 'type' (usually a single file, but clinical can have two)
-        validation_statusdf: Validation status dataframe
-        error_trackerdf: Invalid files error tracking dataframe
+        file_statuses: File id to validation status, see index_file_status
+        file_errors: File id to errors, see index_file_status
         center: Center of interest
         oncotree_link: Oncotree url
 
@@ -257,7 +506,7 @@ def validatefile(syn, project_id, entities, validation_status_table, error_track
     file_users = [entities[0].modifiedBy, entities[0].createdBy]
 
     check_file_status = check_existing_file_status(
-        validation_status_table, error_tracker_table, entities)
+        file_statuses, file_errors, entities)
 
     status_list = check_file_status['status_list']
     error_list = check_file_status['error_list']
@@ -665,9 +914,180 @@ def _update_tables_content(validation_statusdf, error_trackingdf):
             'duplicated_filesdf': duplicated_filesdf}
 
 
+def _download_changed_files(downloader, center_files,
+                            file_statuses, file_errors):
+    '''
+    Download only the file groups that have to be validated.  Unchanged
+    file groups reuse their stored status and errors, so their files are
+    not downloaded and keep the path stored in the validation status table.
+
+    Args:
+        downloader: CenterFileDownloader
+        center_files: List of file groups of entities without files
+        file_statuses: File id to validation status, see index_file_status
+        file_errors: File id to errors, see index_file_status
+
+    Returns:
+        list: File groups, with the files of changed groups downloaded
+    '''
+    to_download = []
+    for ents in center_files:
+        file_status = check_existing_file_status(
+            file_statuses, file_errors, ents)
+        if file_status['to_validate']:
+            to_download.extend(ent for ent in ents if ent.path is None)
+        else:
+            for ent in ents:
+                if ent.path is None:
+                    ent.path = file_statuses[ent.id].get('path')
+    logger.info(f"Downloading {len(to_download)} changed files.")
+    downloaded = {ent.id: ent for ent in downloader.download(to_download)}
+    return [[downloaded.get(ent.id, ent) for ent in ents]
+            for ents in center_files]
+
+
+# Synapse client of a validation process, logged in by its first task
+_PROCESS_SYN = None
+
+
+class _CenterLogForwarder(logging.Handler):
+    '''
+    Hands the log records of validation processes to the loggers of this
+    process as records of the center, so they reach the center log
+
+    Args:
+        center: Center name
+    '''
+    def __init__(self, center):
+        super().__init__()
+        self.center = center
+
+    def emit(self, record):
+        with _center_context(self.center):
+            logging.getLogger(record.name).handle(record)
+
+
+def _log_to_queue(log_queue):
+    '''Send the log records of this process to log_queue'''
+    # Handlers inherited from a forked parent would write the records a
+    # second time
+    for process_logger in logging.Logger.manager.loggerDict.values():
+        if isinstance(process_logger, logging.Logger):
+            process_logger.handlers = []
+    root_logger = logging.getLogger()
+    root_logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root_logger.setLevel(logging.INFO)
+
+
+def _validate_in_process(syn_login, oncotree_offline, log_queue,
+                         project_id, center, ents, file_statuses,
+                         file_errors, oncotree_link, format_registry):
+    '''
+    Validate a file group in a validation process.  The Synapse client
+    can't be pickled, so every process logs in once, on its first file
+    group, and keeps the client for the next ones.
+
+    Args:
+        syn_login: Picklable function returning a logged in Synapse object
+        oncotree_offline: Use the oncotree snapshot instead of the link
+        log_queue: Queue the log records are sent back to the center with
+        See validatefile for the other arguments
+    '''
+    global _PROCESS_SYN
+    if _PROCESS_SYN is None:
+        _log_to_queue(log_queue)
+        process_functions.ONCOTREE_CACHE.offline = oncotree_offline
+        _PROCESS_SYN = syn_login()
+        process_functions.ONCOTREE_CACHE.use_synapse_cache(_PROCESS_SYN)
+    return validatefile(
+        _PROCESS_SYN, project_id, ents, file_statuses, file_errors,
+        center=center, threads=1, oncotree_link=oncotree_link,
+        format_registry=format_registry)
+
+
+def _validate_center_files(syn, project_id, center, center_files,
+                           file_statuses, file_errors,
+                           oncotree_link, format_registry, threads=1,
+                           validation_executor="thread", syn_login=None):
+    '''
+    Validate every file group of a center.  With more than one thread,
+    file groups are validated concurrently.  Threads share the Synapse
+    client and the cached tables, but the pandas work of the validators
+    holds the GIL, so they only overlap while waiting on Synapse and
+    oncotree.  With the process executor the pandas work runs in
+    parallel, at the cost of a Synapse login and cold caches per process.
+
+    Args:
+        syn: Synapse object
+        project_id: Synapse Project ID where data is stored
+        center: Center name
+        center_files: List of file groups (lists of entities)
+        file_statuses: File id to validation status, see index_file_status
+        file_errors: File id to errors, see index_file_status
+        oncotree_link: Link to oncotree
+        format_registry: File format registry
+        threads: Number of file groups to validate at the same time.
+                 Defaults to 1
+        validation_executor: thread or process. Defaults to thread
+        syn_login: Picklable function returning a logged in Synapse
+                   object, required by the process executor
+
+    Returns:
+        list: validatefile results in the same order as center_files
+    '''
+    def _validate(ents):
+        with _center_context(center):
+            return validatefile(
+                syn, project_id, ents,
+                file_statuses,
+                file_errors,
+                center=center, threads=1,
+                oncotree_link=oncotree_link,
+                format_registry=format_registry)
+
+    if threads is None or threads <= 1 or len(center_files) <= 1:
+        return [_validate(ents) for ents in center_files]
+    workers = min(threads, len(center_files))
+    if validation_executor == "process":
+        if syn_login is None:
+            raise ValueError(
+                "syn_login must be specified to validate in processes")
+        logger.info(f"Validating {center} files with {workers} processes.")
+        oncotree_offline = process_functions.ONCOTREE_CACHE.offline
+        with multiprocessing.Manager() as manager:
+            log_queue = manager.Queue()
+            log_listener = logging.handlers.QueueListener(
+                log_queue, _CenterLogForwarder(center))
+            log_listener.start()
+            try:
+                with concurrent.futures.ProcessPoolExecutor(
+                        max_workers=workers) as executor:
+                    # Only the statuses of its own files are sent with a
+                    # group
+                    futures = [executor.submit(
+                        _validate_in_process, syn_login, oncotree_offline,
+                        log_queue, project_id, center, ents,
+                        {ent.id: file_statuses[ent.id] for ent in ents
+                         if ent.id in file_statuses},
+                        {ent.id: file_errors[ent.id] for ent in ents
+                         if ent.id in file_errors},
+                        oncotree_link, format_registry)
+                        for ents in center_files]
+                    return [future.result() for future in futures]
+            finally:
+                log_listener.stop()
+    logger.info(f"Validating {center} files with {workers} threads.")
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers) as executor:
+        # map returns results in the order of center_files
+        return list(executor.map(_validate, center_files))
+
+
 def validation(syn, project_id, center, process,
                center_files, database_synid_mappingdf,
-               oncotree_link, format_registry):
+               oncotree_link, format_registry, threads=1,
+               downloader=None, validation_executor="thread",
+               syn_login=None):
     '''
     Validation of all center files
 
@@ -676,8 +1096,15 @@ def validation(syn, project_id, center, process,
         center: Center name
         process: main, vcf, maf
         center_mapping_df: center mapping dataframe
-        thread: Unused parameter for now
         oncotree_link: Link to oncotree
+        threads: Number of file groups to validate at the same time.
+                 Defaults to 1
+        downloader: CenterFileDownloader to download changed files with,
+                    if center_files were fetched without their files
+        validation_executor: Validate file groups in threads or processes.
+                             Defaults to thread
+        syn_login: Picklable function returning a logged in Synapse
+                   object, used by the process executor
 
     Returns:
         dataframe: Valid files
@@ -708,6 +1135,13 @@ def validation(syn, project_id, center, process,
             center=center,
             add=add_query_str))
 
+    # Indexed once, every file group is checked against these
+    file_statuses, file_errors = index_file_status(validation_status_table,
+                                                   error_tracker_table)
+    if downloader is not None:
+        center_files = _download_changed_files(
+            downloader, center_files, file_statuses, file_errors)
+
     input_valid_statuses = []
     invalid_errors = []
 
@@ -715,15 +1149,12 @@ def validation(syn, project_id, center, process,
     # particular users
     user_message_dict = defaultdict(list)
 
-    for ents in center_files:
-        status, errors, messages_to_send = validatefile(
-            syn, project_id, ents,
-            validation_status_table,
-            error_tracker_table,
-            center=center, threads=1,
-            oncotree_link=oncotree_link,
-            format_registry=format_registry)
-
+    results = _validate_center_files(
+        syn, project_id, center, center_files,
+        file_statuses, file_errors,
+        oncotree_link, format_registry, threads=threads,
+        validation_executor=validation_executor, syn_login=syn_login)
+    for status, errors, messages_to_send in results:
         input_valid_statuses.extend(status)
         if errors is not None:
             invalid_errors.extend(errors)
@@ -770,12 +1201,35 @@ def validation(syn, project_id, center, process,
     return(valid_filesdf[['id', 'path', 'fileType', 'name']])
 
 
+def download_valid_files(downloader, valid_filesdf):
+    '''
+    Download the valid files that were not downloaded for validation,
+    because they did not change since they were last validated
+
+    Args:
+        downloader: CenterFileDownloader
+        valid_filesdf: Valid files with 'id' and 'path' columns
+
+    Returns:
+        dataframe: Valid files with local paths
+    '''
+    valid_filesdf = valid_filesdf.copy()
+    missing = [not isinstance(path, str) or not os.path.exists(path)
+               for path in valid_filesdf['path']]
+    if any(missing):
+        ents = downloader.get_entities(
+            valid_filesdf['id'][missing].tolist())
+        valid_filesdf.loc[missing, 'path'] = [ent.path for ent in ents]
+    return valid_filesdf
+
+
 def center_input_to_database(
         syn, project_id, center, process,
         only_validate, vcf2maf_path, vep_path,
         vep_data, database_to_synid_mappingdf,
         center_mapping_df, reference=None,
-        delete_old=False, oncotree_link=None):
+        delete_old=False, oncotree_link=None, threads=1,
+        stage_limits=None, validation_executor="thread", syn_login=None):
     if only_validate:
         log_path = os.path.join(
             process_functions.SCRIPT_DIR,
@@ -789,8 +1243,59 @@ def center_input_to_database(
         "%(asctime)s [%(name)s][%(levelname)s] %(message)s")
     fileHandler = logging.FileHandler(log_path, mode='w')
     fileHandler.setFormatter(logFormatter)
+    # Other centers can be handled at the same time
+    fileHandler.addFilter(CenterLogFilter(center))
     logger.addHandler(fileHandler)
+    try:
+        with _center_context(center):
+            uploaded = _center_input_to_staging(
+                syn, project_id, center, process,
+                only_validate, vcf2maf_path, vep_path,
+                vep_data, database_to_synid_mappingdf,
+                center_mapping_df, reference=reference,
+                delete_old=delete_old, oncotree_link=oncotree_link,
+                threads=threads, stage_limits=stage_limits,
+                validation_executor=validation_executor,
+                syn_login=syn_login)
+            if not uploaded:
+                os.remove(log_path)
+                return
+            # Store log file
+            log_folder_synid = process_functions.getDatabaseSynId(
+                syn, "logs",
+                databaseToSynIdMappingDf=database_to_synid_mappingdf)
+            fileHandler.flush()
+            syn.store(synapseclient.File(log_path,
+                                          parentId=log_folder_synid))
+            os.remove(log_path)
+            logger.info("ALL PROCESSES COMPLETE")
+    except Exception:
+        # Logged here, so the traceback is in the log of the center
+        with _center_context(center):
+            logger.exception(f"{center} failed")
+        raise
+    finally:
+        # Bed symbols are queried again by the next run of the center
+        bed.SYMBOL_RESOLVERS.clear(center)
+        logger.removeHandler(fileHandler)
+        fileHandler.close()
+
+
+def _center_input_to_staging(
+        syn, project_id, center, process,
+        only_validate, vcf2maf_path, vep_path,
+        vep_data, database_to_synid_mappingdf,
+        center_mapping_df, reference=None,
+        delete_old=False, oncotree_link=None, threads=1,
+        stage_limits=None, validation_executor="thread", syn_login=None):
+    '''
+    Validate and process the input files of a center
 
+    Returns:
+        bool: False if the center has not uploaded any files
+    '''
+    if stage_limits is None:
+        stage_limits = StageLimits()
     # ----------------------------------------
     # Start input to staging process
     # ----------------------------------------
@@ -814,19 +1319,29 @@ def center_input_to_database(
     center_input_synid = center_mapping_df['inputSynId'][
         center_mapping_df['center'] == center][0]
     logger.info("Center: " + center)
+    # Only the files that changed since they were last validated
+    # are downloaded
+    downloader = CenterFileDownloader(syn, workers=threads)
     center_files = get_center_input_files(syn, center_input_synid, center,
-                                          process)
+                                          process, downloadFile=False,
+                                          workers=threads)
 
     # only validate if there are center files
     if center_files:
-        validFiles = validation(syn, project_id, center, process, center_files,
-                                database_to_synid_mappingdf,
-                                oncotree_link, PROCESS_FILES)
+        with stage_limits.stage("validation"):
+            validFiles = validation(syn, project_id, center, process,
+                                    center_files,
+                                    database_to_synid_mappingdf,
+                                    oncotree_link, PROCESS_FILES,
+                                    threads=threads, downloader=downloader,
+                                    validation_executor=validation_executor,
+                                    syn_login=syn_login)
     else:
         logger.info("{} has not uploaded any files".format(center))
-        return
+        return False
 
     if len(validFiles) > 0 and not only_validate:
+        validFiles = download_valid_files(downloader, validFiles)
         # Reorganize so BED file are always validated and processed first
         bed_files = validFiles['fileType'] == "bed"
         beds = validFiles[bed_files]
@@ -871,13 +1386,14 @@ def center_input_to_database(
             syn.store(synapseclient.Table(
                 processTrackerSynId, processTrackerDf))
 
-        processfiles(syn, validFiles, center, path_to_genie,
-                     center_mapping_df, oncotree_link,
-                     database_to_synid_mappingdf,
-                     validVCF=validVCF,
-                     vcf2mafPath=vcf2maf_path,
-                     veppath=vep_path, vepdata=vep_data,
-                     processing=process, reference=reference)
+        with stage_limits.stage("processing"):
+            processfiles(syn, validFiles, center, path_to_genie,
+                         center_mapping_df, oncotree_link,
+                         database_to_synid_mappingdf,
+                         validVCF=validVCF,
+                         vcf2mafPath=vcf2maf_path,
+                         veppath=vep_path, vepdata=vep_data,
+                         processing=process, reference=reference)
 
         # Should add in this process end tracking
         # before the deletion of samples
@@ -892,17 +1408,98 @@ def center_input_to_database(
         syn.store(synapseclient.Table(processTrackerSynId, processTrackerDf))
 
         logger.info("SAMPLE/PATIENT RETRACTION")
-        toRetract.retract(syn, project_id=project_id)
+        # Retraction updates every center's rows
+        with stage_limits.stage("retraction"):
+            toRetract.retract(syn, project_id=project_id)
 
     else:
         messageOut = \
             "{} does not have any valid files" if not only_validate \
             else "ONLY VALIDATION OCCURED FOR {}"
         logger.info(messageOut.format(center))
+    return True
+
 
-    # Store log file
-    log_folder_synid = process_functions.getDatabaseSynId(
-        syn, "logs", databaseToSynIdMappingDf=database_to_synid_mappingdf)
-    syn.store(synapseclient.File(log_path, parentId=log_folder_synid))
-    os.remove(log_path)
-    logger.info("ALL PROCESSES COMPLETE")
+def centers_input_to_database(
+        syn, project_id, centers, process,
+        only_validate, vcf2maf_path, vep_path,
+        vep_data, database_to_synid_mappingdf,
+        center_mapping_df, reference=None,
+        delete_old=False, oncotree_link=None, threads=1,
+        center_workers=1, processing_workers=None,
+        validation_executor="thread", syn_login=None):
+    '''
+    Validate and process several centers in one process.  The mapping
+    tables, oncotree codes, gene positions and GTF feature store are
+    loaded once and shared by all centers.
+
+    Args:
+        syn: Synapse object
+        project_id: Synapse Project ID where data is stored
+        centers: List of center names
+        process: main, vcf, maf or mafSP
+        only_validate: Only validate the files, don't process
+        vcf2maf_path: Path to vcf2maf
+        vep_path: Path to VEP
+        vep_data: Path to VEP data
+        database_to_synid_mappingdf: Database to synapse id mapping
+        center_mapping_df: Center mapping dataframe
+        reference: Reference file for vcf2maf
+        delete_old: Delete old processed and temp files
+        oncotree_link: Link to oncotree
+        threads: Number of files of a center to validate at the same time
+        center_workers: Number of centers handled at the same time.
+                        Defaults to 1
+        processing_workers: Number of centers processing at the same time.
+                            Defaults to 1 for VEP processes, otherwise
+                            center_workers
+        validation_executor: Validate the files of a center in threads or
+                             processes. Defaults to thread
+        syn_login: Picklable function returning a logged in Synapse
+                   object, used by the process executor
+
+    Returns:
+        list: Centers that failed
+    '''
+    if processing_workers is None:
+        processing_workers = 1 if process in VEP_PROCESSES \
+            else center_workers
+    stage_limits = StageLimits(validation=center_workers,
+                               processing=processing_workers,
+                               retraction=1)
+    if len(centers) > 1:
+        # Load the shared resources once, before the centers race for them
+        if oncotree_link is not None:
+            process_functions.get_oncotree_code_mappings(oncotree_link)
+        bed.GENE_POSITIONS.load(syn)
+        if not only_validate and process == "main":
+            bed.load_feature_store(
+                bed.create_feature_store(process_functions.SCRIPT_DIR))
+
+    def _run_center(center):
+        try:
+            center_input_to_database(
+                syn, project_id, center, process,
+                only_validate, vcf2maf_path, vep_path,
+                vep_data, database_to_synid_mappingdf,
+                center_mapping_df, reference=reference,
+                delete_old=delete_old, oncotree_link=oncotree_link,
+                threads=threads, stage_limits=stage_limits,
+                validation_executor=validation_executor,
+                syn_login=syn_login)
+        except Exception:
+            # A failing center doesn't stop the others, its traceback is
+            # logged by center_input_to_database
+            return False
+        return True
+
+    if center_workers <= 1:
+        succeeded = [_run_center(center) for center in centers]
+    else:
+        logger.info(f"Handling {len(centers)} centers with "
+                    f"{center_workers} workers.")
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=center_workers) as executor:
+            succeeded = list(executor.map(_run_center, centers))
+    return [center for center, center_succeeded in zip(centers, succeeded)
+            if not center_succeeded]
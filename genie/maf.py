@@ -11,6 +11,7 @@ except ModuleNotFoundError:
 
 from .example_filetype_format import FileTypeFormat
 from . import process_functions
+from . import table_upload
 
 logger = logging.getLogger(__name__)
 
@@ -102,14 +103,9 @@ class maf(FileTypeFormat):
         logger.info('STORING %s' % filePath)
         database = self.syn.get(mafSynId)
         if isNarrow:
-            try:
-                update_table = synapseclient.Table(
-                    database.id, filePath, separator="\t")
-                self.syn.store(update_table)
-            except SynapseTimeoutError:
-                # This error occurs because of waiting for table to index.
-                # Don't worry about this.
-                pass
+            # Stored in chunks because of the 1 GB table update limit
+            table_upload.TableUploader(self.syn).store(
+                database.id, filePath, separator="\t")
         else:
             self.syn.store(
                 synapseclient.File(filePath, parentId=centerMafSynId))
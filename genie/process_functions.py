@@ -1,6 +1,8 @@
 import ast
 from Crypto.PublicKey import RSA
+import copy
 import datetime
+import hashlib
 import json
 import logging
 import os
@@ -8,10 +10,16 @@ import requests
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
 
+import numpy as np
 import pandas as pd
 import synapseclient
 
+from . import table_upload
+
 # try:
 #   from urllib.request import urlopen
 # except ImportError:
@@ -22,6 +30,14 @@ pd.options.mode.chained_assignment = None
 logger = logging.getLogger(__name__)
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+# Overrides the mapping cache directory in the Synapse client's cache
+MAPPING_CACHE_DIR = None
+# Seconds before a cached mapping table is checked against Synapse again
+MAPPING_CACHE_TTL = 3600
+# Overrides the oncotree snapshot directory in the Synapse client's cache
+ONCOTREE_CACHE_DIR = None
+# Seconds before an oncotree snapshot is refreshed
+ONCOTREE_CACHE_TTL = 24 * 3600
 
 
 # try:
@@ -153,9 +169,121 @@ def checkUrl(url):
     assert temp.status_code == 200, "%s site is down" % url
 
 
+class MappingTableCache(object):
+    """
+    Process wide cache of the GENIE mapping tables.  Tables are kept in
+    memory for ttl seconds.  After that the etag of the table's rows is
+    checked and the table is only queried again if there is no copy on
+    disk for that etag or the copy is older than ttl seconds.  Edits to a
+    table are therefore seen at most ttl seconds late.
+    """
+
+    def __init__(self, cache_dir=None, ttl=None):
+        """
+        Args:
+            cache_dir: Cache directory. Default is MAPPING_CACHE_DIR or
+                       genie_mapping_cache in the Synapse client's cache
+            ttl: Seconds a table is used without checking Synapse.
+                 Default is MAPPING_CACHE_TTL
+        """
+        self.cache_dir = cache_dir
+        self.ttl = MAPPING_CACHE_TTL if ttl is None else ttl
+        self._tables = {}
+        self._table_locks = {}
+        self._lock = threading.Lock()
+
+    def _table_lock(self, synid):
+        with self._lock:
+            return self._table_locks.setdefault(synid, threading.Lock())
+
+    @staticmethod
+    def _table_etag(syn, synid):
+        # The etag of the table entity doesn't change when rows are
+        # edited, the etag of a query result does
+        return syn.tableQuery("SELECT * FROM %s LIMIT 1" % synid,
+                              resultsAs="rowset").etag
+
+    def _resolve_cache_dir(self, syn):
+        if self.cache_dir is not None:
+            return self.cache_dir
+        if MAPPING_CACHE_DIR is not None:
+            return MAPPING_CACHE_DIR
+        return os.path.join(syn.cache.cache_root_dir, "genie_mapping_cache")
+
+    @staticmethod
+    def _entry_path(cache_dir, synid, etag):
+        return os.path.join(cache_dir, "{}_{}.pkl".format(synid, etag))
+
+    def _read_entry(self, entry_path):
+        try:
+            if time.time() - os.path.getmtime(entry_path) < self.ttl:
+                return pd.read_pickle(entry_path)
+        except Exception:
+            # Missing or unreadable entries are queried again
+            pass
+        return None
+
+    @staticmethod
+    def _write_entry(entry_path, table):
+        cache_dir = os.path.dirname(entry_path)
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file first so that concurrent runs never
+        # read a partial entry
+        temp_fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        os.close(temp_fd)
+        table.to_pickle(temp_path)
+        os.replace(temp_path, entry_path)
+
+    def get(self, syn, synid):
+        """
+        Get a mapping table
+
+        Args:
+            syn: Synapse object
+            synid: Synapse Id of synapse table
+
+        Returns:
+            df: Table dataframe
+        """
+        # Only calls for the same table wait on its query
+        with self._table_lock(synid):
+            with self._lock:
+                cached = self._tables.get(synid)
+            if cached is not None and time.time() - cached[0] < self.ttl:
+                return cached[1].copy()
+            etag = self._table_etag(syn, synid)
+            # Only tables with a real etag are persisted
+            entry_path = None
+            if isinstance(etag, str):
+                entry_path = self._entry_path(
+                    self._resolve_cache_dir(syn), synid, etag)
+            table = None
+            if entry_path is not None:
+                table = self._read_entry(entry_path)
+            if table is None:
+                table_ent = syn.tableQuery('SELECT * FROM %s' % synid)
+                table = table_ent.asDataFrame()
+                table = table.fillna("")
+                if entry_path is not None:
+                    self._write_entry(entry_path, table)
+            with self._lock:
+                self._tables[synid] = (time.time(), table)
+            return table.copy()
+
+    def clear(self):
+        """Forget the tables kept in memory"""
+        with self._lock:
+            self._tables.clear()
+
+
+MAPPING_CACHE = MappingTableCache()
+
+
 def getGenieMapping(syn, synId):
     """
-    This function gets the GENIE mapping tables
+    This function gets the GENIE mapping tables.  The tables are cached
+    in MAPPING_CACHE, so all files in a run share one query per table.
+    Edits to a table can take up to MAPPING_CACHE_TTL seconds to be seen.
 
     Args:
         synId: Synapse Id of synapse table
@@ -163,10 +291,7 @@ def getGenieMapping(syn, synId):
     Returns:
         df: Table dataframe
     """
-    table_ent = syn.tableQuery('SELECT * FROM %s' % synId)
-    table = table_ent.asDataFrame()
-    table = table.fillna("")
-    return(table)
+    return MAPPING_CACHE.get(syn, synId)
 
 
 def checkColExist(DF, key):
@@ -365,6 +490,26 @@ def checkGenieId(ID, center):
         return(str(ID))
 
 
+def format_genie_ids(ids, center):
+    '''
+    Vectorized version of checkGenieId
+
+    Args:
+        ids: pandas Series of ids
+        center: GENIE center
+
+    Return:
+        Series: Formatted GENIE ID strings
+    '''
+    ids = ids.astype(str)
+    center_prefix = "%s-" % center
+    genie_prefix = 'GENIE-%s-' % center
+    formatted = genie_prefix + ids
+    formatted[ids.str.startswith(center_prefix)] = "GENIE-" + ids
+    formatted[ids.str.startswith(genie_prefix)] = ids
+    return(formatted)
+
+
 def storeFile(
         syn, fileName, parentId,
         center, fileFormat, dataSubType,
@@ -590,6 +735,24 @@ def _append_rows(new_datasetdf, databasedf, checkby):
     return(appenddf)
 
 
+def _split_rowid_version(rowids):
+    '''
+    Split Synapse row names (ROW_ID_ROW_VERSION) into their parts
+
+    Args:
+        rowids: Synapse row names
+
+    Returns:
+        Dataframe: ROW_ID in column 0 and ROW_VERSION in column 1
+    '''
+    rowids = pd.Series(rowids, dtype=object)
+    rowid_version = pd.DataFrame({
+        0: rowids.str.split("_").str[0],
+        1: rowids.str.split("_").str[1]})
+    rowid_version.reset_index(drop=True, inplace=True)
+    return(rowid_version)
+
+
 def _delete_rows(new_datasetdf, databasedf, checkby):
     '''
     Compares the dataset from the database and determines which rows to
@@ -610,10 +773,7 @@ def _delete_rows(new_datasetdf, databasedf, checkby):
     deletedf = _get_left_diff_df(databasedf, new_datasetdf, checkby)
     if not deletedf.empty:
         logger.info("Deleting Rows")
-        delete_rowid_version = pd.DataFrame([[
-            rowid.split("_")[0], rowid.split("_")[1]]
-            for rowid in deletedf.index])
-        delete_rowid_version.reset_index(drop=True, inplace=True)
+        delete_rowid_version = _split_rowid_version(deletedf.index)
     else:
         delete_rowid_version = pd.DataFrame()
         logger.info("No deleted rows")
@@ -641,9 +801,8 @@ def _create_update_rowsdf(
         updating_databasedf.loc[differentrows] = updatesetdf.loc[differentrows]
         toupdatedf = updating_databasedf.loc[differentrows]
         logger.info("Updating rows")
-        rowid_version = pd.DataFrame([[
-            rowid.split("_")[0], rowid.split("_")[1]]
-            for rowid, row in zip(rowids, differentrows) if row])
+        rowid_version = _split_rowid_version(
+            np.asarray(rowids)[np.asarray(differentrows, dtype=bool)])
         toupdatedf['ROW_ID'] = rowid_version[0].values
         toupdatedf['ROW_VERSION'] = rowid_version[1].values
         toupdatedf.reset_index(drop=True, inplace=True)
@@ -653,6 +812,61 @@ def _create_update_rowsdf(
     return(toupdatedf)
 
 
+def _hash_comparable(left_col, right_col):
+    '''
+    Check if equal row hashes of two columns mean equal values.  This is
+    the case for numeric columns of the same type and columns that only
+    have strings.  Hashes of mixed object columns are computed from the
+    string value, so 1 and '1' would be seen as the same value.
+
+    Args:
+        left_col: Column
+        right_col: Column
+
+    Returns:
+        bool: True if the columns can be compared by their hashes
+    '''
+    if left_col.dtype != right_col.dtype:
+        return False
+    if left_col.dtype.kind in 'biuf':
+        return True
+    return left_col.dtype == object and \
+        pd.api.types.infer_dtype(left_col, skipna=False) == "string" and \
+        pd.api.types.infer_dtype(right_col, skipna=False) == "string"
+
+
+def _get_different_rows(updatesetdf, updating_databasedf):
+    '''
+    Vectorized version of (updatesetdf != updating_databasedf).any(axis=1).
+    Columns that can be compared by their hashes are compared with one
+    content hash per row, all other columns are compared value by value.
+
+    Args:
+        updatesetdf:  Update dataset dataframe
+        updating_databasedf: Update database dataframe with the same
+                             index and columns
+
+    Returns:
+        Series: True for rows that need to be updated
+    '''
+    hashed_cols = []
+    differentrows = np.zeros(len(updating_databasedf), dtype=bool)
+    for col in updating_databasedf.columns:
+        if _hash_comparable(updatesetdf[col], updating_databasedf[col]):
+            hashed_cols.append(col)
+        else:
+            differentrows |= np.asarray(
+                updatesetdf[col].values != updating_databasedf[col].values,
+                dtype=bool)
+    if hashed_cols:
+        update_hashes = pd.util.hash_pandas_object(
+            updatesetdf[hashed_cols], index=False)
+        database_hashes = pd.util.hash_pandas_object(
+            updating_databasedf[hashed_cols], index=False)
+        differentrows |= update_hashes.values != database_hashes.values
+    return pd.Series(differentrows, index=updating_databasedf.index)
+
+
 def _update_rows(new_datasetdf, databasedf, checkby):
     '''
     Compares the dataset from the database and determines which rows to
@@ -686,9 +900,7 @@ def _update_rows(new_datasetdf, databasedf, checkby):
     updatesetdf = updatesetdf[~updatesetdf.index.duplicated()]
     # Reorder dataset index
     updatesetdf = updatesetdf.loc[updating_databasedf.index]
-    # Index comparison
-    differences = updatesetdf != updating_databasedf
-    differentrows = differences.apply(sum, axis=1) > 0
+    differentrows = _get_different_rows(updatesetdf, updating_databasedf)
 
     toupdatedf = _create_update_rowsdf(
         updating_databasedf, updatesetdf, rowids, differentrows)
@@ -696,6 +908,94 @@ def _update_rows(new_datasetdf, databasedf, checkby):
     return(toupdatedf)
 
 
+def _diff_keys(new_keys, database_keys):
+    '''
+    Three way diff of the unique keys of the new dataset and the database.
+    The keys are factorized together once, so the rest of the diff
+    only works with integer codes.
+
+    Args:
+        new_keys: Unique keys of the new dataset
+        database_keys: Unique keys of the database
+
+    Returns:
+        tuple: boolean mask of new dataset rows to append,
+               boolean mask of database rows to delete,
+               positions of the database rows that exist in the new dataset,
+               positions of the first new dataset row with the same key
+    '''
+    codes, uniques = pd.factorize(
+        pd.concat([new_keys, database_keys], ignore_index=True))
+    new_codes = codes[:len(new_keys)]
+    database_codes = codes[len(new_keys):]
+
+    in_database = np.zeros(len(uniques), dtype=bool)
+    in_database[database_codes] = True
+    # Position of the first row in the new dataset for every key
+    first_new_position = np.full(len(uniques), -1, dtype=np.int64)
+    new_unique_codes, new_unique_positions = np.unique(
+        new_codes, return_index=True)
+    first_new_position[new_unique_codes] = new_unique_positions
+
+    append_mask = ~in_database[new_codes]
+    matched_positions = first_new_position[database_codes]
+    delete_mask = matched_positions == -1
+    database_positions = np.flatnonzero(~delete_mask)
+    return(append_mask, delete_mask,
+           database_positions, matched_positions[database_positions])
+
+
+def _diff_datasets(new_datasetdf, databasedf, checkby, to_delete=True):
+    '''
+    Determines the rows to append, update and delete in one pass.
+    Gives the same results as _append_rows, _update_rows and _delete_rows.
+    Both dataframes must already have their NA values filled in.
+
+    Args:
+        new_datasetdf: Input data dataframe
+        databasedf: Existing data dataframe
+        checkby: Column of values to compare
+        to_delete: Determine rows to delete, Defaults to True
+
+    Returns:
+        tuple: Dataframes of rows to append, rows to update and
+               rows to delete
+    '''
+    _check_valid_df(new_datasetdf, checkby)
+    _check_valid_df(databasedf, checkby)
+    append_mask, delete_mask, database_positions, new_positions = \
+        _diff_keys(new_datasetdf[checkby], databasedf[checkby])
+
+    appenddf = new_datasetdf[append_mask]
+    if not appenddf.empty:
+        logger.info("Adding Rows")
+    else:
+        logger.info("No new rows")
+    del appenddf[checkby]
+    appenddf.reset_index(drop=True, inplace=True)
+
+    updating_databasedf = databasedf.iloc[database_positions]
+    updatesetdf = new_datasetdf.iloc[new_positions]
+    rowids = updating_databasedf.index.values
+    updatesetdf.index = updating_databasedf[checkby].values
+    updating_databasedf.index = updating_databasedf[checkby].values
+    del updatesetdf[checkby]
+    del updating_databasedf[checkby]
+    differentrows = _get_different_rows(updatesetdf, updating_databasedf)
+    toupdatedf = _create_update_rowsdf(
+        updating_databasedf, updatesetdf, rowids, differentrows)
+
+    if not to_delete:
+        deletedf = pd.DataFrame()
+    elif delete_mask.any():
+        logger.info("Deleting Rows")
+        deletedf = _split_rowid_version(databasedf.index[delete_mask])
+    else:
+        deletedf = pd.DataFrame()
+        logger.info("No deleted rows")
+    return(appenddf, toupdatedf, deletedf)
+
+
 def updateData(
         syn, databaseSynId, newData,
         filterBy, filterByColumn="CENTER",
@@ -714,6 +1014,27 @@ def updateData(
         databaseEnt.primaryKey, toDelete)
 
 
+def _build_unique_key(df, primary_key_cols):
+    '''
+    Convert the primary key columns to strings in place and join them
+    with spaces into one key
+
+    Args:
+        df: Dataframe
+        primary_key_cols: Column(s) that make up the unique key
+
+    Returns:
+        Series: unique key of each row
+    '''
+    for col in primary_key_cols:
+        df[col] = df[col].astype(str)
+    first_col = df[primary_key_cols[0]]
+    if len(primary_key_cols) == 1:
+        return first_col.copy()
+    return first_col.str.cat([df[col] for col in primary_key_cols[1:]],
+                             sep=" ")
+
+
 def updateDatabase(
         syn, database, new_dataset, database_synid,
         primary_key_cols, to_delete=False):
@@ -740,21 +1061,13 @@ def updateDatabase(
     new_dataset = new_dataset.fillna("")
     # Columns must be in the same order
     new_dataset = new_dataset[orig_database_cols]
-    database[primary_key_cols] = database[primary_key_cols].applymap(str)
-    database[primary_key] = database[
-        primary_key_cols].apply(lambda x: ' '.join(x), axis=1)
-
-    new_dataset[primary_key_cols] = new_dataset[primary_key_cols].applymap(str)
-    new_dataset[primary_key] = new_dataset[
-        primary_key_cols].apply(lambda x: ' '.join(x), axis=1)
+    database[primary_key] = _build_unique_key(database, primary_key_cols)
+    new_dataset[primary_key] = _build_unique_key(new_dataset,
+                                                 primary_key_cols)
 
     allupdates = pd.DataFrame(columns=col_order)
-    to_append_rows = _append_rows(new_dataset, database, primary_key)
-    to_update_rows = _update_rows(new_dataset, database, primary_key)
-    if to_delete:
-        to_delete_rows = _delete_rows(new_dataset, database, primary_key)
-    else:
-        to_delete_rows = pd.DataFrame()
+    to_append_rows, to_update_rows, to_delete_rows = _diff_datasets(
+        new_dataset, database, primary_key, to_delete=to_delete)
     allupdates = allupdates.append(to_append_rows, sort=False)
     allupdates = allupdates.append(to_update_rows, sort=False)
 
@@ -785,7 +1098,8 @@ def updateDatabase(
                 .replace(".0\n", "\n"))
             storedatabase = True
     if storedatabase:
-        syn.store(synapseclient.Table(database_synid, update_all_file.name))
+        table_upload.TableUploader(syn).store(
+            database_synid, update_all_file.name)
     # Delete the update file
     os.unlink(update_all_file.name)
 
@@ -807,6 +1121,29 @@ def checkInt(element):
         return(False)
 
 
+def coerce_int(values):
+    '''
+    Vectorized version of converting every value that passes checkInt
+    to an integer.  All other values are kept as is.
+
+    Args:
+        values: pandas Series
+
+    Returns:
+        Series: int64 if every value is an integer, otherwise the
+                integer values are replaced in an object Series
+    '''
+    numeric = pd.to_numeric(values, errors='coerce').astype(float)
+    integers = np.isfinite(numeric) & (np.floor(numeric) == numeric)
+    if integers.all():
+        return(numeric.astype(np.int64))
+    if not integers.any():
+        return(values)
+    coerced = values.astype(object)
+    coerced[integers] = numeric[integers].astype(np.int64).tolist()
+    return(coerced.infer_objects())
+
+
 def check_col_and_values(df, col, possible_values, filename, na_allowed=False,
                          required=False, sep=None):
     '''
@@ -891,19 +1228,170 @@ def extract_oncotree_code_mappings_from_oncotree_json(
     return oncotree_code_to_info
 
 
+class OncotreeCache(object):
+    """
+    Process wide cache of oncotree code mappings.  The oncotree json of
+    every url is stored as a snapshot on disk and each url is only walked
+    once per process.  Snapshots older than ttl seconds are refreshed,
+    a stale snapshot is used when oncotree can't be reached.  In offline
+    mode only snapshots are used, no matter how old they are.
+    """
+
+    def __init__(self, cache_dir=None, ttl=None, offline=False):
+        """
+        Args:
+            cache_dir: Snapshot directory. Default is ONCOTREE_CACHE_DIR or
+                       oncotree_cache in the Synapse client's cache
+            ttl: Seconds before a snapshot is refreshed.
+                 Default is ONCOTREE_CACHE_TTL
+            offline: Never request oncotree. Default is False
+        """
+        self._cache_dir = cache_dir
+        # Oncotree urls are fetched without a Synapse client, so the
+        # client's cache root is set with use_synapse_cache
+        self._cache_root_dir = os.path.expanduser("~/.synapseCache")
+        self.ttl = ONCOTREE_CACHE_TTL if ttl is None else ttl
+        self.offline = offline
+        self._mappings = {}
+        self._lock = threading.Lock()
+
+    @property
+    def cache_dir(self):
+        """Snapshot directory"""
+        if self._cache_dir is not None:
+            return self._cache_dir
+        if ONCOTREE_CACHE_DIR is not None:
+            return ONCOTREE_CACHE_DIR
+        return os.path.join(self._cache_root_dir, "oncotree_cache")
+
+    def use_synapse_cache(self, syn):
+        """
+        Keep the snapshots in the Synapse client's cache
+
+        Args:
+            syn: Synapse object
+        """
+        self._cache_root_dir = syn.cache.cache_root_dir
+
+    def snapshot_path(self, url):
+        """
+        Snapshots are named after the oncotree version in the url and
+        a hash of the url
+
+        Args:
+            url: Oncotree tumor types url
+
+        Returns:
+            str: Path to snapshot
+        """
+        version = parse_qs(urlparse(url).query).get("version", ["latest"])
+        url_hash = hashlib.sha1(url.encode("utf-8")).hexdigest()[:12]
+        return os.path.join(self.cache_dir, "{}_{}.json".format(
+            version[0], url_hash))
+
+    def _read_snapshot(self, url):
+        try:
+            with open(self.snapshot_path(url), "r") as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        except (OSError, ValueError):
+            return None
+        if snapshot.get("url") != url:
+            return None
+        return snapshot
+
+    def _write_snapshot(self, url, tissue):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        snapshot = {"url": url, "fetched": time.time(), "TISSUE": tissue}
+        # Write to a temporary file first so that concurrent runs never
+        # read a partial snapshot
+        temp_fd, temp_path = tempfile.mkstemp(dir=self.cache_dir,
+                                              suffix=".tmp")
+        with os.fdopen(temp_fd, "w") as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+        os.replace(temp_path, self.snapshot_path(url))
+
+    def _fetch(self, url):
+        response = retry_get_url(url)
+        assert response.status_code == 200, "%s site is down" % url
+        return json.loads(response.text)['TISSUE']
+
+    def _load_tissue(self, url):
+        snapshot = self._read_snapshot(url)
+        if self.offline:
+            if snapshot is None:
+                raise ValueError(
+                    "No oncotree snapshot for {} in {}".format(
+                        url, self.cache_dir))
+            return snapshot['TISSUE']
+        if snapshot is not None and \
+                time.time() - snapshot['fetched'] < self.ttl:
+            return snapshot['TISSUE']
+        try:
+            tissue = self._fetch(url)
+        except (AssertionError, requests.exceptions.RequestException,
+                ValueError, KeyError):
+            if snapshot is None:
+                raise
+            logger.warning(
+                "Can't reach {}, using the snapshot from {}".format(
+                    url, datetime.datetime.fromtimestamp(
+                        snapshot['fetched'])))
+            return snapshot['TISSUE']
+        self._write_snapshot(url, tissue)
+        return tissue
+
+    def get(self, url):
+        """
+        Get the oncotree code mappings of an oncotree url
+
+        Args:
+            url: Oncotree tumor types url
+
+        Returns:
+            dict: Oncotree code to its cancer type, detailed cancer type,
+                  primary and secondary node
+        """
+        with self._lock:
+            cached = self._mappings.get(url)
+            if cached is None or \
+                    (not self.offline and
+                     time.time() - cached[0] >= self.ttl):
+                tissue = self._load_tissue(url)
+                mappings = extract_oncotree_code_mappings_from_oncotree_json(
+                    tissue, '', '')
+                cached = (time.time(), mappings)
+                self._mappings[url] = cached
+        # Callers add codes to the mappings
+        return copy.deepcopy(cached[1])
+
+    def clear(self):
+        """Forget the mappings kept in memory"""
+        with self._lock:
+            self._mappings.clear()
+
+
+ONCOTREE_CACHE = OncotreeCache()
+
+
 def get_oncotree_code_mappings(oncotree_tumortype_api_endpoint_url):
     '''
     CREATE ONCOTREE DICTIONARY MAPPING TO PRIMARY, SECONDARY,
     CANCER TYPE, AND CANCER DESCRIPTION
+
+    The mappings are cached in ONCOTREE_CACHE
+    '''
+    return ONCOTREE_CACHE.get(oncotree_tumortype_api_endpoint_url)
+
+
+def check_oncotree_link(oncotree_link):
+    '''
+    Check that the oncotree codes of a link can be loaded, either from
+    oncotree or from a snapshot, and keep them in ONCOTREE_CACHE
+
+    Args:
+        oncotree_link: Oncotree tumor types url
     '''
-    # oncotree_raw_response = urlopen(oncotree_tumortype_api_endpoint_url).text
-    # with requests.get(oncotree_tumortype_api_endpoint_url) as oncotreeUrl:
-    oncotreeUrl = retry_get_url(oncotree_tumortype_api_endpoint_url)
-    oncotree_raw_response = oncotreeUrl.text
-    oncotree_response = json.loads(oncotree_raw_response)
-    oncotree_response = oncotree_response['TISSUE']
-    return extract_oncotree_code_mappings_from_oncotree_json(
-        oncotree_response, '', '')
+    get_oncotree_code_mappings(oncotree_link)
 
 
 # Get mapping code #Add USE DESCRIPTION sampletypedetailed -> public
@@ -918,6 +1406,62 @@ def getCODE(mapping, key, useDescription=False):
         return("")
 
 
+class CodeMapper(object):
+    """
+    Compiled version of getCODE.  The mapping table is turned into
+    dictionaries once, so each code is looked up in constant time.
+
+    Args:
+        mapping: GENIE mapping table with CODE, CBIO_LABEL and
+                 optionally DESCRIPTION columns
+    """
+
+    def __init__(self, mapping):
+        self._labels = self._first_values(mapping, 'CBIO_LABEL')
+        self._descriptions = self._first_values(mapping, 'DESCRIPTION') \
+            if 'DESCRIPTION' in mapping.columns else {}
+
+    @staticmethod
+    def _first_values(mapping, column):
+        # getCODE returns the first matching row
+        values = {}
+        for code, value in zip(mapping['CODE'], mapping[column]):
+            values.setdefault(code, value)
+        return values
+
+    def get_code(self, key, useDescription=False):
+        """
+        Same as getCODE(mapping, key, useDescription)
+
+        Args:
+            key: Code to look up
+            useDescription: Return DESCRIPTION instead of CBIO_LABEL
+
+        Returns:
+            Mapped value, "" if the code doesn't exist
+        """
+        values = self._descriptions if useDescription else self._labels
+        try:
+            return values.get(key, "")
+        except TypeError:
+            # Unhashable keys can't match a code
+            return ""
+
+    def map(self, col, useDescription=False):
+        """
+        Map a column of codes
+
+        Args:
+            col: pandas Series of codes
+            useDescription: Map to DESCRIPTION instead of CBIO_LABEL
+
+        Returns:
+            pandas Series of mapped values, "" for unknown codes
+        """
+        return col.map(
+            lambda key: self.get_code(key, useDescription=useDescription))
+
+
 def getPrimary(code, oncotreeDict, primary):
     if code != "":
         for level in oncotreeDict:
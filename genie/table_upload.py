@@ -0,0 +1,401 @@
+'''
+Batched uploads of table changes to Synapse.
+
+A single table transaction can only be 1 GB, so large change sets
+(appends, updates and deletes written out as a csv) are split into
+chunks that each repeat the header and are stored one transaction
+at a time.
+'''
+import concurrent.futures
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+import types
+
+import pandas as pd
+import requests
+try:
+    from synapseclient.core.exceptions import (SynapseError,
+                                               SynapseHTTPError)
+except ModuleNotFoundError:
+    from synapseclient.exceptions import SynapseError, SynapseHTTPError
+
+logger = logging.getLogger(__name__)
+
+# Stay well below the 1 GB table update limit
+MAX_UPLOAD_BYTES = 900 * 1000000
+TRANSACTION_URI = "/entity/{}/table/transaction/async"
+UPLOAD_TO_TABLE_REQUEST = \
+    "org.sagebionetworks.repo.model.table.UploadToTableRequest"
+
+
+def is_retryable(ex):
+    '''
+    Whether a failed Synapse call can be retried: connection errors and
+    HTTP 429 or 5xx responses.  Other HTTP errors, such as a bad request
+    or a missing entity, fail the same way every time.
+
+    Args:
+        ex: Exception raised by the call
+
+    Returns:
+        bool
+    '''
+    if isinstance(ex, requests.exceptions.ConnectionError):
+        return True
+    if isinstance(ex, SynapseHTTPError):
+        status = getattr(ex.response, 'status_code', None)
+        if status is None:
+            # The message of an error without a response starts with
+            # the status code
+            match = re.match(r"(\d{3}) ", str(ex))
+            status = int(match.group(1)) if match else None
+        return status is not None and (status == 429 or status >= 500)
+    return False
+
+
+def _read_records(table_file):
+    '''
+    Read the records of a delimited file.  A record can span multiple
+    lines when a quoted value contains a newline.
+
+    Args:
+        table_file: File opened in binary mode
+
+    Yields:
+        bytes: One record, including the line ending
+    '''
+    record = b''
+    in_quotes = False
+    for line in table_file:
+        record += line
+        # Escaped quotes are doubled, so an odd count toggles quoting
+        if line.count(b'"') % 2:
+            in_quotes = not in_quotes
+        if not in_quotes:
+            yield record
+            record = b''
+    if record:
+        yield record
+
+
+def split_table_file(path, dirname, max_bytes=MAX_UPLOAD_BYTES,
+                     max_rows=None):
+    '''
+    Split a delimited file with a header into chunks that are each at
+    most max_bytes big and have at most max_rows rows.  A chunk always
+    has at least one row.
+
+    Args:
+        path: Path to delimited file
+        dirname: Directory to write chunks to
+        max_bytes: Maximum size of a chunk in bytes
+        max_rows: Maximum number of rows in a chunk. Defaults to no limit
+
+    Returns:
+        list: Paths to the chunks
+    '''
+    chunk_paths = []
+    chunk = None
+    basename, ext = os.path.splitext(os.path.basename(path))
+    with open(path, 'rb') as table_file:
+        records = _read_records(table_file)
+        header = next(records, b'')
+        for record in records:
+            if chunk is None or \
+                    chunk_size + len(record) > max_bytes or \
+                    (max_rows is not None and chunk_rows >= max_rows):
+                if chunk is not None:
+                    chunk.close()
+                chunk_path = os.path.join(
+                    dirname,
+                    "{}_{}{}".format(basename, len(chunk_paths), ext))
+                chunk_paths.append(chunk_path)
+                chunk = open(chunk_path, 'wb')
+                chunk.write(header)
+                chunk_size = len(header)
+                chunk_rows = 0
+            chunk.write(record)
+            chunk_size += len(record)
+            chunk_rows += 1
+    if chunk is not None:
+        chunk.close()
+    return(chunk_paths)
+
+
+class TableUploader(object):
+    '''
+    Stores a table change set in chunks.  Every chunk is its own table
+    transaction and is retried on its own.
+
+    Only calls that can't change the table are retried freely.  Once
+    the transaction of a chunk is started, its job is polled until it
+    completes or fails and the chunk is never sent again.  If starting
+    the transaction fails in a way that could still have started it,
+    the chunk is only sent again if the table hasn't changed since.
+
+    Args:
+        syn: Synapse object
+        max_bytes: Maximum size of a chunk in bytes
+        max_rows: Maximum number of rows in a chunk. Defaults to no limit
+        workers: Number of chunks to upload at the same time. Defaults to 1
+        retries: Number of times a call is retried. Defaults to 3
+        retry_wait: Seconds to wait before the first retry, doubles
+                    every retry. Defaults to 5
+        poll_wait: Maximum seconds between polls of a transaction.
+                   Defaults to 30
+    '''
+    def __init__(self, syn, max_bytes=MAX_UPLOAD_BYTES, max_rows=None,
+                 workers=1, retries=3, retry_wait=5, poll_wait=30):
+        self.syn = syn
+        self.max_bytes = max_bytes
+        self.max_rows = max_rows
+        self.workers = workers
+        self.retries = retries
+        self.retry_wait = retry_wait
+        self.poll_wait = poll_wait
+
+    def _needs_split(self, path):
+        if os.path.getsize(path) > self.max_bytes:
+            return True
+        if self.max_rows is None:
+            return False
+        with open(path, 'rb') as table_file:
+            # Header + max_rows rows
+            for nrecords, _ in enumerate(_read_records(table_file)):
+                if nrecords > self.max_rows:
+                    return True
+        return False
+
+    def _retry(self, func, description):
+        '''
+        Call func, retrying connection and server errors.  Only used for
+        calls that can't change the table.
+
+        Args:
+            func: Function without arguments
+            description: What func does, for the log
+
+        Returns:
+            The return value of func
+        '''
+        for attempt in range(self.retries + 1):
+            try:
+                return func()
+            except Exception as ex:
+                if not is_retryable(ex) or attempt == self.retries:
+                    raise
+                wait = self.retry_wait * 2 ** attempt
+                logger.warning("{} failed ({}), retrying in {}s".format(
+                    description, ex, wait))
+                time.sleep(wait)
+
+    def _table_etag(self, table_synid):
+        '''Etag of the last change to a table'''
+        return self._retry(
+            lambda: self.syn.tableQuery(
+                "SELECT * FROM {} LIMIT 1".format(table_synid),
+                resultsAs="rowset").etag,
+            "Querying {}".format(table_synid))
+
+    def _start_transaction(self, table_synid, file_handle_id, separator):
+        '''
+        Start the table transaction that stores an uploaded chunk
+
+        Returns:
+            str: Token of the transaction job
+        '''
+        request = {'changes': [{
+            'concreteType': UPLOAD_TO_TABLE_REQUEST,
+            'tableId': table_synid,
+            'uploadFileHandleId': file_handle_id,
+            'linesToSkip': 0,
+            'csvTableDescriptor': {'isFirstLineHeader': True,
+                                   'quoteCharacter': '"',
+                                   'escapeCharacter': "\\",
+                                   'lineEnd': os.linesep,
+                                   'separator': separator}}]}
+        job = self.syn.restPOST(
+            TRANSACTION_URI.format(table_synid) + "/start",
+            body=json.dumps(request))
+        return job['token']
+
+    def _wait_for_transaction(self, table_synid, token):
+        '''
+        Poll a transaction job until it is done.  The transaction is
+        atomic, so a failed job didn't store any rows.
+
+        Returns:
+            dict: Transaction response
+        '''
+        uri = TRANSACTION_URI.format(table_synid) + "/get/" + token
+        wait = 1
+        while True:
+            result = self._retry(lambda: self.syn.restGET(uri),
+                                 "Polling {}".format(table_synid))
+            state = result.get('jobState')
+            if state == 'PROCESSING':
+                time.sleep(wait)
+                wait = min(wait * 2, self.poll_wait)
+            elif state == 'FAILED':
+                raise SynapseError("Storing to {} failed: {}".format(
+                    table_synid, result.get('errorMessage')))
+            else:
+                return result
+
+    def _store_chunk(self, table_synid, path, separator):
+        '''
+        Store one chunk
+
+        Args:
+            table_synid: Synapse id of the table
+            path: Path to the chunk
+            separator: Delimiter of the chunk
+        '''
+        name = os.path.basename(path)
+        file_handle = self._retry(
+            lambda: self.syn.uploadFileHandle(path, table_synid,
+                                              mimetype="text/csv"),
+            "Uploading {}".format(name))
+        for attempt in range(self.retries + 1):
+            etag = self._table_etag(table_synid)
+            try:
+                token = self._start_transaction(
+                    table_synid, file_handle['id'], separator)
+            except Exception as ex:
+                if not is_retryable(ex) or attempt == self.retries:
+                    raise
+                wait = self.retry_wait * 2 ** attempt
+                logger.warning(
+                    "Storing {} failed ({}), checking {} in {}s".format(
+                        name, ex, table_synid, wait))
+                time.sleep(wait)
+                # The transaction may have been started before the error
+                if self._table_etag(table_synid) != etag:
+                    raise SynapseError(
+                        "Storing {} failed and {} changed since, the chunk "
+                        "may already be stored and is not sent again: "
+                        "{}".format(name, table_synid, ex))
+                continue
+            self._wait_for_transaction(table_synid, token)
+            return
+
+    def store(self, table_synid, path, separator=","):
+        '''
+        Store a delimited file of table changes
+
+        Args:
+            table_synid: Synapse id of the table
+            path: Path to delimited file with a header
+            separator: Delimiter of the file. Defaults to ","
+
+        Returns:
+            int: Number of chunks stored
+        '''
+        if not self._needs_split(path):
+            self._store_chunk(table_synid, path, separator)
+            return 1
+        chunk_dir = tempfile.mkdtemp(dir=os.path.dirname(path) or None)
+        try:
+            chunk_paths = split_table_file(
+                path, chunk_dir, max_bytes=self.max_bytes,
+                max_rows=self.max_rows)
+            logger.info("Storing {} in {} chunks".format(
+                table_synid, len(chunk_paths)))
+            if self.workers > 1:
+                with concurrent.futures.ThreadPoolExecutor(
+                        max_workers=self.workers) as executor:
+                    futures = [
+                        executor.submit(self._store_chunk, table_synid,
+                                        chunk_path, separator)
+                        for chunk_path in chunk_paths]
+                    for future in futures:
+                        future.result()
+            else:
+                for chunk_path in chunk_paths:
+                    self._store_chunk(table_synid, chunk_path, separator)
+        finally:
+            shutil.rmtree(chunk_dir)
+        return len(chunk_paths)
+
+
+class LocalTableClient(object):
+    '''
+    Stand-in for the Synapse client that keeps stored table changes in
+    memory, so uploads can be run and tested offline.  Transactions are
+    done as soon as they are started.
+
+    Args:
+        fail_times: Number of times starting a transaction raises an HTTP
+                    error before it succeeds. Defaults to 0
+        fail_after_start: Raise the errors after the transaction is
+                          stored instead of before. Defaults to False
+        status_code: Status code of the errors. Defaults to 503
+    '''
+    def __init__(self, fail_times=0, fail_after_start=False,
+                 status_code=503):
+        self.fail_times = fail_times
+        self.fail_after_start = fail_after_start
+        self.status_code = status_code
+        self.tables = {}
+        self.etags = {}
+        self._file_handles = {}
+        self._jobs = {}
+
+    def _fail(self):
+        if self.fail_times > 0:
+            self.fail_times -= 1
+            raise SynapseHTTPError("{} Error: Local failure".format(
+                self.status_code))
+
+    def uploadFileHandle(self, path, parent, mimetype=None):
+        file_handle_id = str(len(self._file_handles) + 1)
+        with open(path, 'rb') as upload_file:
+            self._file_handles[file_handle_id] = upload_file.read()
+        return {'id': file_handle_id}
+
+    def restPOST(self, uri, body):
+        if not self.fail_after_start:
+            self._fail()
+        for change in json.loads(body)['changes']:
+            table_synid = change['tableId']
+            changes = pd.read_csv(
+                io.BytesIO(self._file_handles[change['uploadFileHandleId']]),
+                sep=change['csvTableDescriptor']['separator'],
+                dtype=str, na_filter=False)
+            self.tables.setdefault(table_synid, []).append(changes)
+            self.etags[table_synid] = str(len(self.tables[table_synid]))
+        token = str(len(self._jobs) + 1)
+        self._jobs[token] = {'results': [
+            {'concreteType': "org.sagebionetworks.repo.model.table."
+                             "UploadToTableResult"}]}
+        if self.fail_after_start:
+            self._fail()
+        return {'token': token}
+
+    def restGET(self, uri):
+        return self._jobs[uri.rsplit("/", 1)[1]]
+
+    def tableQuery(self, query, resultsAs="csv"):
+        table_synid = re.search(r"FROM (\S+)", query).group(1)
+        # Only the etag of the results is used
+        return types.SimpleNamespace(etag=self.etags.get(table_synid))
+
+    def changes(self, table_synid):
+        '''
+        Get all changes stored to a table
+
+        Args:
+            table_synid: Synapse id of the table
+
+        Returns:
+            Dataframe: All stored rows in the order they were stored
+        '''
+        if table_synid not in self.tables:
+            return pd.DataFrame()
+        return pd.concat(self.tables[table_synid], ignore_index=True)
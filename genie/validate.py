@@ -273,6 +273,9 @@ def _perform_validate(syn, args):
 
     args.oncotree_link = _get_oncotreelink(syn, databasetosynid_mappingdf,
                                            oncotree_link=args.oncotree_link)
+    process_functions.ONCOTREE_CACHE.use_synapse_cache(syn)
+    process_functions.ONCOTREE_CACHE.offline = getattr(
+        args, "oncotree_offline", False)
 
     format_registry = collect_format_types(args.format_registry_packages)
     logger.debug("Using {} file formats.".format(format_registry))
@@ -136,20 +136,12 @@ class vcf(maf):
             col['name'] for col in self.syn.getTableColumns(mafSynId)
             if col['name'] != 'inBED']
 
-        narrowMafPaths = [narrowMafPath]
         for mafFile in mafFiles:
             mafDf = pd.read_csv(mafFile, sep="\t", comment="#")
             mafDf.drop_duplicates(inplace=True)
             mafDf = self.formatMAF(mafDf)
             self.createFinalMaf(mafDf, newMafPath)
             narrowMafDf = mafDf[narrowMafColumns]
-            maf_statinfo = os.stat(narrowMafPath)
-            # This is done because of the table update size limit.
-            # Can only update 1 GB at a time
-            if maf_statinfo.st_size / 1000000 > 900:
-                narrowMafPath = narrowMafPath.replace(
-                    ".txt", str(len(narrowMafPaths)) + ".txt")
-                narrowMafPaths.append(narrowMafPath)
             self.createFinalMaf(narrowMafDf, narrowMafPath)
 
         if len(mafFiles) > 0:
@@ -158,11 +150,10 @@ class vcf(maf):
             # Store MAF flat file into synapse
             # First because of 1 GB limit
             self.storeProcessedMaf(newMafPath, mafSynId, centerMafSynId)
-            # Store Narrow MAF into db
-            # Need to figure out how to fix this 1 GB limit
-            for narrow_path in narrowMafPaths:
-                self.storeProcessedMaf(
-                    narrow_path, mafSynId, centerMafSynId, isNarrow=True)
+            # Store Narrow MAF into db, this is split into table updates
+            # below the 1 GB limit
+            self.storeProcessedMaf(
+                narrowMafPath, mafSynId, centerMafSynId, isNarrow=True)
 
         return newMafPath
 
@@ -0,0 +1,13 @@
+"""Fixtures shared by the tests"""
+from mock import patch
+import pytest
+
+from genie.bed import SymbolResolverCache
+
+
+@pytest.fixture(autouse=True)
+def symbol_resolvers():
+    """Every test queries the bed symbols"""
+    with patch("genie.bed.SYMBOL_RESOLVERS", SymbolResolverCache()) as \
+            resolvers:
+        yield resolvers
@@ -1,6 +1,8 @@
 """Test GENIE Bed class"""
+import os
+import subprocess
 import tempfile
-import shutil
+import threading
 import mock
 from mock import patch
 import pytest
@@ -13,19 +15,13 @@ import genie.bed
 from genie.bed import bed
 from genie.bedSP import bedSP
 
-if not shutil.which('bedtools'):
-    pytest.skip("bedtools is not found, skipping bed tests", 
-                allow_module_level=True)
-
 GENE_GTF_TEXT = '2\tprotein_coding\tgene\t69688532\t69901481\t.\t-\t.\tgene_id "ENSG00000115977"; gene_name "AAK1"; gene_source "ensembl_havana"; gene_biotype "protein_coding";\n9\tprotein_coding\tgene\t99401859\t99417585\t.\t-\t.\tgene_id "ENSG00000158122"; gene_name "AAED1"; gene_source "ensembl_havana"; gene_biotype "protein_coding";\n12\tprotein_coding\tgene\t53701240\t53718648\t.\t-\t.\tgene_id "ENSG00000094914"; gene_name "AAAS"; gene_source "ensembl_havana"; gene_biotype "protein_coding";\n19\tprotein_coding\tgene\t44047192\t44084625\t.\t-\t.\tgene_id "ENSG00000073050"; gene_name "XRCC1"; gene_source "ensembl_havana"; gene_biotype "protein_coding";\n19\tprotein_coding\tgene\t44080952\t44088116\t.\t+\t.\tgene_id "ENSG00000234465"; gene_name "PINLYP"; gene_source "ensembl_havana"; gene_biotype "protein_coding";'
 EXON_GTF_TEXT = '2\tprocessed_transcript\texon\t69688432\t69689532\t.\t-\t.\tgene_id "ENSG00000115977"; transcript_id "ENST00000492192"; exon_number "2"; gene_name "AAK1"; gene_source "ensembl_havana"; gene_biotype "protein_coding"; transcript_name "AAK1-009"; transcript_source "havana"; exon_id "ENSE00001882560";\n9\tprotein_coding\texon\t99416987\t99417030\t.\t-\t.\tgene_id "ENSG00000158122"; transcript_id "ENST00000411939"; exon_number "1"; gene_name "AAED1"; gene_source "ensembl_havana"; gene_biotype "protein_coding"; transcript_name "AAED1-003"; transcript_source "havana"; exon_id "ENSE00001768346"; tag "cds_start_NF"; tag "mRNA_start_NF";\n12\tretained_intron\texon\t53702509\t53702599\t.\t-\t.\tgene_id "ENSG00000094914"; transcript_id "ENST00000550033"; exon_number "4"; gene_name "AAAS"; gene_source "ensembl_havana"; gene_biotype "protein_coding"; transcript_name "AAAS-019"; transcript_source "havana"; exon_id "ENSE00003694270";\n19\tprotein_coding\texon\t44084517\t44084625\t.\t-\t.\tgene_id "ENSG00000073050"; transcript_id "ENST00000598165"; exon_number "1"; gene_name "XRCC1"; gene_source "ensembl_havana"; gene_biotype "protein_coding"; transcript_name "XRCC1-008"; transcript_source "havana"; exon_id "ENSE00003137784"; tag "cds_end_NF"; tag "mRNA_end_NF";\n19\tprotein_coding\texon\t44084696\t44084739\t.\t+\t.\tgene_id "ENSG00000234465"; transcript_id "ENST00000562255"; exon_number "1"; gene_name "PINLYP"; gene_source "ensembl_havana"; gene_biotype "protein_coding"; transcript_name "PINLYP-001"; transcript_source "havana"; tag "CCDS"; ccds_id "CCDS58667"; exon_id "ENSE00002599477";'
-GENE_TEMP = tempfile.NamedTemporaryFile()
-EXON_TEMP = tempfile.NamedTemporaryFile()
-
-with open(GENE_TEMP.name, "w") as gene:
-    gene.write(GENE_GTF_TEXT)
-with open(EXON_TEMP.name, "w") as exon:
-    exon.write(EXON_GTF_TEXT)
+GTF_TEMP = tempfile.NamedTemporaryFile()
+with open(GTF_TEMP.name, "w") as gtf:
+    gtf.write(GENE_GTF_TEXT + "\n" + EXON_GTF_TEXT)
+FEATURE_STORE = tempfile.TemporaryDirectory()
+genie.bed.build_feature_store(GTF_TEMP.name, FEATURE_STORE.name)
 
 def create_mock_table(dataframe):
     table = mock.create_autospec(synapseclient.table.CsvFileTable)
@@ -81,8 +77,8 @@ def test_perfect___process():
         3: ['AAK1', 'AAED1', 'AAAS', 'XRCC1', 'foo'],
         4: [True, True, True, 1, 1],
         5: [True, True, False, 0, 1]})
-    with patch.object(genie.bed, "create_gtf",
-                      return_value=(EXON_TEMP.name, GENE_TEMP.name)):
+    with patch.object(genie.bed, "create_feature_store",
+                      return_value=FEATURE_STORE.name):
         new_beddf = bed_class._process(
             beddf, seq_assay_id, new_path, parentid, create_panel=False)
         new_beddf.sort_values("ID", inplace=True)
@@ -121,8 +117,8 @@ def test_includeinpanel___process():
         2: [69689532, 1111, 53719548, 44084624],
         3: ['foo', 'bar', 'baz', 'boo'],
         4: [True, True, 0, 1]})
-    with patch.object(genie.bed, "create_gtf",
-                      return_value=(EXON_TEMP.name, GENE_TEMP.name)):
+    with patch.object(genie.bed, "create_feature_store",
+                      return_value=FEATURE_STORE.name):
         new_beddf = bedsp_class._process(
             beddf, seq_assay_id, new_path, parentid, create_panel=False)
         new_beddf.sort_values("Chromosome", inplace=True)
@@ -157,8 +153,8 @@ def test_clinicalreport___process():
         3: ['foo', 'bar', 'baz', 'boo'],
         4: [True, True, False, True],
         5: [True, float('nan'), False, True]})
-    with patch.object(genie.bed, "create_gtf",
-                      return_value=(EXON_TEMP.name, GENE_TEMP.name)):
+    with patch.object(genie.bed, "create_feature_store",
+                      return_value=FEATURE_STORE.name):
         new_beddf = bedsp_class._process(
             beddf, seq_assay_id, new_path, parentid, create_panel=False)
         new_beddf.sort_values("Chromosome", inplace=True)
@@ -324,3 +320,243 @@ def test_symbolnull_failure__validate():
         "BED file: Any gene names that can't be remapped will be null.\n")
     assert error == expected_errors
     assert warning == expected_warnings
+
+
+def test_genomicintervals_overlaps():
+    """GTF positions are 1-based and closed, BED positions are 0-based
+    and half-open"""
+    intervals = genie.bed.GenomicIntervals(
+        ['1', '1', '2'], [99, 500, 10], [200, 600, 20])
+    overlaps = intervals.overlaps(
+        ['1', '1', '1', '1', '1', '3', '2'],
+        [90, 90, 200, 300, 150, 10, 15],
+        [99, 100, 250, 400, 550, 20, 15])
+    assert overlaps.tolist() == [False, True, False, False, True,
+                                 False, True]
+
+
+def test_add_feature_type_to_text():
+    """Regions are exons, introns or intergenic and are only kept once"""
+    bed_text = ("2\t69700000\t69700100\tAAK1\tTrue\t\tAAK1\tSAGE-TEST\n"
+                "2\t69688500\t69688600\tAAK1\tTrue\t\tAAK1\tSAGE-TEST\n"
+                "2\t69688500\t69688600\tAAK1\tTrue\t\tAAK1\tSAGE-TEST\n"
+                "2\t1000\t1100\tfoo\tTrue\t\tfoo\tSAGE-TEST\n")
+    beddf = genie.bed.add_feature_type_to_text(
+        bed_text,
+        *genie.bed.load_feature_store(FEATURE_STORE.name))
+    assert beddf['Start_Position'].tolist() == [69688500, 69700000, 1000]
+    assert beddf['Feature_Type'].tolist() == ['exon', 'intron',
+                                              'intergenic']
+
+
+def test_genepositionindex_check_regions_overlap():
+    """Regions overlap the first gene position of their symbol"""
+    gene_positions = genie.bed.GenePositionIndex(symbols)
+    overlap = gene_positions.check_regions_overlap(
+        pd.Series(['AAK1', 'AAK1', 'foo', 'XRCC1']),
+        [69688533, 1, 69688533, 44000000],
+        [69901480, 10, 69901480, 44100000])
+    assert overlap.tolist() == [True, False, False, True]
+    assert gene_positions.check_region_overlap('AAK1', 69688533, 69901480)
+    assert not gene_positions.check_region_overlap('foo', 1, 10)
+
+
+def test_genepositionindex_map_position_within_boundary():
+    """Regions are mapped to the genes containing them or overlapping
+    more than 90% of them"""
+    gene_positions = genie.bed.GenePositionIndex(symbols)
+    # Contained in two genes
+    assert gene_positions.map_position_within_boundary(
+        '19', 44080952, 44084625) == ['PINLYP', 'XRCC1']
+    # Start goes over the start of AAK1 by less than 10%
+    assert gene_positions.map_position_within_boundary(
+        2, 69688432, 69689532) == ['AAK1']
+    # Start goes over the start of AAK1 by more than 10%
+    assert gene_positions.map_position_within_boundary(
+        '2', 69688000, 69688600) == []
+    assert gene_positions.map_position_within_boundary(
+        '3', 69688432, 69689532) == []
+
+
+def test_bedremapcache_lru(tmpdir):
+    """Entries are keyed on bed md5 and gene table etag, and the least
+    recently used entries are removed"""
+    cache = genie.bed.BedRemapCache(cache_dir=str(tmpdir), max_entries=2)
+    assert cache.get("md5a", "etag1") == {}
+    cache.put("md5a", "etag1", {("1", 10, 20, "foo"): "AAK1"})
+    cache.put("md5b", "etag1", {("1", 10, 20, "foo"): None})
+    assert cache.get("md5a", "etag1") == {("1", 10, 20, "foo"): "AAK1"}
+    assert cache.get("md5a", "etag2") == {}
+    # md5b is now the least recently used entry
+    os.utime(str(tmpdir.join("md5b_etag1.json")), (0, 0))
+    cache.put("md5c", "etag1", {})
+    assert cache.get("md5b", "etag1") == {}
+    assert cache.get("md5a", "etag1") == {("1", 10, 20, "foo"): "AAK1"}
+
+
+def test_remap_symbols_cached(tmpdir):
+    """Processing reuses the symbols remapped during validation, cached
+    in the Synapse cache"""
+    bed_path = str(tmpdir.join("SAGE-Test.bed"))
+    with open(bed_path, "w") as bed_file:
+        bed_file.write("2\t69688432\t69689532\tfoo\tTrue\n")
+    gene_table = create_mock_table(symbols)
+    gene_table.etag = "etag1"
+    cache_syn = mock.create_autospec(synapseclient.Synapse)
+    cache_syn.tableQuery.return_value = gene_table
+    cache_syn.cache = mock.Mock(cache_root_dir=str(tmpdir))
+    bed_validator = bed(cache_syn, "SAGE")
+    valid, errors, warnings = bed_validator.validate([bed_path])
+    assert valid
+    assert len(tmpdir.join("bed_remap_cache").listdir()) == 1
+    bed_processor = bed(cache_syn, "SAGE")
+    beddf = bed_processor.read_file([bed_path])
+    with patch.object(genie.bed, "remap_bed_symbols") as patch_remap,\
+         patch.object(genie.bed, "create_feature_store",
+                      return_value=FEATURE_STORE.name):
+        new_beddf = bed_processor._process(
+            beddf, seq_assay_id, new_path, parentid, create_panel=False)
+    patch_remap.assert_not_called()
+    assert new_beddf['Hugo_Symbol'].tolist() == ['AAK1']
+
+
+def test_remap_symbols_cached_normalized(tmpdir):
+    """Processing reuses the symbols remapped during validation of bed
+    files with chr prefixed chromosomes and dotted symbols"""
+    bed_path = str(tmpdir.join("SAGE-Test.bed"))
+    with open(bed_path, "w") as bed_file:
+        bed_file.write("chr2\t69688432\t69689532\tfoo.1\tTrue\n")
+    gene_table = create_mock_table(symbols)
+    gene_table.etag = "etag1"
+    cache_syn = mock.create_autospec(synapseclient.Synapse)
+    cache_syn.tableQuery.return_value = gene_table
+    cache_syn.cache = mock.Mock(cache_root_dir=str(tmpdir))
+    bed_validator = bed(cache_syn, "SAGE")
+    valid, errors, warnings = bed_validator.validate([bed_path])
+    assert valid
+    bed_processor = bed(cache_syn, "SAGE")
+    beddf = bed_processor.read_file([bed_path])
+    with patch.object(genie.bed, "remap_bed_symbols") as patch_remap,\
+         patch.object(genie.bed, "create_feature_store",
+                      return_value=FEATURE_STORE.name):
+        new_beddf = bed_processor._process(
+            beddf, seq_assay_id, new_path, parentid, create_panel=False)
+    patch_remap.assert_not_called()
+    assert new_beddf['Hugo_Symbol'].tolist() == ['AAK1']
+
+
+def test_shared_gene_positions():
+    """Bed files use the shared gene positions once they are loaded"""
+    gene_table = create_mock_table(symbols)
+    shared_syn = mock.create_autospec(synapseclient.Synapse)
+    shared_syn.tableQuery.return_value = gene_table
+    gene_positions = genie.bed.SharedGenePositions()
+    with patch.object(genie.bed, "GENE_POSITIONS", gene_positions):
+        index = gene_positions.load(shared_syn)
+        assert gene_positions.load(shared_syn) is index
+        bed_syn = mock.create_autospec(synapseclient.Synapse)
+        assert bed(bed_syn, "SAGE")._get_gene_positions() is index
+        bed_syn.tableQuery.assert_not_called()
+    shared_syn.tableQuery.assert_called_once_with(
+        'SELECT * FROM syn11806563')
+
+
+def test_feature_store():
+    """The feature store holds the exons and genes of the GTF"""
+    exons, genes = genie.bed.load_feature_store(FEATURE_STORE.name)
+    chromosomes = ['2', '2', '9', '19', '19', '12']
+    starts = [69688431, 69688400, 99416987, 44084625, 44084625, 1]
+    ends = [69688432, 69688431, 99417000, 44084695, 44084696, 2]
+    assert exons.overlaps(chromosomes, starts, ends).tolist() == \
+        [True, False, True, False, True, False]
+    assert genes.overlaps(chromosomes, starts, ends).tolist() == \
+        [False, False, True, True, True, False]
+
+
+def test_create_feature_store_local_gtf(tmpdir):
+    """The feature store is built from a local GTF without downloading"""
+    with patch.object(subprocess, "check_call") as patch_check_call:
+        store_dir = genie.bed.create_feature_store(str(tmpdir),
+                                                   gtf_path=GTF_TEMP.name)
+        patch_check_call.assert_not_called()
+    assert store_dir == str(tmpdir.join("gtf_feature_store"))
+    assert sorted(os.listdir(str(tmpdir))) == ["gtf_feature_store"]
+    exons, genes = genie.bed.load_feature_store(store_dir)
+    assert genes.overlaps(['9'], [99401858], [99401859]).tolist() == [True]
+
+
+def test_perform_build_feature_store(tmpdir):
+    """Rebuilding swaps in a complete store and leaves nothing behind,
+    a failed build keeps the old store"""
+    store_dir = str(tmpdir.join("gtf_feature_store"))
+    args = mock.Mock(gtf_path=GTF_TEMP.name, store_dir=store_dir)
+    genie.bed._perform_build_feature_store(None, args)
+    genie.bed._perform_build_feature_store(None, args)
+    assert os.listdir(str(tmpdir)) == ["gtf_feature_store"]
+    exons, genes = genie.bed.load_feature_store(store_dir)
+    assert genes.overlaps(['9'], [99401858], [99401859]).tolist() == [True]
+    stored = sorted(os.listdir(store_dir))
+
+    with patch.object(genie.bed, "build_feature_store",
+                      side_effect=ValueError), \
+            pytest.raises(ValueError):
+        genie.bed._perform_build_feature_store(None, args)
+    assert os.listdir(str(tmpdir)) == ["gtf_feature_store"]
+    assert sorted(os.listdir(store_dir)) == stored
+
+
+def test_symbolresolver():
+    """Genes are Hugo symbols or remapped from the bed IDs"""
+    beddf = pd.DataFrame({"Hugo_Symbol": ["AAK1", "AAED1", "AAK1", "TP53"],
+                          "ID": ["AAK1", "AAED", "AAK1b", "AAED"]})
+    resolver = genie.bed.SymbolResolver(beddf)
+    genes = pd.Series(["AAK1", "AAED", "AAK1b", "foo", float('nan'),
+                       "AAED1"])
+    assert resolver.resolve(genes).equals(pd.Series(
+        ["AAK1", "AAED1", "AAK1", float('nan'), float('nan'), "AAED1"]))
+    assert resolver.resolve(genes, keep_unmapped=True).tolist()[:4] == \
+        ["AAK1", "AAED1", "AAK1", "foo"]
+
+
+def test_symbolresolvercache():
+    """The bed database of a center is queried once until cleared"""
+    bed_syn = mock.create_autospec(synapseclient.Synapse)
+    bed_syn.tableQuery.return_value = create_mock_table(
+        pd.DataFrame({"Hugo_Symbol": ["AAK1"], "ID": ["AAK1"]}))
+    resolvers = genie.bed.SymbolResolverCache()
+    resolver = resolvers.get(bed_syn, "syn1", "SAGE")
+    assert resolvers.get(bed_syn, "syn1", "SAGE") is resolver
+    resolvers.get(bed_syn, "syn1", "GOLD")
+    resolvers.clear("SAGE")
+    assert resolvers.get(bed_syn, "syn1", "SAGE") is not resolver
+    assert bed_syn.tableQuery.call_args_list == [
+        mock.call("select Hugo_Symbol, ID from syn1 where CENTER = 'SAGE'"),
+        mock.call("select Hugo_Symbol, ID from syn1 where CENTER = 'GOLD'"),
+        mock.call("select Hugo_Symbol, ID from syn1 where CENTER = 'SAGE'")]
+
+
+def test_symbolresolvercache_per_center():
+    """A slow bed query of one center doesn't hold up other centers"""
+    sage_querying = threading.Event()
+    gold_queried = threading.Event()
+
+    def table_query(query):
+        if "SAGE" in query:
+            sage_querying.set()
+            assert gold_queried.wait(5)
+        else:
+            gold_queried.set()
+        return create_mock_table(
+            pd.DataFrame({"Hugo_Symbol": ["AAK1"], "ID": ["AAK1"]}))
+
+    bed_syn = mock.create_autospec(synapseclient.Synapse)
+    bed_syn.tableQuery.side_effect = table_query
+    resolvers = genie.bed.SymbolResolverCache()
+    sage = threading.Thread(target=resolvers.get,
+                            args=(bed_syn, "syn1", "SAGE"))
+    sage.start()
+    assert sage_querying.wait(5)
+    resolvers.get(bed_syn, "syn1", "GOLD")
+    sage.join()
+    assert gold_queried.is_set()
+    assert bed_syn.tableQuery.call_count == 2
@@ -1,10 +1,13 @@
 import datetime
 import mock
+import os
 import pytest
 
 import pandas as pd
 import synapseclient
 
+import genie.clinical
+import genie.process_functions
 from genie.clinical import clinical
 
 
@@ -14,7 +17,7 @@ def createMockTable(dataframe):
     return(table)
 
 
-def table_query_results(*args):
+def table_query_results(*args, **kwargs):
     return(table_query_results_map[args])
 
 
@@ -33,6 +36,12 @@ table_query_results_map = {
     ("SELECT * FROM syn7434236",): createMockTable(no_nan),
     ("SELECT * FROM syn7434242",): createMockTable(no_nan),
     ("SELECT * FROM syn7434273",): createMockTable(no_nan)}
+# Mapping tables are looked up by the etag of their rows first, without
+# an etag they aren't cached on disk
+table_query_results_map.update({
+    ("SELECT * FROM {} LIMIT 1".format(query[0].split()[-1]),):
+        mock.Mock(etag=None)
+    for query in list(table_query_results_map)})
 
 syn = mock.create_autospec(synapseclient.Synapse)
 syn.tableQuery.side_effect = table_query_results
@@ -320,6 +329,98 @@ def test_sample__process():
     assert expected_sampledf.equals(new_sampledf[expected_sampledf.columns])
 
 
+def test_clinicalnormalizer_timings():
+    '''
+    Test that every normalization step is timed and that string
+    columns are normalized per unique value
+    '''
+    sampledf = pd.DataFrame(dict(
+        SAMPLE_ID=["ID1-1", "ID2-1", "ID3-1"],
+        SAMPLE_TYPE=[1, 1, 99],
+        SEQ_ASSAY_ID=['sage_1', 'sage_1', 'sage_1'],
+        SEQ_DATE=['JAN-2012', 'JAN-2012', 'JAN-2012']))
+    normalizer = genie.clinical.ClinicalNormalizer(
+        "SAGE", sexdf, no_nan, no_nan, no_nan)
+    new_sampledf = normalizer.normalize(sampledf)
+    assert new_sampledf['SEQ_ASSAY_ID'].tolist() == ['SAGE-1'] * 3
+    assert new_sampledf['SEQ_YEAR'].tolist() == [2012] * 3
+    assert new_sampledf['SAMPLE_TYPE'].tolist() == ['Test', 'Test', 'Unknown']
+    assert new_sampledf['YEAR_DEATH'].tolist() == ['Not Collected'] * 3
+    steps = [name for name, _ in normalizer.timings]
+    assert steps[:4] == [
+        "SAMPLE_ID:genie_id", "SEQ_ASSAY_ID:seq_assay_id",
+        "SAMPLE_TYPE_DETAILED:sample_type_detailed",
+        "SAMPLE_TYPE:sample_type"]
+    assert "SEQ_ASSAY_ID:strip" in steps
+
+
+def test_clinicalnormalizer_matches_per_value():
+    '''
+    Test that the normalized columns match the value by value functions
+    '''
+    index = pd.Series(range(20))
+    sampledf = pd.DataFrame(dict(
+        SAMPLE_ID="ID" + index.astype(str),
+        PATIENT_ID=("SAGE-P" + (index // 2).astype(str)),
+        AGE_AT_SEQ_REPORT=(index % 3).map({0: "<6570", 1: "12000",
+                                           2: " Unknown"}),
+        SAMPLE_TYPE=index % 5,
+        SEQ_ASSAY_ID="sage_1",
+        SEQ_DATE=(index % 4).map({0: "JAN-2012", 1: "apr-2013",
+                                  2: "Jul-2014", 3: "release"})))
+    normalizer = genie.clinical.ClinicalNormalizer(
+        "SAGE", sexdf, no_nan, no_nan, no_nan)
+    new_sampledf = normalizer.normalize(sampledf)
+
+    assert new_sampledf['SAMPLE_ID'].tolist() == [
+        genie.process_functions.checkGenieId(sample_id, "SAGE")
+        for sample_id in sampledf['SAMPLE_ID']]
+    assert new_sampledf['PATIENT_ID'].tolist() == [
+        genie.process_functions.checkGenieId(patient_id, "SAGE")
+        for patient_id in sampledf['PATIENT_ID']]
+    assert new_sampledf['AGE_AT_SEQ_REPORT'].tolist() == [
+        int(age) if genie.process_functions.checkInt(age) else age.strip()
+        for age in sampledf['AGE_AT_SEQ_REPORT']]
+    assert new_sampledf['SAMPLE_TYPE_DETAILED'].tolist() == [
+        genie.process_functions.getCODE(
+            no_nan, sample_type, useDescription=True)
+        for sample_type in sampledf['SAMPLE_TYPE']]
+    assert new_sampledf['SEQ_YEAR'].fillna(0).tolist() == [
+        int(seq_date.split("-")[1]) if seq_date != "release" else 0
+        for seq_date in sampledf['SEQ_DATE']]
+
+
+def test_uploadmissingdata():
+    '''
+    Missing rows are written to a path of their own and removed once
+    they are stored
+    '''
+    missing_syn = mock.create_autospec(synapseclient.Synapse)
+    missing_syn.tableQuery.return_value.asDataFrame.return_value = \
+        pd.DataFrame({'SAMPLE_ID': ["GENIE-SAGE-3"]})
+    stored = []
+
+    def store(entity):
+        with open(entity.path) as missing_file:
+            stored.append((entity.path, missing_file.read()))
+
+    missing_syn.store.side_effect = store
+    missing_clinical = clinical(missing_syn, "SAGE")
+    sampledf = pd.DataFrame({'SAMPLE_ID': ["GENIE-SAGE-1", "GENIE-SAGE-2"]})
+    for _ in range(2):
+        missing_clinical.uploadMissingData(
+            sampledf, "SAMPLE_ID", "syn1", "syn2")
+    missing_syn.tableQuery.assert_called_with(
+        "select SAMPLE_ID from syn1 where CENTER='SAGE' and SAMPLE_ID "
+        "not in ('GENIE-SAGE-1','GENIE-SAGE-2')")
+    assert [content for _, content in stored] == \
+        ["SAMPLE_ID\nGENIE-SAGE-3\n"] * 2
+    paths = [path for path, _ in stored]
+    assert paths[0] != paths[1]
+    assert all(os.path.basename(path) == "clinical_missing_SAMPLE_ID.csv"
+               and not os.path.exists(path) for path in paths)
+
+
 def test_perfect__validate():
     '''
     Test perfect validation
@@ -616,6 +717,7 @@ def test_duplicated__validate():
 
 
 class fake_oncotree():
+    status_code = 200
     import json
     text = json.dumps({
         'TISSUE': {
@@ -655,12 +757,54 @@ expected_onco_mapping = {
         'ONCOTREE_SECONDARY_NODE': 'UCEC'}}
 
 
-def test_get_oncotree_code_mappings():
+def test_get_oncotree_code_mappings(tmpdir):
     from genie import process_functions
+    oncotree_cache = process_functions.OncotreeCache(cache_dir=str(tmpdir))
     with mock.patch(
             "genie.process_functions.retry_get_url",
-            return_value=fake_oncotree) as retry_get_url:
+            return_value=fake_oncotree) as retry_get_url, \
+        mock.patch.object(
+            process_functions, "ONCOTREE_CACHE", oncotree_cache):
         onco_mapping = \
             process_functions.get_oncotree_code_mappings(json_oncotreeurl)
         retry_get_url.called_once_with(json_oncotreeurl)
         assert onco_mapping == expected_onco_mapping
+
+
+def test_oncotreecache(tmpdir):
+    '''
+    Test that oncotree is requested once, that the snapshot is used
+    offline and when oncotree is down, and that callers can't change
+    the cached mappings
+    '''
+    from genie import process_functions
+    oncotree_cache = process_functions.OncotreeCache(cache_dir=str(tmpdir))
+    with mock.patch(
+            "genie.process_functions.retry_get_url",
+            return_value=fake_oncotree) as retry_get_url:
+        onco_mapping = oncotree_cache.get(json_oncotreeurl)
+        onco_mapping['UNKNOWN'] = {}
+        assert oncotree_cache.get(json_oncotreeurl) == expected_onco_mapping
+        retry_get_url.assert_called_once_with(json_oncotreeurl)
+    assert os.path.basename(oncotree_cache.snapshot_path(
+        json_oncotreeurl)).startswith("oncotree_2017_06_21_")
+
+    offline_cache = process_functions.OncotreeCache(
+        cache_dir=str(tmpdir), ttl=0, offline=True)
+    with mock.patch(
+            "genie.process_functions.retry_get_url") as retry_get_url:
+        assert offline_cache.get(json_oncotreeurl) == expected_onco_mapping
+        retry_get_url.assert_not_called()
+    with pytest.raises(ValueError, match="No oncotree snapshot"):
+        offline_cache.get("http://oncotree.mskcc.org/api/tumorTypes/tree")
+
+    stale_cache = process_functions.OncotreeCache(
+        cache_dir=str(tmpdir), ttl=0)
+    down = mock.Mock(status_code=503)
+    with mock.patch(
+            "genie.process_functions.retry_get_url",
+            return_value=down) as retry_get_url:
+        assert stale_cache.get(json_oncotreeurl) == expected_onco_mapping
+        retry_get_url.assert_called_once_with(json_oncotreeurl)
+        with pytest.raises(AssertionError, match="site is down"):
+            stale_cache.get("http://oncotree.mskcc.org/api/tumorTypes/tree")
@@ -5,7 +5,8 @@ import pytest
 import pandas as pd
 import synapseclient
 
-from genie.cna import cna
+from genie.cna import cna, CnaMatrix, encode_cna_values, CNA_NAN_CODE
+from genie.cna import mergeCNAvalues
 
 
 def createMockTable(dataframe):
@@ -125,3 +126,74 @@ def test_validation():
             "0.5, 1, 1.5, or 2.\n")
         assert error == expectedErrors
         assert warning == ""
+
+
+def test_encode_cna_values():
+    valuesdf = pd.DataFrame({"GENIE-1": [-2, 0.5, float('nan')],
+                             "GENIE-2": ["1", "3", "foo"]})
+    codes, invalid = encode_cna_values(valuesdf, block_size=1)
+    assert invalid.tolist() == [False, True]
+    assert codes[:2, 0].tolist() == [-4, 1]
+    assert codes[2, 0] == CNA_NAN_CODE
+
+
+def test_encode_cna_values_text():
+    """Text columns only have the CNA values as they are written"""
+    valuesdf = pd.DataFrame({"GENIE-1": ["-2.0", "-0.5", "1", float('nan')],
+                             "GENIE-2": ["+1", "0", "0", "0"],
+                             "GENIE-3": ["1e0", "0", "0", "0"],
+                             "GENIE-4": [" 1", "0", "0", "0"]})
+    codes, invalid = encode_cna_values(valuesdf)
+    assert invalid.tolist() == [False, True, True, True]
+    assert codes[:3, 0].tolist() == [-4, -1, 2]
+    assert codes[3, 0] == CNA_NAN_CODE
+
+
+def test_encode_cna_values_bool():
+    """TRUE/FALSE columns are not CNA values"""
+    valuesdf = pd.DataFrame({"GENIE-1": [True, False],
+                             "GENIE-2": [1, 0]})
+    codes, invalid = encode_cna_values(valuesdf)
+    assert invalid.tolist() == [True, False]
+    assert (codes[:, 0] == CNA_NAN_CODE).all()
+
+
+def test_cnamatrix_merge_duplicates():
+    cnadf = pd.DataFrame({
+        "Hugo_Symbol": ["TP53", "AAK1", "TP53", "TP53", "AAK1"],
+        "GENIE-1": [0, 1, 2, float('nan'), 1],
+        "GENIE-2": [1, -1, float('nan'), 0, 2],
+        "GENIE-3": [float('nan'), 0, float('nan'), float('nan'), 0]})
+    merged = CnaMatrix.from_dataframe(cnadf).merge_duplicates()
+    expected = cnadf.groupby("Hugo_Symbol", sort=False).agg(
+        mergeCNAvalues).reset_index()
+    assert merged.to_dataframe().equals(expected)
+
+
+def test_cnamatrix_read_write(tmpdir):
+    cna_path = str(tmpdir.join("data_CNA.txt"))
+    with open(cna_path, "w") as cna_file:
+        cna_file.write("Hugo_Symbol\tEntrez_Gene_Id\tGENIE-1\tGENIE-2\n"
+                       "AAK1\t1\t-1.5\tNA\n"
+                       "0001\t2\t0.5\t2\n")
+    matrix = CnaMatrix.read(cna_path, chunksize=1)
+    assert matrix.symbols.tolist() == ["AAK1", "0001"]
+    assert matrix.samples == ["GENIE-1", "GENIE-2"]
+    matrix.select_samples(["GENIE-1"]).write(cna_path)
+    with open(cna_path) as cna_file:
+        assert cna_file.read() == ("Hugo_Symbol\tGENIE-1\n"
+                                   "AAK1\t-1.5\n"
+                                   "0001\t0.5\n")
+
+
+
+def test_cnamatrix_format_rows_chunks():
+    """Rows formatted in small chunks are the same as in one chunk"""
+    cnadf = pd.DataFrame({"Hugo_Symbol": ["TP53", "AAK1", "BRCA1"],
+                          "GENIE-1": [0, -0.5, float('nan')],
+                          "GENIE-2": [2, 1.5, -1]})
+    matrix = CnaMatrix.from_dataframe(cnadf)
+    rows = list(matrix.format_rows())
+    assert rows == ["\t0\t2", "\t-0.5\t1.5", "\tNA\t-1"]
+    assert list(matrix.format_rows(chunk_bytes=10)) == rows
+    assert list(matrix.format_rows(chunk_bytes=1)) == rows
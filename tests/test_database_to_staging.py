@@ -1,4 +1,5 @@
 """Tests database to staging functions"""
+import io
 import os
 
 import mock
@@ -6,7 +7,8 @@ from mock import patch
 import pandas as pd
 import synapseclient
 
-from genie import database_to_staging
+from genie import database_to_staging, process_functions
+from genie.cna import CnaMatrix
 
 SYN = synapseclient.Synapse()
 FILEVIEW_SYNID = "syn12345"
@@ -94,3 +96,335 @@ def test_store_assay_info_files():
                                                 genieVersion=GENIE_VERSION,
                                                 name="assay_information.txt")
         assert wes_ids == ['A']
+
+
+MAF_HEADERS = ['Center', 'Chromosome', 'Start_Position', 'End_Position',
+               'Reference_Allele', 'Tumor_Seq_Allele2',
+               'Tumor_Sample_Barcode', 'HGVSp_Short', 'FILTER',
+               't_depth', 't_ref_count', 't_alt_count', 'n_depth',
+               'n_ref_count', 'n_alt_count', 'Match_Norm_Seq_Allele2',
+               'Match_Norm_Seq_Allele1', 'mutationInCis_Flag']
+
+
+def _maf_row(center, sample, start, filter_info="PASS"):
+    return "\t".join([center, "1", start, start, "A", "T", sample,
+                      "p.A1T", filter_info, "10.0", ".", "5", "0.0", ".",
+                      ".", "A", "A"]) + "\n"
+
+
+def test_mafrowfilter_write_rows(tmpdir):
+    """Each row is configured once and written to the merged and
+    center release files according to the keep sets"""
+    merged_path = str(tmpdir.join("merged.txt"))
+    center_path = str(tmpdir.join("center_%s.txt"))
+    maf_rows = [_maf_row("SAGE", "GENIE-SAGE-1", "100"),
+                _maf_row("SAGE", "GENIE-SAGE-2", "200"),
+                _maf_row("SAGE", "GENIE-SAGE-3", "300"),
+                _maf_row("SAGE", "GENIE-SAGE-1", "400",
+                         filter_info="common_variant")]
+    header = "\t".join(MAF_HEADERS) + "\n"
+    with database_to_staging.MafReleaseWriter(merged_path, center_path,
+                                              centers=["SAGE"]) as writer:
+        writer.write_header(header)
+        row_filter = database_to_staging.MafRowFilter(
+            keep_for_merged_consortium_samples=pd.Series(["GENIE-SAGE-1"]),
+            keep_for_center_consortium_samples=pd.Series(["GENIE-SAGE-1",
+                                                          "GENIE-SAGE-2"]),
+            remove_mafinbed_variants=pd.Series(
+                ["1 200 200 A T GENIE-SAGE-2"]),
+            flagged_mutationInCis_variants=pd.Series(
+                ["1 100 p.A1T A T GENIE-SAGE-1"]))
+        row_filter.with_headers(MAF_HEADERS).write_rows(iter(maf_rows),
+                                                        writer)
+
+    expected_row = "\t".join(["SAGE", "1", "100", "100", "A", "T",
+                              "GENIE-SAGE-1", "p.A1T", "PASS", "10", "",
+                              "5", "0", "", "", "", "", "True"]) + "\n"
+    with open(merged_path) as merged:
+        assert merged.read() == header + expected_row
+    with open(center_path % "SAGE") as center:
+        assert center.read() == header + expected_row
+
+
+def test_mafrowfilter_write_chunks(tmpdir):
+    """The chunked engine writes the same bytes as the row engine"""
+    maf_rows = [_maf_row("SAGE", "GENIE-SAGE-1", "100"),
+                _maf_row("GOLD", "GENIE-GOLD-1", "200.0"),
+                _maf_row("SAGE", "GENIE-SAGE-2", "300"),
+                _maf_row("GOLD", "GENIE-GOLD-2", "400"),
+                _maf_row("SAGE", "GENIE-SAGE-3", "500"),
+                _maf_row("GOLD", "GENIE-GOLD-1", "600",
+                         filter_info="PASS;common_variant"),
+                _maf_row("SAGE", "GENIE-SAGE-1", "700").replace(
+                    "0.0\t.\t.\tA\tA", "NA\t1.0\t.\tA\tA")]
+    row_filter = database_to_staging.MafRowFilter(
+        keep_for_merged_consortium_samples=pd.Series(["GENIE-SAGE-1",
+                                                      "GENIE-GOLD-1"]),
+        keep_for_center_consortium_samples=pd.Series(["GENIE-SAGE-1",
+                                                      "GENIE-GOLD-1",
+                                                      "GENIE-GOLD-2",
+                                                      "GENIE-SAGE-3"]),
+        remove_mafinbed_variants=pd.Series(["1 500 500 A T GENIE-SAGE-3"]),
+        flagged_mutationInCis_variants=pd.Series(
+            ["1 200.0 p.A1T A T GENIE-GOLD-1"])).with_headers(MAF_HEADERS)
+    header = "\t".join(MAF_HEADERS) + "\n"
+    for engine in ["rows", "chunks"]:
+        with database_to_staging.MafReleaseWriter(
+                str(tmpdir.join(engine + "_merged.txt")),
+                str(tmpdir.join(engine + "_%s.txt"))) as writer:
+            writer.write_header(header)
+            if engine == "rows":
+                row_filter.write_rows(iter(maf_rows), writer)
+            else:
+                row_filter.write_chunks(io.StringIO("".join(maf_rows)),
+                                        writer, chunksize=2)
+    for name in ["merged", "SAGE", "GOLD"]:
+        with open(str(tmpdir.join("rows_%s.txt" % name))) as rows_file, \
+                open(str(tmpdir.join("chunks_%s.txt" % name))) as chunks:
+            assert rows_file.read() == chunks.read()
+
+
+def test_store_maf_files_workers(tmpdir, monkeypatch):
+    """Filtering the center mafs in worker processes writes the same
+    release mafs as filtering them one after another"""
+    monkeypatch.chdir(tmpdir)
+    header = "\t".join(MAF_HEADERS[:-1]) + "\n"
+    maf_paths = {"syn1": "data_mutations_extended_SAGE_1.txt",
+                 "syn2": "data_mutations_extended_GOLD_1.txt",
+                 "syn3": "data_mutations_extended_NORELEASE_1.txt"}
+    for synid, center in [("syn1", "SAGE"), ("syn2", "GOLD"),
+                          ("syn3", "NORELEASE")]:
+        with open(maf_paths[synid], "w") as maf:
+            maf.write(header)
+            for i in range(3):
+                maf.write(_maf_row(center, "GENIE-%s-%d" % (center, i),
+                                   str(i)))
+    clinicaldf = pd.DataFrame({'CENTER': ["SAGE", "GOLD"]})
+    center_mappingdf = pd.DataFrame({'center': ["SAGE", "GOLD"],
+                                     'stagingSynId': ["syn4", "syn5"]})
+    keep_samples = pd.Series(["GENIE-SAGE-0", "GENIE-SAGE-2",
+                              "GENIE-GOLD-1", "GENIE-NORELEASE-1"])
+    release_files = {}
+    for maf_workers in [1, 2]:
+        release_dir = str(tmpdir.mkdir("release%d" % maf_workers))
+        with patch.object(SYN, "tableQuery",
+                          return_value=Tablequerydf(
+                              pd.DataFrame({'id': list(maf_paths)}))),\
+             patch.object(SYN, "get",
+                          side_effect=lambda synid: synapseclient.Entity(
+                              path=maf_paths[synid])),\
+             patch.object(database_to_staging, "store_file"),\
+             patch.object(database_to_staging, "GENIE_RELEASE_DIR",
+                          release_dir),\
+             patch.object(database_to_staging, "MUTATIONS_CENTER_PATH",
+                          os.path.join(release_dir, "center_%s.txt")):
+            database_to_staging.store_maf_files(
+                SYN, GENIE_VERSION, FILEVIEW_SYNID, CONSORTIUM_SYNID,
+                clinicaldf, center_mappingdf, keep_samples, keep_samples,
+                pd.Series([], dtype=str), pd.Series([], dtype=str), True,
+                maf_workers=maf_workers)
+        release_files[maf_workers] = {}
+        for name in sorted(os.listdir(release_dir)):
+            with open(os.path.join(release_dir, name)) as release_file:
+                release_files[maf_workers][name] = release_file.read()
+    assert release_files[1] == release_files[2]
+    assert sorted(release_files[1]) == [
+        "center_GOLD.txt", "center_SAGE.txt",
+        "data_mutations_extended_vTEST.txt"]
+    assert release_files[1]["center_SAGE.txt"].count("\n") == 3
+
+
+def test_store_seg_files(tmpdir):
+    """The seg table is queried in pages and filtered into the merged
+    and center seg files"""
+    segdf = pd.DataFrame({
+        'ID': ["GENIE-SAGE-1", "GENIE-SAGE-2", "GENIE-GOLD-1",
+               "GENIE-NORELEASE-1", "GENIE-SAGE-1"],
+        'CHROM': ["1", "2", "3", "4", "X"],
+        'LOCSTART': [1, 2, 3, 4, 5],
+        'LOCEND': [10, 20, 30, 40, 50],
+        'NUMMARK': [3.0, float('nan'), 4.0, 5.0, 6.0],
+        'SEGMEAN': [0.5, -1.0, 0.25, 1.0, 2.0],
+        'CENTER': ["SAGE", "SAGE", "GOLD", "NORELEASE", "SAGE"]},
+        index=["3_1", "5_2", "8_1", "13_1", "21_4"])
+    pages = [Tablequerydf(segdf[:2]), Tablequerydf(segdf[2:4]),
+             Tablequerydf(segdf[4:])]
+    center_mappingdf = pd.DataFrame({'center': ["SAGE", "GOLD"],
+                                     'stagingSynId': ["syn4", "syn5"]})
+    keep_center = ["GENIE-SAGE-1", "GENIE-SAGE-2", "GENIE-NORELEASE-1"]
+    keep_merged = ["GENIE-SAGE-1", "GENIE-GOLD-1"]
+    release_dir = str(tmpdir)
+    with patch.object(SYN, "tableQuery", side_effect=pages) as patch_query,\
+         patch.object(database_to_staging, "store_file") as patch_store,\
+         patch.object(database_to_staging, "GENIE_RELEASE_DIR",
+                      release_dir),\
+         patch.object(database_to_staging, "SEG_CENTER_PATH",
+                      os.path.join(release_dir, "center_%s.seg")):
+        database_to_staging.store_seg_files(
+            SYN, GENIE_VERSION, "syn6", CONSORTIUM_SYNID, keep_center,
+            keep_merged, center_mappingdf, False, page_size=2)
+    query = ('SELECT ID,CHROM,LOCSTART,LOCEND,NUMMARK,SEGMEAN,CENTER '
+             'FROM syn6%s ORDER BY ROW_ID LIMIT 2')
+    assert patch_query.call_args_list == [
+        mock.call(query % ""),
+        mock.call(query % " WHERE ROW_ID > 5"),
+        mock.call(query % " WHERE ROW_ID > 13")]
+    header = "ID\tchrom\tloc.start\tloc.end\tnum.mark\tseg.mean\n"
+    with open(os.path.join(release_dir,
+                           "genie_private_data_cna_hg19_vTEST.seg")) as seg:
+        assert seg.read() == (header +
+                              "GENIE-SAGE-1\t1\t1\t10\t3\t0.5\n"
+                              "GENIE-GOLD-1\t3\t3\t30\t4\t0.25\n"
+                              "GENIE-SAGE-1\tX\t5\t50\t6\t2\n")
+    with open(os.path.join(release_dir, "center_SAGE.seg")) as seg:
+        assert seg.read() == (header +
+                              "GENIE-SAGE-1\t1\t1\t10\t3\t0.5\n"
+                              "GENIE-SAGE-2\t2\t2\t20\t\t-1\n"
+                              "GENIE-SAGE-1\tX\t5\t50\t6\t2\n")
+    assert sorted(os.listdir(release_dir)) == [
+        "center_SAGE.seg", "genie_private_data_cna_hg19_vTEST.seg"]
+    assert patch_store.call_count == 2
+
+
+def test_mafreleasewriter_lazy_center(tmpdir):
+    """Center files not created up front get the header on first write"""
+    merged_path = str(tmpdir.join("merged.txt"))
+    center_path = str(tmpdir.join("center_%s.txt"))
+    with database_to_staging.MafReleaseWriter(merged_path,
+                                              center_path) as writer:
+        writer.write_header("foo\n")
+        writer.write_center("GOLD", "bar\n")
+    with open(center_path % "GOLD") as center:
+        assert center.read() == "foo\nbar\n"
+
+
+def _legacy_configure_maf_row(row_array, headers, keep_samples,
+                              remove_variants, flagged_variants):
+    """Per-row configuration with Series.tolist() lookups, used as the
+    reference for the row filter"""
+    chrom = str(row_array[headers.index('Chromosome')])
+    start = str(row_array[headers.index('Start_Position')])
+    end = str(row_array[headers.index('End_Position')])
+    ref = str(row_array[headers.index('Reference_Allele')])
+    seq = str(row_array[headers.index('Tumor_Seq_Allele2')])
+    sampleid = str(row_array[headers.index('Tumor_Sample_Barcode')])
+    hgvsp = str(row_array[headers.index('HGVSp_Short')])
+    filter_info = str(row_array[headers.index('FILTER')])
+    variant = '{} {} {} {} {} {}'.format(chrom, start, end,
+                                         ref, seq, sampleid)
+    mergecheck_variant = '{} {} {} {} {} {}'.format(chrom, start, hgvsp,
+                                                    ref, seq, sampleid)
+    if sampleid in keep_samples.tolist() \
+            and variant not in remove_variants.tolist() \
+            and "common_variant" not in filter_info:
+        for i in ['t_depth', 't_ref_count', 't_alt_count',
+                  'n_depth', 'n_ref_count', 'n_alt_count']:
+            value = row_array[headers.index(i)]
+            row_array[headers.index(i)] = "" if str(value) == "." else value
+        n_depth = row_array[headers.index("n_depth")]
+        row_array[headers.index("Match_Norm_Seq_Allele2")] = \
+            '' if str(n_depth) in ["NA", "0.0"] else n_depth
+        row_array[headers.index("Match_Norm_Seq_Allele1")] = \
+            '' if str(n_depth) in ["NA", "0.0"] else n_depth
+        if mergecheck_variant in flagged_variants.tolist():
+            row_array.append('True')
+        else:
+            row_array.append('')
+        return process_functions.removeStringFloat(
+            "\t".join(row_array) + "\n")
+    return None
+
+
+def test_mafrowfilter_matches_per_row():
+    """The row filter keeps, removes, flags and formats rows like the
+    per-row Series lookups did"""
+    keep_samples = pd.Series(["GENIE-SAGE-%d" % i for i in range(0, 40, 2)])
+    remove_variants = pd.Series(
+        ["1 %d %d A T GENIE-SAGE-%d" % (i, i, i) for i in range(0, 40, 4)])
+    flagged_variants = pd.Series(
+        ["1 %d p.A1T A T GENIE-SAGE-%d" % (i, i) for i in range(0, 40, 6)])
+    rows = [_maf_row("SAGE", "GENIE-SAGE-%d" % i, str(i),
+                     filter_info="common_variant" if i % 10 == 8
+                     else "PASS").replace("\n", "").split("\t")
+            for i in range(40)]
+    rows.append(_maf_row("SAGE", "GENIE-SAGE-2", "2").replace(
+        "0.0\t.\t.\tA\tA", "NA\t1.0\t.\tA\tA").replace(
+            "\n", "").split("\t"))
+    row_filter = database_to_staging.MafRowFilter(
+        keep_samples, keep_samples, remove_variants,
+        flagged_variants).with_headers(MAF_HEADERS)
+
+    configured = [
+        row_filter.configure_row(list(row))
+        if row[row_filter.sample_idx] in row_filter.keep_merged_samples
+        else None
+        for row in rows]
+    expected = [
+        _legacy_configure_maf_row(list(row), MAF_HEADERS, keep_samples,
+                                  remove_variants, flagged_variants)
+        for row in rows]
+    assert configured == expected
+    assert any(row is not None and row.endswith("True\n")
+               for row in configured)
+
+
+def test_annotate_oncotree():
+    oncotree_mapping = {
+        'AMPCA': {
+            'CANCER_TYPE': 'Ampullary Cancer',
+            'CANCER_TYPE_DETAILED': 'Ampullary Carcinoma',
+            'ONCOTREE_PRIMARY_NODE': 'AMPCA',
+            'ONCOTREE_SECONDARY_NODE': ''},
+        'TESTIS': {
+            'CANCER_TYPE': 'Testicular Cancer, NOS',
+            'CANCER_TYPE_DETAILED': 'Testis',
+            'ONCOTREE_PRIMARY_NODE': 'AMPCA',
+            'ONCOTREE_SECONDARY_NODE': 'TESTIS'}}
+    clinicaldf = pd.DataFrame(dict(
+        SAMPLE_ID=["GENIE-1", "GENIE-2", "GENIE-3", "GENIE-4", "GENIE-5"],
+        ONCOTREE_CODE=["ampca", "TESTIS", "Unknown", "FOO", float('nan')],
+        AGE_AT_SEQ_REPORT=[">32485", "<6570", 20000, "20000", "Unknown"]))
+    annotateddf = database_to_staging.annotate_oncotree(
+        clinicaldf, oncotree_mapping)
+    assert annotateddf['CANCER_TYPE'].tolist()[:3] == [
+        'Ampullary Cancer', 'Testicular Cancer, NOS', 'UNKNOWN']
+    assert annotateddf['CANCER_TYPE'].isnull().tolist() == [
+        False, False, False, True, True]
+    assert annotateddf['ONCOTREE_SECONDARY_NODE'].tolist()[:3] == [
+        '', 'TESTIS', 'UNKNOWN']
+    assert annotateddf['ONCOTREE_CODE'].tolist()[:3] == [
+        "ampca", "TESTIS", "Unknown"]
+    assert annotateddf['ONCOTREE_CODE'][3:].isnull().all()
+    assert annotateddf['AGE_AT_SEQ_REPORT'].tolist() == [
+        ">89", "<18", 54, 54, "Unknown"]
+    assert annotateddf['AGE_AT_SEQ_REPORT_DAYS'].tolist() == \
+        clinicaldf['AGE_AT_SEQ_REPORT'].tolist()
+    # The input is not modified
+    assert 'CANCER_TYPE' not in clinicaldf
+
+
+def test_cnareleaseassembler(tmpdir):
+    """Center matrices are aligned on all symbols and written once"""
+    center1 = CnaMatrix.from_dataframe(
+        pd.DataFrame({"Hugo_Symbol": ["TP53", "AAK1"],
+                      "GENIE-1": [1.0, float('nan')],
+                      "GENIE-2": [-2, 0.5]}))
+    center2 = CnaMatrix.from_dataframe(
+        pd.DataFrame({"Hugo_Symbol": ["BRCA1", "TP53"],
+                      "GENIE-3": [2, -1]}))
+    assembler = database_to_staging.CnaReleaseAssembler(
+        ["TP53", "AAK1", "BRCA1", "TP53"], str(tmpdir), block_size=1)
+    aligned = assembler.align(center1)
+    assert aligned.symbols.tolist() == ["AAK1", "BRCA1", "TP53"]
+    assembler.add(aligned)
+    assembler.add(assembler.align(center2))
+    assembler.add(assembler.align(center2).select_samples([]))
+    cna_path = str(tmpdir.join("data_CNA.txt"))
+    assembler.write(cna_path)
+    assert assembler.samples == ["GENIE-1", "GENIE-2", "GENIE-3"]
+    with open(cna_path) as cna_file:
+        assert cna_file.read() == (
+            "Hugo_Symbol\tGENIE-1\tGENIE-2\tGENIE-3\n"
+            "AAK1\tNA\t0.5\tNA\n"
+            "BRCA1\tNA\tNA\t2\n"
+            "TP53\t1\t-2\t-1\n")
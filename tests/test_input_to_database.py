@@ -1,15 +1,25 @@
 from datetime import datetime
+import concurrent.futures
+import logging
 import mock
 from mock import patch
 import os
+import pickle
 import pytest
+import threading
+import time
 
 import pandas as pd
 import synapseclient
+try:
+    from synapseclient.core.exceptions import SynapseHTTPError
+except ModuleNotFoundError:
+    from synapseclient.exceptions import SynapseHTTPError
 import synapseutils
 
 from genie import input_to_database, process_functions
 from genie.clinical import clinical
+import genie.bed
 import genie.config
 from genie.mafSP import mafSP
 from genie.maf import maf
@@ -180,6 +190,111 @@ def test_vcf_get_center_input_files():
         patch_syn_get.assert_has_calls(calls)
 
 
+def test_centerfiledownloader(tmpdir):
+    """Every file takes a single get, the entities keep their order and
+    failed gets are retried"""
+    failures = []
+
+    def fake_get(synid, downloadFile):
+        if synid == 'syn3' and not failures:
+            failures.append(synid)
+            raise SynapseHTTPError("503 Server Error")
+        return synapseclient.File(path='/downloaded/' + synid, id=synid,
+                                  parentId='syn1')
+
+    download_syn = mock.create_autospec(synapseclient.Synapse)
+    download_syn.get.side_effect = fake_get
+    downloader = input_to_database.CenterFileDownloader(
+        download_syn, workers=2, retry_wait=0)
+    log_path = str(tmpdir.join("SAGE_log.txt"))
+    handler = logging.FileHandler(log_path, mode='w')
+    handler.addFilter(input_to_database.CenterLogFilter("SAGE"))
+    input_to_database.logger.addHandler(handler)
+    try:
+        with patch.object(input_to_database.time, "sleep") as patch_sleep,\
+                input_to_database._center_context("SAGE"):
+            ents = downloader.get_entities(['syn1', 'syn2', 'syn3'])
+    finally:
+        input_to_database.logger.removeHandler(handler)
+        handler.close()
+    patch_sleep.assert_called_once_with(0)
+    # The retry warning of a pool thread is in the center log
+    with open(log_path) as log_file:
+        assert "Getting syn3 failed" in log_file.read()
+    assert [ent.id for ent in ents] == ['syn1', 'syn2', 'syn3']
+    assert sorted(download_syn.get.call_args_list) == [
+        mock.call('syn1', downloadFile=True),
+        mock.call('syn2', downloadFile=True),
+        mock.call('syn3', downloadFile=True),
+        mock.call('syn3', downloadFile=True)]
+
+
+def test_centerfiledownloader_download():
+    """Fetched entities with an unmodified cached copy aren't downloaded
+    again and the cached copy isn't hashed"""
+    cached = synapseclient.File(name='cached.txt', id='syn1',
+                                parentId='syn1', dataFileHandleId='fh1')
+    changed = synapseclient.File(name='changed.txt', id='syn2',
+                                 parentId='syn1', dataFileHandleId='fh2')
+    downloaded = synapseclient.File(path='/downloaded/changed.txt',
+                                    id='syn2', parentId='syn1')
+    download_syn = mock.create_autospec(synapseclient.Synapse)
+    download_syn.get.return_value = downloaded
+    download_syn.cache = mock.Mock()
+    download_syn.cache.get.side_effect = \
+        lambda file_handle_id: '/cache/cached.txt' \
+        if file_handle_id == 'fh1' else None
+    downloader = input_to_database.CenterFileDownloader(download_syn)
+    ents = downloader.download([cached, changed])
+    assert [ent.path for ent in ents] == \
+        ['/cache/cached.txt', '/downloaded/changed.txt']
+    download_syn.get.assert_called_once_with('syn2', downloadFile=True)
+
+
+def test__download_changed_files():
+    """Only the files that changed since their validation are downloaded"""
+    statusdf = validation_statusdf.copy()
+    statusdf['path'] = ['/stored/first.txt', '/stored/second.txt']
+    unchanged = synapseclient.File(name='first.txt', id='syn1234',
+                                   md5='3333', parentId='syn1')
+    changed = synapseclient.File(name='second.txt', id='syn2345',
+                                 md5='55555', parentId='syn1')
+    downloaded = synapseclient.File(path='/downloaded/second.txt',
+                                    name='second.txt', id='syn2345',
+                                    md5='55555', parentId='syn1')
+    downloader = mock.Mock()
+    downloader.download.return_value = [downloaded]
+    file_statuses, file_errors = input_to_database.index_file_status(
+        mock_csv_query_result(statusdf),
+        mock_csv_query_result(error_trackerdf))
+    center_files = input_to_database._download_changed_files(
+        downloader, [[unchanged], [changed]], file_statuses, file_errors)
+    downloader.download.assert_called_once_with([changed])
+    assert center_files == [[unchanged], [downloaded]]
+    assert unchanged.path == '/stored/first.txt'
+
+
+def test_download_valid_files(tmpdir):
+    """Valid files without a local copy are downloaded for processing"""
+    local_path = tmpdir.join("first.txt")
+    local_path.write("first")
+    valid_filesdf = pd.DataFrame({
+        'id': ['syn1234', 'syn2345', 'syn3456'],
+        'path': [str(local_path), '/stored/second.txt', None],
+        'fileType': ['maf', 'cna', 'seg'],
+        'name': ['first.txt', 'second.txt', 'third.txt']})
+    downloader = mock.Mock()
+    downloader.get_entities.return_value = [
+        synapseclient.File(path='/downloaded/second.txt', parentId='syn1'),
+        synapseclient.File(path='/downloaded/third.txt', parentId='syn1')]
+    new_filesdf = input_to_database.download_valid_files(
+        downloader, valid_filesdf)
+    downloader.get_entities.assert_called_once_with(['syn2345', 'syn3456'])
+    assert new_filesdf['path'].tolist() == [
+        str(local_path), '/downloaded/second.txt', '/downloaded/third.txt']
+    assert valid_filesdf['path'][1] == '/stored/second.txt'
+
+
 def test_empty_get_center_input_files():
     '''
     Test that center input files is empty if directory
@@ -329,6 +444,30 @@ def test_error_check_existing_file_status():
             emptydf, emptydf, entities)
 
 
+def test_index_file_status():
+    """The first status and error of each file id is indexed"""
+    statusdf = validation_statusdf.append(
+        {'id': 'syn1234', 'status': 'INVALID', 'md5': '5555',
+         'name': 'first.txt', 'fileType': 'filetype1'}, ignore_index=True)
+    file_statuses, file_errors = input_to_database.index_file_status(
+        mock_csv_query_result(statusdf), mock_csv_query_result(emptydf))
+    assert file_statuses == {
+        'syn1234': {'status': 'VALID', 'md5': '3333', 'name': 'first.txt'},
+        'syn2345': {'status': 'INVALID', 'md5': '44444',
+                    'name': 'second.txt'}}
+    assert file_errors == {}
+    entity = synapseclient.Entity(name='second.txt', id='syn2345',
+                                  md5='44444')
+    file_statuses, file_errors = input_to_database.index_file_status(
+        mock_csv_query_result(statusdf), mock_csv_query_result(error_trackerdf))
+    assert file_errors == {'syn2345': 'Invalid file format'}
+    file_status = input_to_database.check_existing_file_status(
+        file_statuses, file_errors, [entity])
+    assert file_status == {'status_list': ['INVALID'],
+                           'error_list': ['Invalid file format'],
+                           'to_validate': False}
+
+
 def test_create_and_archive_maf_database():
     '''
     Test the creation and archive of the maf database
@@ -807,6 +946,8 @@ class TestValidation:
                       'duplicated_filesdf': self.empty_dup}
         validationstatus_mock = emptytable_mock()
         errortracking_mock = emptytable_mock()
+        file_statuses = {}
+        file_errors = {}
         with patch.object(syn, "tableQuery",
                           side_effect=[validationstatus_mock,
                                        errortracking_mock]) as patch_query,\
@@ -820,6 +961,8 @@ class TestValidation:
                           return_value=self.errors_df),\
              patch.object(input_to_database, "_update_tables_content",
                           return_value=new_tables),\
+             patch.object(input_to_database, "index_file_status",
+                          return_value=(file_statuses, file_errors)),\
              patch.object(input_to_database, "update_status_and_error_tables"):
             valid_filedf = input_to_database.validation(
                 syn, "syn123", center, process,
@@ -829,8 +972,8 @@ class TestValidation:
             assert patch_query.call_count == 2
             patch_validatefile.assert_called_once_with(
                 syn, "syn123", entity,
-                validationstatus_mock,
-                errortracking_mock,
+                file_statuses,
+                file_errors,
                 center='SAGE', threads=1,
                 oncotree_link=oncotree_link,
                 format_registry=genie.config.PROCESS_FILES
@@ -841,6 +984,216 @@ class TestValidation:
             )
 
 
+def test__validate_center_files():
+    """File groups are validated concurrently, results keep their order"""
+    center_files = [[synapseclient.Entity(id=f'syn{i}', name=f'file{i}')]
+                    for i in range(6)]
+
+    def fake_validatefile(syn, project_id, ents, *args, **kwargs):
+        # Make earlier files finish last
+        time.sleep(0.01 * (6 - int(ents[0].id[3:])))
+        return ([ents[0].id], None, [])
+
+    with patch.object(input_to_database, "validatefile",
+                      side_effect=fake_validatefile) as patch_validatefile:
+        results = input_to_database._validate_center_files(
+            syn, "syn123", center, center_files,
+            "status_table", "error_table",
+            oncotree_link, genie.config.PROCESS_FILES, threads=3)
+    assert patch_validatefile.call_count == 6
+    assert [status for status, _, _ in results] == \
+        [[f'syn{i}'] for i in range(6)]
+    for call in patch_validatefile.call_args_list:
+        assert call[1]['threads'] == 1
+
+
+PROCESS_SYN = mock.create_autospec(synapseclient.Synapse)
+PROCESS_SYN.cache = mock.Mock(cache_root_dir="synapse_cache")
+PROCESS_LOGINS = []
+
+
+def _process_syn_login():
+    PROCESS_LOGINS.append(PROCESS_SYN)
+    return PROCESS_SYN
+
+
+class InlineProcessPoolExecutor(object):
+    """Runs the submitted calls in this process, after checking that
+    everything sent to the processes can be pickled"""
+    def __init__(self, max_workers):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def submit(self, func, *args):
+        pickle.loads(pickle.dumps((func, args)))
+        future = concurrent.futures.Future()
+        future.set_result(func(*args))
+        return future
+
+
+def test__validate_center_files_process():
+    """File groups are validated in processes that log in once and get
+    only their own statuses, results keep their order"""
+    center_files = [[synapseclient.Entity(id=f'syn{i}', name=f'file{i}')]
+                    for i in range(3)]
+    file_statuses = {f'syn{i}': {'status': 'VALIDATED', 'md5': str(i)}
+                     for i in range(3)}
+
+    def fake_validatefile(syn, project_id, ents, statuses, errors,
+                          **kwargs):
+        return ([ents[0].id], sorted(statuses), [])
+
+    del PROCESS_LOGINS[:]
+    with patch.object(input_to_database, "validatefile",
+                      side_effect=fake_validatefile) as patch_validatefile,\
+            patch.object(input_to_database.concurrent.futures,
+                         "ProcessPoolExecutor", InlineProcessPoolExecutor),\
+            patch.object(input_to_database, "_PROCESS_SYN", None),\
+            patch.object(input_to_database, "_log_to_queue"),\
+            patch.object(process_functions.ONCOTREE_CACHE,
+                         "use_synapse_cache") as patch_use_cache:
+        results = input_to_database._validate_center_files(
+            syn, "syn123", center, center_files,
+            file_statuses, {}, oncotree_link, genie.config.PROCESS_FILES,
+            threads=2, validation_executor="process",
+            syn_login=_process_syn_login)
+    assert results == [([f'syn{i}'], [f'syn{i}'], []) for i in range(3)]
+    assert PROCESS_LOGINS == [PROCESS_SYN]
+    patch_use_cache.assert_called_once_with(PROCESS_SYN)
+    for call in patch_validatefile.call_args_list:
+        assert call[0][0] is PROCESS_SYN
+
+
+def _logging_validatefile(syn, project_id, ents, *args, **kwargs):
+    input_to_database.logger.warning(f"validating {ents[0].id}")
+    return ([ents[0].id], None, [])
+
+
+def test__validate_center_files_process_logs(tmpdir):
+    """Log records of the validation processes reach the center log"""
+    center_files = [[synapseclient.Entity(id=f'syn{i}', name=f'file{i}')]
+                    for i in range(2)]
+    log_path = str(tmpdir.join("SAGE_log.txt"))
+    handler = logging.FileHandler(log_path, mode='w')
+    handler.addFilter(input_to_database.CenterLogFilter("SAGE"))
+    input_to_database.logger.addHandler(handler)
+    try:
+        with patch.object(input_to_database, "validatefile",
+                          _logging_validatefile):
+            results = input_to_database._validate_center_files(
+                syn, "syn123", "SAGE", center_files, {}, {},
+                oncotree_link, genie.config.PROCESS_FILES, threads=2,
+                validation_executor="process",
+                syn_login=_process_syn_login)
+    finally:
+        input_to_database.logger.removeHandler(handler)
+        handler.close()
+    assert [status for status, _, _ in results] == [['syn0'], ['syn1']]
+    with open(log_path) as log_file:
+        logs = log_file.read()
+    assert "validating syn0" in logs
+    assert "validating syn1" in logs
+
+
+def test__validate_center_files_process_login():
+    """The process executor needs a way to log in"""
+    center_files = [[synapseclient.Entity(id=f'syn{i}', name=f'file{i}')]
+                    for i in range(2)]
+    with pytest.raises(ValueError):
+        input_to_database._validate_center_files(
+            syn, "syn123", center, center_files, {}, {}, oncotree_link,
+            genie.config.PROCESS_FILES, threads=2,
+            validation_executor="process")
+
+
+def test_stagelimits():
+    """Only the limited number of centers run a stage at the same time"""
+    stage_limits = input_to_database.StageLimits(processing=2)
+    running = []
+    most_running = []
+    lock = threading.Lock()
+
+    def _process(center):
+        with stage_limits.stage("processing"), \
+                stage_limits.stage("validation"):
+            with lock:
+                running.append(center)
+                most_running.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(center)
+
+    threads = [threading.Thread(target=_process, args=(i,))
+               for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(most_running) == 2
+
+
+def test_centerlogfilter(tmpdir):
+    """Log records only go to the log of the center that emitted them"""
+    log_path = str(tmpdir.join("SAGE_log.txt"))
+    handler = logging.FileHandler(log_path, mode='w')
+    handler.addFilter(input_to_database.CenterLogFilter("SAGE"))
+    input_to_database.logger.addHandler(handler)
+    try:
+        with input_to_database._center_context("SAGE"):
+            input_to_database.logger.warning("sage")
+        with input_to_database._center_context("GOLD"):
+            input_to_database.logger.warning("gold")
+        input_to_database.logger.warning("no center")
+    finally:
+        input_to_database.logger.removeHandler(handler)
+        handler.close()
+    with open(log_path) as log_file:
+        assert log_file.read() == "sage\n"
+
+
+def test_centers_input_to_database():
+    """Centers run concurrently, failed centers are returned"""
+    def fake_center_input_to_database(syn, project_id, center, *args,
+                                      **kwargs):
+        if center == "GOLD":
+            raise ValueError("GOLD failed")
+
+    with patch.object(input_to_database, "center_input_to_database",
+                      side_effect=fake_center_input_to_database) as patch_c,\
+         patch.object(genie.bed.GENE_POSITIONS, "load") as patch_load,\
+         patch.object(process_functions,
+                      "get_oncotree_code_mappings") as patch_oncotree:
+        failed = input_to_database.centers_input_to_database(
+            syn, "syn123", ["SAGE", "GOLD", "TEST"], "maf",
+            True, None, None, None, None, center_mapping_df,
+            oncotree_link=oncotree_link, center_workers=3)
+    assert failed == ["GOLD"]
+    assert patch_c.call_count == 3
+    patch_load.assert_called_once_with(syn)
+    patch_oncotree.assert_called_once_with(oncotree_link)
+    stage_limits = patch_c.call_args[1]['stage_limits']
+    assert stage_limits._semaphores['processing']._initial_value == 1
+    assert stage_limits._semaphores['validation']._initial_value == 3
+
+
+def test_centers_input_to_database_sequential():
+    """Failed centers are also collected when centers run one by one"""
+    with patch.object(input_to_database, "center_input_to_database",
+                      side_effect=[None, ValueError("GOLD failed"),
+                                   None]) as patch_c,\
+         patch.object(genie.bed.GENE_POSITIONS, "load"):
+        failed = input_to_database.centers_input_to_database(
+            syn, "syn123", ["SAGE", "GOLD", "TEST"], "maf",
+            True, None, None, None, None, center_mapping_df)
+    assert failed == ["GOLD"]
+    assert patch_c.call_count == 3
+
+
 @pytest.mark.parametrize(
     'process, genieclass, filetype', [
         ('main', clinical, 'clinical'),
@@ -929,3 +1282,18 @@ def test_notvcf_processfile():
             veppath=None, vepdata=None,
             processing='vcf', reference=None)
         patch_process.assert_called_once()
+
+
+def test_center_input_to_database_logs_failure(tmpdir):
+    """The traceback of a failing center is in its log"""
+    with patch.object(process_functions, "SCRIPT_DIR", str(tmpdir)),\
+            patch.object(input_to_database, "_center_input_to_staging",
+                         side_effect=ValueError("bad bed")),\
+            pytest.raises(ValueError):
+        input_to_database.center_input_to_database(
+            syn, "syn123", "SAGE", "main", True, None, None, None, None,
+            None)
+    with open(str(tmpdir.join("SAGE_validation_log.txt"))) as log_file:
+        logs = log_file.read()
+    assert "SAGE failed" in logs
+    assert "ValueError: bad bed" in logs
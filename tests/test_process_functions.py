@@ -1,6 +1,7 @@
 import mock
 from mock import patch
 import pytest
+import threading
 
 import pandas as pd
 import synapseclient
@@ -267,6 +268,43 @@ def test_norows__delete_rows():
     assert delete_rows.empty
 
 
+def test__get_different_rows():
+    database = pd.DataFrame({
+        "test": ['a', 'b', 'c', 'd'],
+        "foo": [1, 2, 3, 4],
+        "mixed": [1, '1', 2.0, 'x']})
+    new_datadf = pd.DataFrame({
+        "test": ['a', 'b', 'z', 'd'],
+        "foo": [1, 2, 3, 4],
+        "mixed": ['1', '1', 2, 'x']})
+    differentrows = genie.process_functions._get_different_rows(
+        new_datadf, database)
+    assert differentrows.tolist() == [True, False, True, False]
+
+
+def test__diff_datasets():
+    databasedf = DATABASE_DF.fillna('')
+    new_datadf = pd.DataFrame({
+        'UNIQUE_KEY': ['test1', 'test2', 'test4', 'test2'],
+        "test": ['test1', 'new', 'test4', 'dup'],
+        "foo": [1, 2, 4, 2],
+        "baz": ['', '', 3.2, '']})
+    appenddf, updatedf, deletedf = \
+        genie.process_functions._diff_datasets(
+            new_datadf, databasedf, 'UNIQUE_KEY')
+    assert appenddf.equals(
+        genie.process_functions._append_rows(
+            new_datadf.copy(), databasedf.copy(), 'UNIQUE_KEY'))
+    assert updatedf.equals(
+        genie.process_functions._update_rows(
+            new_datadf.copy(), databasedf.copy(), 'UNIQUE_KEY'))
+    assert deletedf.equals(
+        genie.process_functions._delete_rows(
+            new_datadf.copy(), databasedf.copy(), 'UNIQUE_KEY'))
+    assert updatedf['test'].tolist() == ['new']
+    assert deletedf.values.tolist() == [['3', '5']]
+
+
 class argparser:
     def asDataFrame(self):
         database_dict = {"Database": ["centerMapping"],
@@ -304,3 +342,143 @@ def test_get_syntabledf():
         df = genie.process_functions.get_syntabledf(syn, querystring)
         patch_syn_tablequery.assert_called_once_with(querystring)
         assert df.equals(arg.asDataFrame())
+
+
+def test_mappingtablecache(tmpdir):
+    '''
+    Test that mapping tables are queried once per etag of their rows
+    '''
+    mappingdf = pd.DataFrame({
+        "CODE": [1, 2, 99],
+        "CBIO_LABEL": ["Male", "Female", float('nan')]})
+    table = mock.Mock()
+    table.asDataFrame.return_value = mappingdf
+    rows = mock.Mock(etag="etag1")
+    cache_syn = mock.create_autospec(synapseclient.Synapse)
+    cache_syn.tableQuery.side_effect = \
+        lambda query, **kwargs: rows if query.endswith("LIMIT 1") else table
+    etag_call = mock.call("SELECT * FROM syn123 LIMIT 1", resultsAs="rowset")
+    table_call = mock.call("SELECT * FROM syn123")
+    cache = genie.process_functions.MappingTableCache(
+        cache_dir=str(tmpdir))
+    expecteddf = mappingdf.fillna("")
+
+    assert cache.get(cache_syn, "syn123").equals(expecteddf)
+    assert cache.get(cache_syn, "syn123").equals(expecteddf)
+    assert cache_syn.tableQuery.call_args_list == [etag_call, table_call]
+
+    # Tables are read from disk after the ttl when the etag is the same
+    cache.clear()
+    assert cache.get(cache_syn, "syn123").equals(expecteddf)
+    assert cache_syn.tableQuery.call_args_list == [etag_call, table_call,
+                                                   etag_call]
+    # and queried again when a row was edited
+    cache.clear()
+    rows.etag = "etag2"
+    assert cache.get(cache_syn, "syn123").equals(expecteddf)
+    assert cache_syn.tableQuery.call_args_list[-1] == table_call
+    assert cache_syn.tableQuery.call_count == 5
+    # or when the copy on disk is too old
+    cache = genie.process_functions.MappingTableCache(
+        cache_dir=str(tmpdir), ttl=0)
+    cache.get(cache_syn, "syn123")
+    assert cache_syn.tableQuery.call_args_list[-1] == table_call
+    assert cache_syn.tableQuery.call_count == 7
+
+
+def test_mappingtablecache_per_table(tmpdir):
+    '''
+    Test that a slow table query doesn't hold up other tables
+    '''
+    slow_querying = threading.Event()
+    fast_queried = threading.Event()
+
+    def table_query(query, **kwargs):
+        if query == "SELECT * FROM syn1":
+            slow_querying.set()
+            assert fast_queried.wait(5)
+        elif query == "SELECT * FROM syn2":
+            fast_queried.set()
+        table = mock.Mock(etag=None)
+        table.asDataFrame.return_value = pd.DataFrame({"CODE": [1]})
+        return table
+
+    cache_syn = mock.create_autospec(synapseclient.Synapse)
+    cache_syn.tableQuery.side_effect = table_query
+    cache = genie.process_functions.MappingTableCache(
+        cache_dir=str(tmpdir))
+    slow = threading.Thread(target=cache.get, args=(cache_syn, "syn1"))
+    slow.start()
+    assert slow_querying.wait(5)
+    cache.get(cache_syn, "syn2")
+    slow.join()
+    assert fast_queried.is_set()
+
+
+def test_mappingtablecache_synapse_cache(tmpdir):
+    '''
+    Test that the mapping tables are kept in the Synapse client's cache
+    unless a cache directory is given
+    '''
+    cache_syn = mock.create_autospec(synapseclient.Synapse)
+    cache_syn.cache = mock.Mock(cache_root_dir=str(tmpdir))
+    table = mock.Mock()
+    table.asDataFrame.return_value = pd.DataFrame({"CODE": [1]})
+    cache_syn.tableQuery.side_effect = \
+        lambda query, **kwargs: mock.Mock(etag="etag1") \
+        if query.endswith("LIMIT 1") else table
+    genie.process_functions.MappingTableCache().get(cache_syn, "syn123")
+    assert tmpdir.join("genie_mapping_cache", "syn123_etag1.pkl").check()
+
+
+def test_oncotreecache_synapse_cache(tmpdir):
+    '''
+    Test that the oncotree snapshots are kept in the Synapse client's
+    cache unless a snapshot directory is given
+    '''
+    cache_syn = mock.create_autospec(synapseclient.Synapse)
+    cache_syn.cache = mock.Mock(cache_root_dir=str(tmpdir))
+    oncotree_cache = genie.process_functions.OncotreeCache()
+    oncotree_cache.use_synapse_cache(cache_syn)
+    assert oncotree_cache.cache_dir == str(tmpdir.join("oncotree_cache"))
+    assert genie.process_functions.OncotreeCache(
+        cache_dir="snapshots").cache_dir == "snapshots"
+
+
+def test_codemapper():
+    '''
+    Test that CodeMapper gives the same values as getCODE
+    '''
+    mappingdf = pd.DataFrame({
+        "CODE": [1, 2, 99, 1],
+        "CBIO_LABEL": ["Male", "Female", "Unknown", "Duplicated"],
+        "DESCRIPTION": ["male", "female", "not coded", "duplicated"]})
+    mapper = genie.process_functions.CodeMapper(mappingdf)
+    codes = pd.Series([1, 2.0, "1", 3, "", 99], dtype=object)
+    for use_description in [False, True]:
+        expected = [
+            genie.process_functions.getCODE(
+                mappingdf, code, useDescription=use_description)
+            for code in codes]
+        assert mapper.map(
+            codes, useDescription=use_description).tolist() == expected
+    assert mapper.map(codes).tolist() == [
+        "Male", "Female", "", "", "", "Unknown"]
+    assert mapper.get_code(2, useDescription=True) == "female"
+
+
+def test_format_genie_ids():
+    ids = pd.Series(["ID1", "SAGE-ID2", "GENIE-SAGE-ID3", 4])
+    expected = [genie.process_functions.checkGenieId(genie_id, "SAGE")
+                for genie_id in ids]
+    assert genie.process_functions.format_genie_ids(
+        ids, "SAGE").tolist() == expected
+
+
+def test_coerce_int():
+    values = pd.Series([1990, "1990", " 18", 2.0, "Unknown", "", 1.5],
+                       dtype=object)
+    coerced = genie.process_functions.coerce_int(values)
+    assert coerced.tolist() == [1990, 1990, 18, 2, "Unknown", "", 1.5]
+    coerced = genie.process_functions.coerce_int(pd.Series([1.0, 2.0]))
+    assert coerced.dtype == "int64"
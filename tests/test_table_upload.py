@@ -0,0 +1,129 @@
+import mock
+import pytest
+
+import pandas as pd
+import requests
+
+from genie import table_upload
+
+TABLE_TEXT = (
+    'ROW_ID,ROW_VERSION,SAMPLE_ID,NOTE\n'
+    ',,GENIE-1,"two\nlines"\n'
+    ',,GENIE-2,foo\n'
+    '3,4,GENIE-3,"a ""quoted"" value"\n'
+    '5,6\n')
+
+
+@pytest.fixture
+def table_path(tmpdir):
+    path = tmpdir.join("update.csv")
+    path.write(TABLE_TEXT)
+    return str(path)
+
+
+def test_split_table_file(table_path, tmpdir):
+    chunk_dir = tmpdir.mkdir("chunks")
+    chunk_paths = table_upload.split_table_file(
+        table_path, str(chunk_dir), max_bytes=60)
+    chunks = [open(chunk_path).read() for chunk_path in chunk_paths]
+    header = 'ROW_ID,ROW_VERSION,SAMPLE_ID,NOTE\n'
+    assert chunks == [
+        header + ',,GENIE-1,"two\nlines"\n',
+        header + ',,GENIE-2,foo\n',
+        header + '3,4,GENIE-3,"a ""quoted"" value"\n',
+        header + '5,6\n']
+    chunk_paths = table_upload.split_table_file(
+        table_path, str(chunk_dir), max_rows=3)
+    assert len(chunk_paths) == 2
+
+
+def test_tableuploader_store(table_path):
+    syn = table_upload.LocalTableClient()
+    uploader = table_upload.TableUploader(syn, max_rows=2)
+    assert uploader.store("syn1", table_path) == 2
+    changes = syn.changes("syn1")
+    assert len(syn.tables["syn1"]) == 2
+    assert changes.equals(
+        pd.read_csv(table_path, dtype=str, na_filter=False))
+    assert uploader.store("syn2", table_path) == 2
+    uploader = table_upload.TableUploader(syn)
+    assert uploader.store("syn3", table_path) == 1
+
+
+def test_tableuploader_retry(table_path):
+    syn = table_upload.LocalTableClient(fail_times=2)
+    uploader = table_upload.TableUploader(
+        syn, max_rows=2, retries=2, retry_wait=0)
+    with mock.patch.object(table_upload.time, "sleep") as patch_sleep:
+        uploader.store("syn1", table_path)
+    assert patch_sleep.call_count == 2
+    assert len(syn.changes("syn1")) == 4
+
+    syn = table_upload.LocalTableClient(fail_times=3)
+    uploader = table_upload.TableUploader(syn, retries=2, retry_wait=0)
+    with pytest.raises(table_upload.SynapseHTTPError):
+        uploader.store("syn1", table_path)
+    assert syn.changes("syn1").empty
+
+
+def test_tableuploader_workers(table_path):
+    syn = table_upload.LocalTableClient()
+    uploader = table_upload.TableUploader(syn, max_rows=1, workers=2)
+    assert uploader.store("syn1", table_path) == 4
+    assert len(syn.changes("syn1")) == 4
+
+
+def test_is_retryable():
+    assert table_upload.is_retryable(
+        requests.exceptions.ConnectionError())
+    assert table_upload.is_retryable(
+        table_upload.SynapseHTTPError("503 Server Error: Unavailable"))
+    assert table_upload.is_retryable(
+        table_upload.SynapseHTTPError("429 Client Error: Too Many"))
+    response = mock.Mock(status_code=502)
+    assert table_upload.is_retryable(
+        table_upload.SynapseHTTPError("Bad gateway", response=response))
+    assert not table_upload.is_retryable(
+        table_upload.SynapseHTTPError("400 Client Error: Bad Request"))
+    assert not table_upload.is_retryable(
+        table_upload.SynapseHTTPError("404 Client Error: Not Found"))
+    assert not table_upload.is_retryable(ValueError("foo"))
+
+
+def test_tableuploader_client_error(table_path):
+    """Client errors fail the same way every time and aren't retried"""
+    syn = table_upload.LocalTableClient(fail_times=1, status_code=400)
+    uploader = table_upload.TableUploader(syn, retry_wait=0)
+    with mock.patch.object(table_upload.time, "sleep") as patch_sleep,\
+            pytest.raises(table_upload.SynapseHTTPError):
+        uploader.store("syn1", table_path)
+    patch_sleep.assert_not_called()
+    assert syn.changes("syn1").empty
+
+
+def test_tableuploader_ambiguous_failure(table_path):
+    """A chunk that may have been stored is not sent again"""
+    syn = table_upload.LocalTableClient(fail_times=1, fail_after_start=True)
+    uploader = table_upload.TableUploader(syn, max_rows=2, retry_wait=0)
+    with mock.patch.object(table_upload.time, "sleep"),\
+            pytest.raises(table_upload.SynapseError):
+        uploader.store("syn1", table_path)
+    assert len(syn.changes("syn1")) == 2
+
+
+def test_tableuploader_wait_for_transaction():
+    """Transactions are polled until they are done"""
+    syn = mock.Mock()
+    syn.restGET.side_effect = [{'jobState': 'PROCESSING'},
+                               {'results': []},
+                               {'jobState': 'PROCESSING'},
+                               {'jobState': 'FAILED', 'errorMessage': 'foo'}]
+    uploader = table_upload.TableUploader(syn)
+    with mock.patch.object(table_upload.time, "sleep") as patch_sleep:
+        assert uploader._wait_for_transaction("syn1", "1") == \
+            {'results': []}
+        with pytest.raises(table_upload.SynapseError):
+            uploader._wait_for_transaction("syn1", "2")
+    assert patch_sleep.call_count == 2
+    syn.restGET.assert_called_with(
+        "/entity/syn1/table/transaction/async/get/2")
@@ -284,8 +284,11 @@ def test_perform_validate():
          patch.object(validate.GenieValidationHelper,
                       "validate_single_file",
                       return_value=(valid, 'foo')) as patch_validate,\
-         patch.object(validate, "_upload_to_synapse") as patch_syn_upload:
+         patch.object(validate, "_upload_to_synapse") as patch_syn_upload,\
+         patch.object(process_functions.ONCOTREE_CACHE,
+                      "use_synapse_cache") as patch_use_cache:
         validate._perform_validate(syn, arg)
+        patch_use_cache.assert_called_once_with(syn)
         patch_check_parentid.assert_called_once_with(syn, arg.parentid)
         patch_getdb.assert_called_once_with(syn, project_id=arg.project_id)
         patch_syn_tablequery.assert_called_once_with('select * from syn123')